@@ -1 +0,0 @@
-print("Hello World")
@@ -1,9 +1,10 @@
 from . import oscillations
 from . import neurons_stability
 from . import neurons_correlation
+from . import ratemap_metrics
 from .artifact import *
 from .brainstates import *
 from .spkepochs import *
 from .reactivation import ExplainedVariance, NeuronEnsembles
-from .placefields import Pf1D, Pf2D
+from .placefields import Pf1D, Pf2D, LapRatemaps
 from .decoders import Decode1d, Decode2d
@@ -1,21 +1,66 @@
 import pandas as pd
 import numpy as np
+import typing
 from scipy import stats
 from ..core import Epoch
 from ..core import Signal
-from ..utils import signal_process
+from ..utils import signal_process, mathutil
 from pathlib import Path
 
 
+def _filter_traces(traces, sampling_rate, filt=None):
+    """Filters traces (along last axis) according to filt"""
+    if filt is None:
+        return traces
+
+    assert len(filt) == 2, "Inputs for filtering signal must be length = 2"
+    if filt[0] is not None and filt[1] is not None:  # bandpass
+        return signal_process.filter_sig.bandpass(
+            traces, filt[0], filt[1], fs=sampling_rate
+        )
+    elif filt[0] is not None:  # highpass
+        return signal_process.filter_sig.highpass(traces, filt[0], fs=sampling_rate)
+    elif filt[1] is not None:  # lowpass
+        return signal_process.filter_sig.lowpass(traces, filt[1], fs=sampling_rate)
+    else:
+        return traces
+
+
+def _robust_stats(signal: Signal, combine, filt=None, n_segments=100, max_frames=2e6):
+    """Median and MAD (scaled to std of normal distribution) of each channel estimated from segments spread evenly across the recording"""
+    n_frames = signal.n_frames
+    seg_frames = int(min(10 * signal.sampling_rate, max_frames / n_segments))
+    if n_frames <= n_segments * seg_frames:
+        seg_starts, seg_frames = np.array([0]), n_frames
+    else:
+        seg_starts = np.linspace(0, n_frames - seg_frames, n_segments).astype("int")
+
+    traces = []
+    for start in seg_starts:
+        seg = np.asarray(signal.traces[:, start : start + seg_frames], dtype="float")
+        if combine == "mean":
+            seg = seg.mean(axis=0, keepdims=True)
+        traces.append(_filter_traces(seg, signal.sampling_rate, filt))
+    traces = np.hstack(traces)
+
+    median = np.median(traces, axis=1, keepdims=True)
+    mad = stats.median_abs_deviation(traces, axis=1, scale="normal")[:, None]
+    return median, mad
+
+
 def detect_artifact_epochs(
     signal: Signal,
     thresh=4,
     edge_cutoff=2,
     merge=5,
     filt: list or np.ndarray = None,
+    combine: typing.Literal["mean", "or", "and", "vote"] = "mean",
+    min_votes=None,
+    block_dur=60,
+    return_mask=False,
 ):
     """
-    calculating artifact periods using z-score measure
+    calculating artifact periods using robust z-score measure (median/MAD). Signal is processed in blocks, so it works on large memmap arrays.
 
     Parameters
     ----------
@@ -27,81 +72,96 @@ def detect_artifact_epochs(
         zscore value, boundries are extended to this value, by default 2
     merge : int,
         artifacts less than this seconds apart are merged, default 5 seconds
-    method : str, optional
-        [description], by default "zscore"
     filt : list, optional
         lower and upper limits with which to filter signal, e.g. 3, 3000] ->
         bandpass between and 3000 Hz while [45, None] -> high-pass above 45.
-    data_use: str, optional (Not currently implemented)
-        'raw_only' (default): z-score raw only
-        'filt_only': z-score filtered data only
-        'both': z-score both raw and filtered data
+    combine : str, optional
+        how multiple channels are combined,
+        'mean' (default): zscore of mean across channels
+        'or': any channel exceeds threshold
+        'and': all channels exceed threshold
+        'vote': at least min_votes channels exceed threshold
+    min_votes : int, optional
+        used when combine='vote', by default None (majority of channels). Flat channels (MAD = 0) are ignored and not counted
+    block_dur : float, optional
+        duration of blocks (seconds) processed at once, by default 60 seconds
+    return_mask : bool, optional
+        if True, a packed (np.packbits) boolean mask of artifact frames is also returned, by default False. It is unpacked with np.unpackbits(mask, count=signal.n_frames).astype(bool) and converted to epochs for ignore_epochs of other detectors with Epoch.from_boolean_array(unpacked_mask, t=signal.time)
+
     Returns
     -------
     core.Epoch
+        artifact epochs (and packed mask if return_mask=True)
     """
 
     assert edge_cutoff <= thresh, "edge_cutoff can not be bigger than thresh"
+    assert combine in ["mean", "or", "and", "vote"], "invalid combine method"
     sampling_rate = signal.sampling_rate
-
-    if signal.n_channels > 1:
-        sig_raw = np.mean(signal.traces, axis=0)
-
-    else:
-        sig_raw = signal.traces.reshape((-1))
-
-    # NRK todo: does this need to go BEFORE taking the median of the signal above?
-    # After condensing into one trace, filter signal if specified
-    if filt is not None:
-        assert len(filt) == 2, "Inputs for filtering signal must be length = 2"
-        if filt[0] is not None:  # highpass
-            sig = signal_process.filter_sig.highpass(sig_raw, filt[0], fs=sampling_rate)
-        elif filt[1] is not None:  # lowpass
-            sig = signal_process.filter_sig.lowpass(sig_raw, filt[1], fs=sampling_rate)
-        elif filt[0] is not None and filt[1] is not None:  # bandpass
-            sig = signal_process.filter_sig.bandpass(
-                sig_raw, filt[0], filt[1], fs=sampling_rate
-            )
-    elif filt is None:
-        sig = sig_raw
-
-    # ---- zscoring and identifying start and stops---------
-    zsc = np.abs(stats.zscore(sig, axis=-1))
-    artifact_binary = np.where(zsc > thresh, 1, 0)
-    artifact_binary = np.concatenate(([0], artifact_binary, [0]))
-    artifact_diff = np.diff(artifact_binary)
-    artifact_start = np.where(artifact_diff == 1)[0]
-    artifact_end = np.where(artifact_diff == -1)[0]
-    firstPass = np.vstack((artifact_start, artifact_end)).T
+    n_frames = signal.n_frames
+
+    median, mad = _robust_stats(signal, combine, filt)
+
+    # flat or disconnected channels (zero MAD) would have infinite zscores
+    valid = mad[:, 0] > 0
+    assert valid.any(), "all channels are flat (MAD = 0)"
+    if not valid.all():
+        print(f"Channels {signal.channel_id[~valid]} are flat (MAD = 0) and ignored")
+    median, mad = median[valid], mad[valid]
+
+    if combine == "vote" and min_votes is None:
+        min_votes = valid.sum() // 2 + 1
+
+    def combine_channels(zsc, cutoff):
+        above = zsc > cutoff
+        if combine in ["mean", "or"]:
+            return above.any(axis=0)
+        elif combine == "and":
+            return above.all(axis=0)
+        else:
+            return above.sum(axis=0) >= min_votes
+
+    # ---- zscoring and identifying start and stops blockwise ---------
+    block_frames = int(block_dur * sampling_rate)
+    pad = int(2 * sampling_rate) if filt is not None else 0
+    artifact_epochs, edge_epochs = [], []
+    for start in range(0, n_frames, block_frames):
+        stop = min(start + block_frames, n_frames)
+        pad_start, pad_stop = max(start - pad, 0), min(stop + pad, n_frames)
+        traces = np.asarray(signal.traces[:, pad_start:pad_stop], dtype="float")
+        if combine == "mean":
+            traces = traces.mean(axis=0, keepdims=True)
+        traces = _filter_traces(traces, sampling_rate, filt)
+        traces = traces[:, start - pad_start : stop - pad_start]
+
+        zsc = np.abs(traces[valid] - median) / mad
+        artifact_bool = combine_channels(zsc, thresh)
+        if artifact_bool.any():
+            artifact_epochs.append(mathutil.contiguous_regions(artifact_bool) + start)
+        edge_bool = combine_channels(zsc, edge_cutoff)
+        if edge_bool.any():
+            edge_epochs.append(mathutil.contiguous_regions(edge_bool) + start)
+
+    # regions continuing across blocks are joined
+    concat = lambda x: np.concatenate(x) if len(x) > 0 else np.zeros((0, 2), "int")
+    firstPass = mathutil.merge_intervals(concat(artifact_epochs), gap=1)
+    edges = mathutil.merge_intervals(concat(edge_epochs), gap=1)
 
     # --- extending the edges of artifact region --------
-    edge_binary = np.where(zsc > edge_cutoff, 1, 0)
-    edge_binary = np.concatenate(([0], edge_binary, [0]))
-    edge_diff = np.diff(edge_binary)
-    edge_start = np.where(edge_diff == 1)[0]
-    edge_end = np.where(edge_diff == -1)[0]
-
-    edge_start = edge_start[np.digitize(firstPass[:, 0], edge_start) - 1]
-    edge_end = edge_end[np.digitize(firstPass[:, 1], edge_end, right=True)]
-    firstPass[:, 0], firstPass[:, 1] = edge_start, edge_end
+    if len(firstPass) > 0:
+        edge_indx = np.searchsorted(edges[:, 0], firstPass[:, 0], side="right") - 1
+        firstPass = edges[edge_indx]
 
     # --- merging neighbours -------
-    minInterArtifactDist = merge * sampling_rate
-    secondPass = []
+    secondPass = mathutil.merge_intervals(firstPass, gap=merge * sampling_rate)
 
-    if len(firstPass) > 0:
-        artifact = firstPass[0]
-        for i in range(1, len(artifact_start)):
-            if firstPass[i, 0] - artifact[1] < minInterArtifactDist:
-                # Merging artifacts
-                artifact = [artifact[0], firstPass[i, 1]]
-            else:
-                secondPass.append(artifact)
-                artifact = firstPass[i]
+    if return_mask:
+        mask_diff = np.zeros(n_frames + 1, dtype="int")
+        np.add.at(mask_diff, secondPass[:, 0].astype("int"), 1)
+        np.add.at(mask_diff, secondPass[:, 1].astype("int"), -1)
+        mask = np.packbits(np.cumsum(mask_diff[:-1]) > 0)
 
-        secondPass.append(artifact)
-
-        artifact_s = np.asarray(secondPass) / sampling_rate  # seconds
+    if len(secondPass) > 0:
+        artifact_s = signal.t_start + secondPass / sampling_rate  # seconds
 
         epochs = pd.DataFrame(
             {"start": artifact_s[:, 0], "stop": artifact_s[:, 1], "label": ""}
@@ -109,12 +169,17 @@ def detect_artifact_epochs(
         metadata = {"threshold": thresh}
 
         art_epochs = Epoch(epochs, metadata)
-        art_epochs.metadata = {"filename": Path(signal.source_file)}
+        if signal.source_file is not None:
+            art_epochs.metadata = {"filename": Path(signal.source_file)}
 
-        return art_epochs
     else:
         print("No artifacts found at this threshold")
-        pass
+        art_epochs = None
+
+    if return_mask:
+        return art_epochs, mask
+    else:
+        return art_epochs
 
 
 if __name__ == "__main__":
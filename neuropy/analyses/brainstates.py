@@ -2,7 +2,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 from scipy.ndimage import gaussian_filter1d
 from sklearn.decomposition import PCA
 from pathlib import Path
@@ -13,6 +13,47 @@ from ..plotting import plot_epochs
 from ..utils import mathutil, signal_process
 
 
+def _emg_channel_pairs(channel_id, probe: core.ProbeGroup = None, min_dist=0):
+    """Channels and pairs of channels used for correlation based emg estimation
+
+    Parameters
+    ----------
+    channel_id : array
+        channel_ids of the signal
+    probe : core.ProbeGroup, optional
+        channel mapping of the signal, if None all pairs are used, by default None
+    min_dist : int, optional
+        if probe is provided, use only channels that are separated by at least this much distance, in um
+
+    Returns
+    -------
+    emg_chans, pairs_bool
+        channel_ids to use and a 2D boolean array of pairs to include
+    """
+    emg_chans = np.asarray(channel_id)
+
+    if probe is None:
+        pairs_bool = np.ones((len(emg_chans), len(emg_chans))).astype("bool")
+    elif isinstance(probe, core.ProbeGroup):
+        # changrp = np.concatenate(probe.get_connected_channels(groupby="probe"))
+        probe_df = probe.to_dataframe()
+        probe_df = probe_df[probe_df.connected == True]
+        probe_df_chans = list(probe_df["channel_id"].values)
+        x, y = probe_df.x.values.astype("float"), probe_df.y.values.astype("float")
+        # --- choosing pairs of channels spaced min_dist --------
+        squared_diff = lambda arr: (arr[:, np.newaxis] - arr[np.newaxis, :]) ** 2
+        distance = np.sqrt(squared_diff(x) + squared_diff(y))
+
+        emg_chans = emg_chans[np.isin(emg_chans, probe_df_chans)]
+        chan_probe_indx = [probe_df_chans.index(chan) for chan in emg_chans]
+        emg_chans_distance = distance[np.ix_(chan_probe_indx, chan_probe_indx)]
+        pairs_bool = emg_chans_distance > min_dist
+    else:
+        raise ValueError("invalid probe input")
+
+    return emg_chans, pairs_bool
+
+
 def emg_from_LFP(
     signal: core.Signal,
     window,
@@ -27,6 +68,8 @@ def emg_from_LFP(
     Method:
     LFP --> bandpass filtered (300-600 Hz) --> Pearson correlation across pairs of channels --> Mean of pearson correlations --> EMG activity
 
+    Each channel is bandpassed only once (in blocks) and windowed correlations are calculated from running sums, so overlapping windows add little cost.
+
     Note: Prior to estimation, it is advised to visualize LFP power spectrum and confirm they don't have sharp peaks from artifacts in 300-600 Hz band. They can drastically affect the EMG estimation.
 
     Parameters
@@ -52,59 +95,35 @@ def emg_from_LFP(
         emg calculated at each time window
     """
     print("starting emg calculation")
-    highfreq = 600
-    lowfreq = 300
     t_start = signal.t_start
     t_stop = signal.t_stop
     sRate = signal.sampling_rate
     emg_chans = signal.channel_id
 
-    if probe is None:
-        pairs_bool = np.ones((len(emg_chans), len(emg_chans))).astype("bool")
-    elif isinstance(probe, core.ProbeGroup):
-        # changrp = np.concatenate(probe.get_connected_channels(groupby="probe"))
-        probe_df = probe.to_dataframe()
-        probe_df = probe_df[probe_df.connected == True]
-        probe_df_chans = list(probe_df["channel_id"].values)
-        x, y = probe_df.x.values.astype("float"), probe_df.y.values.astype("float")
-        # --- choosing pairs of channels spaced min_dist --------
-        squared_diff = lambda arr: (arr[:, np.newaxis] - arr[np.newaxis, :]) ** 2
-        distance = np.sqrt(squared_diff(x) + squared_diff(y))
+    emg_chans, pairs_bool = _emg_channel_pairs(emg_chans, probe, min_dist)
 
-        emg_chans = emg_chans[np.isin(emg_chans, probe_df_chans)]
-        chan_probe_indx = [probe_df_chans.index(chan) for chan in emg_chans]
-        emg_chans_distance = distance[np.ix_(chan_probe_indx, chan_probe_indx)]
-        pairs_bool = emg_chans_distance > min_dist
-    else:
-        raise ValueError("invalid probe input")
-
-    timepoints = np.arange(t_start, t_stop - window, window - overlap)
+    n_windows = len(np.arange(t_start, t_stop - window, window - overlap))
+    n_window = int(window * sRate)
+    hop = int((window - overlap) * sRate)
+    channel_indx = [list(signal.channel_id).index(_) for _ in emg_chans]
 
-    # ---- Mean correlation across all selected channels calculated in parallel --
-    def corrchan(start):
-        lfp_req = np.asarray(
-            signal.time_slice(
-                channel_id=emg_chans, t_start=start, t_stop=start + window
-            ).traces
-        )
-        yf = signal_process.filter_sig.bandpass(
-            lfp_req, lf=lowfreq, hf=highfreq, fs=sRate
+    # ---- Mean correlation across selected channels, groups of consecutive windows calculated in parallel --
+    win_groups = np.array_split(np.arange(n_windows), effective_n_jobs(n_jobs))
+    corr_per_window = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(_emg_corr_windows)(
+            signal.traces,
+            sRate,
+            n_window=n_window,
+            hop=hop,
+            n_windows=len(win_indx),
+            pairs_bool=pairs_bool,
+            first_frame=win_indx[0] * hop,
+            channel_indx=channel_indx,
         )
-
-        # yf1 = signal_process.filter_sig.bandpass(lfp_req, lf=315, hf=485, fs=sRate)
-        # yf2 = signal_process.filter_sig.bandpass(lfp_req, lf=520, hf=600, fs=sRate)
-        # yf = yf1 + yf2
-
-        # yf = signal_process.filter_sig.highpass(lfp_req, cutoff=300, fs=sRate)
-
-        # ltriang = np.tril_indices(n_emg_chans, k=-1)
-        ltriang = np.tril(pairs_bool, k=-1)
-        return np.corrcoef(yf)[ltriang].mean()
-
-    corr_per_window = Parallel(n_jobs=n_jobs, require="sharedmem")(
-        delayed(corrchan)(start) for start in timepoints
+        for win_indx in win_groups
+        if len(win_indx) > 0
     )
-    emg_lfp = np.asarray(corr_per_window)
+    emg_lfp = np.concatenate(corr_per_window)
 
     print("emg calculation done")
 
@@ -117,6 +136,338 @@ def emg_from_LFP(
         return emg_lfp
 
 
+def _emg_corr_windows(
+    traces,
+    fs,
+    n_window,
+    hop,
+    n_windows,
+    pairs_bool,
+    first_frame=0,
+    channel_indx=None,
+    block_dur=60,
+    max_elements=2**24,
+):
+    """Mean pairwise correlation of 300-600 Hz bandpassed traces within strided windows.
+
+    Traces are bandpassed once in blocks (padded by 1 second on either side to avoid edge effects). Each block is divided into bins of gcd(n_window, hop) frames for which sums of x, x**2 and x*y (only for pairs in pairs_bool) are calculated. Window correlations are then calculated from cumulative sums of these bins.
+
+    Parameters
+    ----------
+    traces : 2D array, (n_channels x n_frames)
+        lfp traces, can be a memmap
+    fs : float
+        sampling rate of traces
+    n_window : int
+        number of frames in each window
+    hop : int
+        number of frames between start of adjacent windows
+    n_windows : int
+        number of windows
+    pairs_bool : 2D bool array
+        pairs of channels to be included
+    first_frame : int, optional
+        first frame of the first window, by default 0
+    channel_indx : list, optional
+        rows of traces to use, by default None (all rows)
+    block_dur : float, optional
+        duration of blocks (seconds) which are filtered at once, by default 60 seconds
+    max_elements : int, optional
+        products x*y are calculated for groups of pairs of at most this many elements, by default 2**24
+
+    Returns
+    -------
+    array
+        mean correlation for each window
+    """
+    assert n_window > 0 and hop > 0, "n_window and hop should be positive"
+    if channel_indx is None:
+        channel_indx = np.arange(traces.shape[0])
+    channel_indx = np.asarray(channel_indx)
+    n_chans, n_frames = len(channel_indx), traces.shape[1]
+    ii, jj = np.nonzero(np.tril(pairs_bool, k=-1))
+
+    bin_size = np.gcd(n_window, hop)
+    m, h = n_window // bin_size, hop // bin_size
+    n_bins = (n_windows - 1) * h + m
+    bins_per_block = max(int(block_dur * fs) // bin_size, m)
+    pad = int(fs)
+
+    # bins not yet used by complete windows (less than m + h) plus those of one block
+    corr = np.zeros(n_windows)
+    sums = np.zeros((min(n_bins, bins_per_block + m + h), 2 * n_chans + len(ii)))
+    n_sums, sums_start, next_win = 0, 0, 0
+    pair_chunk = max(1, int(max_elements // (bins_per_block * bin_size)))
+    for bin_start in range(0, n_bins, bins_per_block):
+        bin_stop = min(bin_start + bins_per_block, n_bins)
+        f0, f1 = first_frame + bin_start * bin_size, first_frame + bin_stop * bin_size
+        p0, p1 = max(f0 - pad, 0), min(f1 + pad, n_frames)
+
+        yf = signal_process.filter_sig.bandpass(
+            np.asarray(traces[channel_indx, p0:p1], dtype="float"),
+            lf=300,
+            hf=600,
+            fs=fs,
+        )[:, f0 - p0 : f1 - p0]
+        yf = yf.reshape(n_chans, -1, bin_size).transpose(1, 0, 2)
+        nb = bin_stop - bin_start
+        sums[n_sums : n_sums + nb, :n_chans] = yf.sum(axis=-1)
+        sums[n_sums : n_sums + nb, n_chans : 2 * n_chans] = (yf**2).sum(axis=-1)
+        for q0 in range(0, len(ii), pair_chunk):
+            pairs = slice(q0, q0 + pair_chunk)
+            sums[
+                n_sums : n_sums + nb, 2 * n_chans + q0 : 2 * n_chans + q0 + pair_chunk
+            ] = np.einsum("bit,bit->bi", yf[:, ii[pairs]], yf[:, jj[pairs]])
+        n_sums += nb
+
+        # ---- windows which are complete up to this block -------
+        win_indx = np.arange(next_win, min((bin_stop - m) // h + 1, n_windows))
+        if len(win_indx) > 0:
+            cum_sums = np.vstack(
+                (np.zeros((1, sums.shape[1])), np.cumsum(sums[:n_sums], 0))
+            )
+            win_bin_start = win_indx * h - sums_start
+            win = cum_sums[win_bin_start + m] - cum_sums[win_bin_start]
+            sx, sxx = win[:, :n_chans], win[:, n_chans : 2 * n_chans]
+            var = n_window * sxx - sx**2
+            r = (n_window * win[:, 2 * n_chans :] - sx[:, ii] * sx[:, jj]) / np.sqrt(
+                var[:, ii] * var[:, jj]
+            )
+            corr[win_indx] = r.mean(axis=1)
+            next_win = win_indx[-1] + 1
+
+        n_drop = next_win * h - sums_start
+        sums[: n_sums - n_drop] = sums[n_drop:n_sums]
+        n_sums, sums_start = n_sums - n_drop, sums_start + n_drop
+
+    return corr
+
+
+def _brainstates_features_chunk(
+    traces,
+    fs,
+    frame_offset,
+    n_frames_owned,
+    seg_starts,
+    nperseg,
+    noverlap,
+    sg_chans,
+    emg_starts,
+    emg_n_window,
+    emg_chans,
+    pairs_bool,
+    bands,
+):
+    """Spectral and emg features for one chunk of the recording. Runs in a separate process when called from detect_brainstates_epochs.
+
+    Parameters
+    ----------
+    traces : 2D array (memmap)
+        traces of the chunk (n_channels x n_frames), extended on either side so that windows starting within the chunk are complete and filtering has no edge effects
+    frame_offset: int
+        number of frames in traces preceding the chunk
+    n_frames_owned: int
+        number of frames belonging to this chunk, used for zscoring statistics
+    seg_starts : array
+        first frame of consecutive spectrogram windows, relative to traces
+    sg_chans : list
+        channel indices for which band powers are calculated
+    emg_starts : array
+        first frame of emg windows, relative to traces
+    bands : list of tuples
+        frequency bands for each channel in sg_chans
+
+    Returns
+    -------
+    dict
+        band powers, power summed across frequencies, sums for zscoring and emg
+    """
+    features = dict(sums=[], sqsums=[], band_power=[], spect_sum=[], emg=None)
+    for chan in sg_chans:
+        trace = np.asarray(
+            traces[chan, frame_offset : frame_offset + n_frames_owned], dtype="float"
+        )
+        features["sums"].append(trace.sum())
+        features["sqsums"].append(np.sum(trace**2))
+
+    if len(seg_starts) > 0:
+        seg_frames = slice(seg_starts[0], seg_starts[-1] + nperseg)
+        for chan, chan_bands in zip(sg_chans, bands):
+            f, _, sxx = signal_process.sg.spectrogram(
+                np.asarray(traces[chan, seg_frames], dtype="float"),
+                fs=fs,
+                nperseg=nperseg,
+                noverlap=noverlap,
+            )
+            features["spect_sum"].append(sxx.sum(axis=0))
+            features["band_power"].append(
+                [sxx[(f >= f1) & (f <= f2)].mean(axis=0) for (f1, f2) in chan_bands]
+            )
+
+    if len(emg_starts) > 0:
+        features["emg"] = _emg_corr_windows(
+            traces,
+            fs,
+            n_window=emg_n_window,
+            hop=emg_n_window,
+            n_windows=len(emg_starts),
+            pairs_bool=pairs_bool,
+            first_frame=emg_starts[0],
+            channel_indx=emg_chans,
+        )
+
+    return features
+
+
+def _get_brainstates_features(
+    signal: core.Signal,
+    theta_channel,
+    delta_channel,
+    probe: core.ProbeGroup = None,
+    window=2,
+    overlap=1,
+    emg_window=1,
+    calculate_emg=True,
+    chunk_dur=300,
+    n_jobs=1,
+):
+    """Calculates all features required for sleep scoring in a single chunked pass over the signal. Spectrogram windows and emg windows are assigned to chunks by their first frame, each chunk is processed independently in a process pool. Traces are zscored (as in FourierSg with norm_sig=True) using statistics accumulated across chunks.
+
+    Returns
+    -------
+    dict
+        time, theta (5-10 Hz), bp_2to16, delta (1-4 Hz), summed power of theta and delta channel spectrograms, variance of theta and delta channel traces and emg (if calculated)
+    """
+    fs = signal.sampling_rate
+    n_frames = signal.n_frames
+    channel_id = list(signal.channel_id)
+    theta_indx = channel_id.index(theta_channel)
+    delta_indx = channel_id.index(delta_channel)
+
+    sg_chans = [theta_indx, delta_indx]
+    bands = [[(5, 10), (2, 16)], [(1, 4)]]
+    if delta_indx == theta_indx:
+        sg_chans = [theta_indx]
+        bands = [[(5, 10), (2, 16), (1, 4)]]
+
+    nperseg = int(window * fs)
+    noverlap = int(overlap * fs)
+    hop = nperseg - noverlap
+    n_segs = (n_frames - nperseg) // hop + 1
+    seg_starts = np.arange(n_segs) * hop
+
+    emg_starts, emg_n_window = np.array([], dtype="int"), 0
+    emg_chans, pairs_bool = [], None
+    if calculate_emg:
+        emg_chan_ids, pairs_bool = _emg_channel_pairs(signal.channel_id, probe)
+        emg_chans = [channel_id.index(_) for _ in emg_chan_ids]
+        emg_n_window = int(emg_window * fs)
+        n_emg_windows = len(np.arange(0, signal.duration - emg_window, emg_window))
+        emg_starts = np.arange(n_emg_windows) * emg_n_window
+
+    chunk_frames = max(int(chunk_dur * fs) // hop, 1) * hop
+    chunk_edges = np.append(np.arange(0, n_frames, chunk_frames), n_frames)
+
+    def get_chunk_args(start, stop):
+        chunk_seg_starts = seg_starts[(seg_starts >= start) & (seg_starts < stop)]
+        chunk_emg_starts = emg_starts[(emg_starts >= start) & (emg_starts < stop)]
+        frame_stop = max(
+            [stop]
+            + [chunk_seg_starts[-1] + nperseg] * (len(chunk_seg_starts) > 0)
+            + [chunk_emg_starts[-1] + emg_n_window] * (len(chunk_emg_starts) > 0)
+        )
+        # padding for emg filtering
+        frame_start = max(start - int(fs), 0)
+        frame_stop = min(frame_stop + int(fs), n_frames)
+        return dict(
+            traces=signal.traces[:, frame_start:frame_stop],
+            frame_offset=start - frame_start,
+            n_frames_owned=stop - start,
+            seg_starts=chunk_seg_starts - frame_start,
+            emg_starts=chunk_emg_starts - frame_start,
+        )
+
+    chunks = Parallel(n_jobs=n_jobs)(
+        delayed(_brainstates_features_chunk)(
+            fs=fs,
+            nperseg=nperseg,
+            noverlap=noverlap,
+            sg_chans=sg_chans,
+            emg_n_window=emg_n_window,
+            emg_chans=emg_chans,
+            pairs_bool=pairs_bool,
+            bands=bands,
+            **get_chunk_args(start, stop),
+        )
+        for start, stop in zip(chunk_edges[:-1], chunk_edges[1:])
+    )
+
+    # ---- variance of each channel to mimic zscoring of the traces ------
+    sums = np.sum([c["sums"] for c in chunks], axis=0)
+    sqsums = np.sum([c["sqsums"] for c in chunks], axis=0)
+    var = sqsums / n_frames - (sums / n_frames) ** 2
+
+    concat = lambda key, i: np.concatenate(
+        [c[key][i] for c in chunks if len(c[key]) > 0], axis=-1
+    )
+    band_power = [concat("band_power", i) / var[i, None] for i in range(len(sg_chans))]
+    spect_sum = [concat("spect_sum", i) / var[i] for i in range(len(sg_chans))]
+    band_power = np.vstack(band_power)
+
+    features = dict(
+        time=signal.t_start + (seg_starts + nperseg / 2) / fs,
+        theta=band_power[0],
+        bp_2to16=band_power[1],
+        delta=band_power[2],
+        theta_spect_sum=spect_sum[0],
+        delta_spect_sum=spect_sum[-1],
+        theta_var=var[0],
+        delta_var=var[-1],
+        emg=None,
+    )
+    if calculate_emg:
+        features["emg"] = np.concatenate(
+            [c["emg"] for c in chunks if c["emg"] is not None]
+        )
+
+    return features
+
+
+def _refine_rem_after_wake(states, n_indx):
+    """REM which follows after n_indx bins of wake is changed to Quiet waking. Once a REM bin is relabeled it counts as wake for the bins that follow, so the relabeling carries over to all REM bins until the next NREM (or unlabeled) bin.
+
+    Parameters
+    ----------
+    states : array of str
+        state labels
+    n_indx : int
+        number of preceding bins that should be wake
+
+    Returns
+    -------
+    array of str
+        refined state labels
+    """
+    states = states.copy()
+    n_indx = int(n_indx)
+    indx = np.arange(len(states))
+    rem_bool = states == "REM"
+    wake_bool = np.isin(states, ["AW", "QW", "NOISE"])
+    breaker_bool = ~(rem_bool | wake_bool)
+
+    # rolling count of wake bins within the preceding n_indx bins
+    wake_cumsum = np.concatenate(([0], np.cumsum(wake_bool)))
+    wake_count = np.zeros(len(states), dtype="int")
+    wake_count[n_indx:] = wake_cumsum[n_indx:-1] - wake_cumsum[: -n_indx - 1]
+
+    flagged = rem_bool & (wake_count >= n_indx)
+    last_flag = np.maximum.accumulate(np.where(flagged, indx, -1))
+    last_break = np.maximum.accumulate(np.where(breaker_bool, indx, -1))
+    states[rem_bool & (last_flag > last_break)] = "QW"
+
+    return states
+
+
 def detect_brainstates_epochs(
     signal: core.Signal,
     theta_channel: int,
@@ -130,6 +481,8 @@ def detect_brainstates_epochs(
     threshold_type: typing.Literal["default", "schmitt"] = "default",
     # plot=False,
     fp_bokeh_plot: typing.Union[Path, str] = None,
+    chunk_dur=300,
+    n_jobs=1,
 ):
     """detects sleep states using LFP.
 
@@ -157,39 +510,42 @@ def detect_brainstates_epochs(
         epochs which are ignored during scoring, could be noise epochs, by None
     fp_bokeh_plot: Path to file, optional
         if given then .html file is saved detailing some of scoring parameters and classification, by default None
+    chunk_dur: float, optional
+        signal is processed in chunks of this duration (seconds) to keep memory usage low, by default 300 seconds
+    n_jobs: int, optional
+        number of processes used for calculating spectral features and emg across chunks, by default 1
+    Returns
+    -------
+    core.Epoch
+        brainstates epochs, metadata also contains fitted mixture parameters and trace variances which can be used by OnlineBrainstateClassifier
     """
 
     # freqs = np.geomspace(1, 100, 100)
-    spect_kw = dict(window=window, overlap=overlap, norm_sig=True)
-
     smooth_ = lambda arr: gaussian_filter1d(arr, sigma=sigma / (window - overlap))
     print(f"channel for sleep detection: {theta_channel,delta_channel}")
 
-    # ---- theta-delta ratio calculation -----
-    if theta_channel is not None:
-        theta_signal = signal.time_slice(channel_id=[theta_channel])
-        theta_chan_sg = signal_process.FourierSg(theta_signal, **spect_kw)
-
-    if delta_channel is not None:
-        if delta_channel == theta_channel:
-            delta_chan_sg = theta_chan_sg
-        else:
-            delta_signal = signal.time_slice(channel_id=[delta_channel])
-            delta_chan_sg = signal_process.FourierSg(delta_signal, **spect_kw)
-
-    time = theta_chan_sg.time
+    # ---- spectral features and emg in a single pass over the signal -----
+    features = _get_brainstates_features(
+        signal,
+        theta_channel=theta_channel,
+        delta_channel=delta_channel,
+        probe=probe,
+        window=window,
+        overlap=overlap,
+        calculate_emg=emg_signal is None,
+        chunk_dur=chunk_dur,
+        n_jobs=n_jobs,
+    )
+    time = features["time"]
     dt = window - overlap
 
     print(f"spectral properties calculated")
 
     # ---- emg processing ----
     if emg_signal is None:
-        # emg_kw = dict(window=window, overlap=overlap)
-        emg_kw = dict(window=1, overlap=0.0)
-        emg = emg_from_LFP(signal=signal, probe=probe, **emg_kw)
-        emg = gaussian_filter1d(emg, sigma=20)
+        emg = gaussian_filter1d(features["emg"], sigma=20)
         emg_t = np.linspace(signal.t_start, signal.t_stop, len(emg))
-        emg = np.interp(theta_chan_sg.time, emg_t, emg)
+        emg = np.interp(time, emg_t, emg)
     elif isinstance(emg_signal, core.Signal):
         assert emg_signal.n_channels == 1, "emg_signal should only have one channel"
         emg_trace = emg_signal.traces[0]
@@ -213,19 +569,20 @@ def detect_brainstates_epochs(
                 np.where((time >= st - window) & (time <= en + window))[0]
             ] = True
 
+    get_noisy_spect_bool = lambda x: (stats.zscore(x) >= 5) | (x <= 0)
     noisy_spect_bool = np.logical_or(
-        theta_chan_sg.get_noisy_spect_bool(thresh=5),
-        delta_chan_sg.get_noisy_spect_bool(thresh=5),
+        get_noisy_spect_bool(features["theta_spect_sum"]),
+        get_noisy_spect_bool(features["delta_spect_sum"]),
     )
     noisy_bool = np.logical_or(noisy_bool, noisy_spect_bool)
 
     # ------ features to be used for scoring ---------
-    theta = theta_chan_sg.get_band_power(5, 10)
+    theta = features["theta"]
     theta[~noisy_bool] = smooth_(theta[~noisy_bool])
-    bp_2to16 = theta_chan_sg.get_band_power(2, 16)
+    bp_2to16 = features["bp_2to16"]
     bp_2to16[~noisy_bool] = smooth_(bp_2to16[~noisy_bool])
 
-    delta = delta_chan_sg.get_band_power(1, 4)
+    delta = features["delta"]
     delta[~noisy_bool] = smooth_(delta[~noisy_bool])
 
     theta_dominance = theta / bp_2to16  # buzsaki lab, better for high and low theta
@@ -274,12 +631,7 @@ def detect_brainstates_epochs(
 
     # ---- Refining states --------
     # removing REM which happens within long WAKE. If REM follows after 200s of WAKE, then change them to Quiet waking.
-    for rem_indx in np.where(states == "REM")[0]:
-        n_indx_before = 200 // dt  # 200 seconds window
-        start_indx = np.max([0, rem_indx - n_indx_before])
-        wk_bool = np.isin(states[start_indx:rem_indx], ["AW", "QW", "NOISE"])
-        if wk_bool.sum() >= n_indx_before:
-            states[rem_indx] = "QW"
+    states = _refine_rem_after_wake(states, n_indx=200 // dt)  # 200 seconds window
 
     # --- TODO micro-arousals ---------
     # ma_bool = emg_bool & delta_bool
@@ -290,8 +642,15 @@ def detect_brainstates_epochs(
     metadata = {
         "window": window,
         "overlap": overlap,
+        "sigma": sigma,
         "theta_channel": theta_channel,
         "delta_channel": delta_channel,
+        "theta_var": features["theta_var"],
+        "delta_var": features["delta_var"],
+        "threshold_type": threshold_type,
+        "emg_fit_params": emg_fit_params,
+        "nrem_rem_fit_params": nrem_rem_fit_params,
+        "aw_qw_fit_params": aw_qw_fit_params,
     }
     epochs.metadata = metadata
 
@@ -439,4 +798,254 @@ def detect_brainstates_epochs(
         )
         print(f"{fp_bokeh_plot} saved")
 
-    return epochs
\ No newline at end of file
+    return epochs
+
+
+class OnlineBrainstateClassifier:
+    """Classifies brainstates as LFP blocks arrive, e.g. for closed-loop experiments.
+
+    Fitted mixture parameters are reused from an offline run of detect_brainstates_epochs (stored in metadata of returned epochs), so a recording from the same animal/probe has to be scored offline first. Whenever (window - overlap) seconds of new data are available, spectral features are estimated for the most recent window and emg from the most recent emg_window. Features are smoothed using only past values (half gaussian kernel), so states are emitted within (window - overlap) seconds of data arriving.
+
+    Parameters
+    ----------
+    metadata : dict
+        metadata of epochs returned by detect_brainstates_epochs
+    sampling_rate : float
+        sampling rate of incoming LFP
+    channel_id : array
+        channel_ids of rows in incoming blocks
+    probe : core.ProbeGroup, optional
+        used to select emg channel pairs, should be same as used for offline scoring, by default None
+    emg_window : float, optional
+        window size in seconds for emg estimation, by default 1 second
+    emg_sigma : float, optional
+        smoothing of emg in seconds, by default 20 seconds
+    t_start : float, optional
+        time of the first frame, by default 0
+
+    Examples
+    --------
+    >>> epochs = detect_brainstates_epochs(signal, theta_channel, delta_channel, probe)
+    >>> clf = OnlineBrainstateClassifier(epochs.metadata, 1250, signal.channel_id, probe)
+    >>> blocks = read_growing_file_blocks("session.eeg", n_channels=n_channels)
+    >>> for t, state in clf.run(blocks):
+    ...     print(t, state)
+    """
+
+    def __init__(
+        self,
+        metadata: dict,
+        sampling_rate,
+        channel_id,
+        probe: core.ProbeGroup = None,
+        emg_window=1,
+        emg_sigma=20,
+        t_start=0,
+    ) -> None:
+        for key in ["emg_fit_params", "nrem_rem_fit_params", "aw_qw_fit_params"]:
+            assert key in metadata, f"{key} not found, rerun detect_brainstates_epochs"
+
+        window, overlap = metadata["window"], metadata["overlap"]
+        assert window >= emg_window, "window should be at least emg_window"
+
+        self.metadata = metadata
+        self.sampling_rate = sampling_rate
+        self.t_start = t_start
+        self.dt = window - overlap
+        self.nperseg = int(window * sampling_rate)
+        self.noverlap = int(overlap * sampling_rate)
+        self.emg_n_window = int(emg_window * sampling_rate)
+
+        channel_id = list(channel_id)
+        self.n_channels = len(channel_id)
+        self.theta_indx = channel_id.index(metadata["theta_channel"])
+        self.delta_indx = channel_id.index(metadata["delta_channel"])
+        emg_chans, self.pairs_bool = _emg_channel_pairs(channel_id, probe)
+        self.emg_indx = [channel_id.index(_) for _ in emg_chans]
+
+        # ---- causal smoothing kernels, same width as gaussian_filter1d ------
+        def half_gaussian(sigma):
+            x = np.arange(int(4 * sigma + 0.5) + 1)
+            return np.exp(-0.5 * (x / sigma) ** 2)
+
+        self._kernel = half_gaussian(metadata["sigma"] / self.dt)
+        self._emg_kernel = half_gaussian(emg_sigma / self.dt)
+
+        # ---- thresholds for schmitt trigger classification -------
+        self._thresholds, self._labels = {}, {}
+        for key in ["emg_fit_params", "nrem_rem_fit_params", "aw_qw_fit_params"]:
+            means, covs, weights = [
+                metadata[key][_] for _ in ["means", "covariances", "weights"]
+            ]
+            bins = np.linspace(means[0], means[1], 200)[1:-1]
+            full_fit = np.sum(
+                [
+                    stats.norm.pdf(bins, means[i], np.sqrt(covs[i])) * weights[i]
+                    for i in range(2)
+                ],
+                axis=0,
+            )
+            thresh_val = bins[np.argmin(full_fit)]
+            self._thresholds[key] = (
+                (means[0] + thresh_val) / 2,
+                (means[1] + thresh_val) / 2,
+            )
+            self._labels[key] = 0
+
+        self._buffer = np.zeros((self.n_channels, 0))
+        self._buffer_start = 0  # frame number of first frame in buffer
+        self._n_segs = 0
+        self._features = np.zeros((0, 3))  # theta, bp_2to16, delta of non-noisy windows
+        self._emg = np.zeros(0)
+        self._spect_sum_stats = np.zeros((3, 2))  # count, mean, M2 (Welford)
+        self._n_indx = int(200 // self.dt)
+        self._wake_count = 0
+
+    def _classify(self, key, x):
+        """label (0=low, 1=high) of x using fitted mixture"""
+        if np.isnan(x):
+            return 1
+        params = self.metadata[key]
+        if self.metadata.get("threshold_type", "default") == "schmitt":
+            low_thresh, high_thresh = self._thresholds[key]
+            if x >= high_thresh:
+                self._labels[key] = 1
+            if x <= low_thresh:
+                self._labels[key] = 0
+            return self._labels[key]
+        else:
+            log_prob = np.log(params["weights"]) + stats.norm.logpdf(
+                x, params["means"], np.sqrt(params["covariances"])
+            )
+            return int(np.argmax(log_prob))
+
+    def _is_noisy(self, spect_sum):
+        """spectral power exceeding 5 std of running statistics or zero power, running statistics are used once 10 windows have been seen"""
+        count, mean, m2 = self._spect_sum_stats
+        with np.errstate(divide="ignore", invalid="ignore"):
+            zsc = (spect_sum - mean) / np.sqrt(m2 / count)
+        noisy = np.any(spect_sum <= 0) or (count[0] >= 10 and np.any(zsc >= 5))
+
+        count = count + 1
+        delta = spect_sum - mean
+        mean = mean + delta / count
+        self._spect_sum_stats = np.vstack(
+            (count, mean, m2 + delta * (spect_sum - mean))
+        )
+        return noisy
+
+    def _segment_state(self, traces, emg_traces):
+        """state for a single spectrogram window"""
+        fs = self.sampling_rate
+        spect = []
+        for indx, var in zip(
+            [self.theta_indx, self.delta_indx],
+            [self.metadata["theta_var"], self.metadata["delta_var"]],
+        ):
+            f, _, sxx = signal_process.sg.spectrogram(
+                traces[indx], fs=fs, nperseg=self.nperseg, noverlap=self.noverlap
+            )
+            spect.append(sxx[:, 0] / var)
+        band_power = lambda sxx, f1, f2: sxx[(f >= f1) & (f <= f2)].mean()
+        features = [
+            band_power(spect[0], 5, 10),
+            band_power(spect[0], 2, 16),
+            band_power(spect[1], 1, 4),
+        ]
+
+        emg = _emg_corr_windows(
+            emg_traces,
+            fs,
+            n_window=self.emg_n_window,
+            hop=self.emg_n_window,
+            n_windows=1,
+            pairs_bool=self.pairs_bool,
+            first_frame=emg_traces.shape[1] - self.emg_n_window,
+            channel_indx=self.emg_indx,
+        )
+        self._emg = np.append(self._emg, emg)[-len(self._emg_kernel) :]
+
+        if self._is_noisy(np.array([spect[0].sum(), spect[1].sum()])):
+            state = "NOISE"
+        else:
+            self._features = np.vstack((self._features, features))[-len(self._kernel) :]
+            smooth_ = lambda arr, kernel: np.dot(
+                kernel[: len(arr)], arr[::-1]
+            ) / np.sum(kernel[: len(arr)])
+            theta, bp_2to16, delta = smooth_(self._features, self._kernel)
+            emg = np.log10(smooth_(self._emg, self._emg_kernel))
+
+            if self._classify("emg_fit_params", emg):
+                aw_qw = self._classify("aw_qw_fit_params", theta / bp_2to16)
+                state = "AW" if aw_qw else "QW"
+            else:
+                nrem_rem = self._classify("nrem_rem_fit_params", theta / delta)
+                state = "REM" if nrem_rem else "NREM"
+
+        # ---- REM following 200 seconds of WAKE is changed to Quiet waking -----
+        if (state == "REM") and (self._wake_count >= self._n_indx):
+            state = "QW"
+        self._wake_count = self._wake_count + 1 if state in ["AW", "QW", "NOISE"] else 0
+
+        return state
+
+    def update(self, block):
+        """Adds a block of LFP and classifies every window completed by it
+
+        Parameters
+        ----------
+        block : 2D array (n_channels x n_frames)
+            newly arrived LFP, rows in the order of channel_id. A 1D block is read as raw frame-interleaved samples (as in .dat files and read_socket_blocks)
+
+        Returns
+        -------
+        list of tuples
+            (time, state) for each new window, time is center of the window
+        """
+        block = np.asarray(block, dtype="float")
+        if block.ndim == 1:
+            assert block.size % self.n_channels == 0, "block is not whole frames"
+            block = block.reshape(-1, self.n_channels).T
+        assert block.shape[0] == self.n_channels, "block should have n_channels rows"
+
+        self._buffer = np.hstack((self._buffer, block))
+        hop = self.nperseg - self.noverlap
+        pad = int(self.sampling_rate)  # used for emg filtering
+
+        states = []
+        while True:
+            seg_start = self._n_segs * hop - self._buffer_start
+            seg_stop = seg_start + self.nperseg
+            if seg_stop > self._buffer.shape[1]:
+                break
+            emg_start = max(seg_stop - self.emg_n_window - pad, 0)
+            state = self._segment_state(
+                self._buffer[:, seg_start:seg_stop], self._buffer[:, emg_start:seg_stop]
+            )
+            t = (
+                self.t_start
+                + (self._n_segs * hop + self.nperseg / 2) / self.sampling_rate
+            )
+            states.append((t, state))
+            self._n_segs += 1
+
+        # ---- keep only frames required for upcoming windows -----
+        next_start = self._n_segs * hop
+        keep_from = min(next_start, next_start + self.nperseg - self.emg_n_window - pad)
+        n_drop = min(max(keep_from - self._buffer_start, 0), self._buffer.shape[1])
+        self._buffer = self._buffer[:, n_drop:]
+        self._buffer_start += n_drop
+
+        return states
+
+    def run(self, blocks):
+        """Classifies blocks from an iterable/generator, e.g. read_growing_file_blocks or read_socket_blocks
+
+        Yields
+        ------
+        tuple
+            (time, state) as soon as a window is complete
+        """
+        for block in blocks:
+            for t, state in self.update(block):
+                yield t, state
@@ -1,31 +1,42 @@
-﻿"""Calculate and test millisecond-scale connectivity between neurons a la Diba et al. (2014) and English/McKenzie
- et al. (2017)"""
+"""Calculate and test millisecond-scale connectivity between neurons a la Diba et al. (2014) and English/McKenzie
+et al. (2017)"""
 
 import numpy as np
+from joblib import Parallel, delayed
+from scipy import stats
+from scipy.ndimage import convolve1d
+from ..utils.backend import get_backend
 
-try:
-    import ccg_gpu as ccg
-    import cupy as cp
 
-    cuda = True
-except ModuleNotFoundError:
-    import ccg
+def _hollow_window(window_width, wintype="gauss", hollow_frac=0.6):
+    """Partially hollowed convolution window (Stark and Abeles, 2009), normalized to unit sum"""
+    if wintype == "gauss":
+        sigma = window_width / 2
+        half = int(np.ceil(3 * sigma))
+        x = np.arange(-half, half + 1)
+        win = np.exp(-(x**2) / (2 * sigma**2))
+    elif wintype == "rect":
+        half = int(window_width // 2)
+        win = np.ones(2 * half + 1)
+    elif wintype == "triang":
+        half = int(window_width // 2)
+        win = 1 - np.abs(np.arange(-half, half + 1)) / (half + 1)
 
-    cuda = False
+    win[half] = win[half] * (1 - hollow_frac)
+    return win / win.sum()
 
 
 def eran_conv(ccg, window_width=5, wintype="gauss", hollow_frac=None):
     """Estimate chance-level correlations using convolution method from Stark and Abeles (2009, J. Neuro Methods).
 
-    :param ccg:
-    :param window_width:
-    :param wintype:
-    :param hollow_frac:
-    :return: pvals:
-             pred:
-             qvals:
+    :param ccg: cross-correlogram counts, 1D or (n_pairs x n_bins), convolution is along last axis
+    :param window_width: width of convolution window in bins
+    :param wintype: 'gauss', 'rect' or 'triang'
+    :param hollow_frac: fraction of the window center that is removed, defaults depend on wintype
+    :return: pvals: probability of observing counts this high by chance (excitation), with continuity correction
+             pred: predicted (chance-level) ccg
+             qvals: probability of observing counts this low by chance (inhibition)
     """
-    pvals, pred, qvals = None
     assert wintype in ["gauss", "rect", "triang"]
 
     # Auto-assign appropriate hollow fraction if not specified
@@ -37,101 +48,219 @@ def eran_conv(ccg, window_width=5, wintype="gauss", hollow_frac=None):
         elif wintype == "triang":
             hollow_frac = 0.63
 
+    ccg = np.asarray(ccg, dtype=float)
+    win = _hollow_window(window_width, wintype, hollow_frac)
+    pred = convolve1d(ccg, win, axis=-1, mode="reflect")
+
+    # Poisson tail probabilities with half weight to the observed count
+    pmf = stats.poisson.pmf(ccg, pred)
+    pvals = 1 - stats.poisson.cdf(ccg - 1, pred) - 0.5 * pmf
+    qvals = stats.poisson.cdf(ccg - 1, pred) + 0.5 * pmf
+
     return pvals, pred, qvals
 
 
+def _lag_counts(ref, targets, binsize, halfbins):
+    """Counts of target spikes around each reference spike for each row of targets.
+
+    Parameters
+    ----------
+    ref : 1D array
+        sorted reference spike samples
+    targets : 2D array (n_rows x n_spikes)
+        target spike samples, each row sorted
+    binsize : float
+        bin size in samples
+    halfbins : int
+        number of bins on either side of zero lag
+
+    Returns
+    -------
+    array (n_rows x 2*halfbins+1)
+        ccg of each row, bins are centered at lags -halfbins*binsize ... halfbins*binsize
+    """
+    n_rows = targets.shape[0]
+    if len(ref) == 0 or targets.shape[1] == 0:
+        return np.zeros((n_rows, 2 * halfbins + 1), dtype=np.int64)
+
+    maxlag = (halfbins + 0.5) * binsize
+    t0 = min(ref.min(), targets.min())
+    row_offset = (max(ref.max(), targets.max()) - t0 + 2 * maxlag + 1) * np.arange(
+        n_rows
+    )
+
+    # rows are laid out one after the other, so a single sorted array serves all surrogates
+    keys = (targets - t0 + row_offset[:, None]).ravel()
+    queries = (ref[None, :] - t0 + row_offset[:, None]).ravel()
+    lo = np.searchsorted(keys, queries - maxlag, side="left")
+    hi = np.searchsorted(keys, queries + maxlag, side="left")
+
+    rows = np.repeat(np.arange(n_rows), len(ref))
+    return get_backend().count_window_lags(
+        keys, queries, rows, lo, hi, binsize, halfbins, n_rows
+    )
+
+
+def _jitter_pair(
+    ref, target, binsize, halfbins, jitter, njitter, seed, max_pairs=2**22
+):
+    """Observed ccg and njitter ccgs with target spikes jittered uniformly within +/- jitter samples"""
+    ccg = _lag_counts(ref, target[None, :], binsize, halfbins)[0]
+
+    # surrogates are processed in groups to limit number of lags held in memory
+    rng = np.random.default_rng(seed)
+    n_group = max(1, int(max_pairs // max(len(ref) + ccg.sum(), 1)))
+    ccgj = []
+    for n0 in range(0, njitter, n_group):
+        n = min(n_group, njitter - n0)
+        offsets = rng.integers(-jitter, jitter + 1, size=(n, len(target)))
+        jittered = np.sort(target[None, :] + offsets, axis=1)
+        ccgj.append(_lag_counts(ref, jittered, binsize, halfbins))
+
+    return ccg, np.vstack(ccgj)
+
+
 def ccg_jitter(
     spike_trains,
-    clusters,
+    pairs=None,
     SampleRate=30000,
     binsize=0.0005,
     duration=0.02,
     jscale=5,
     njitter=100,
     alpha=0.05,
+    ms_window=(0.0008, 0.0028),
+    conv_width=0.005,
+    n_jobs=1,
+    seed=None,
 ):
+    """Detects monosynaptic connections between pairs of neurons by comparing their cross-correlograms to jittered surrogates (Diba et al. 2014, English et al. 2017) and to the Stark and Abeles (2009) convolution predictor.
+
+    A connection from neuron i to j is called if, for any bin in ms_window after spikes of i, the ccg exceeds the global (across all lags) 1-alpha band of jittered ccgs and the convolution p-value is below alpha. Negative lags of the same ccg are used for connections from j to i.
+
+    Parameters
+    ----------
+    spike_trains : list of arrays
+        spike times (seconds) of each neuron
+    pairs : array (n_pairs x 2), optional
+        candidate pairs of neuron indices, by default None (all pairs i<j)
+    SampleRate : int, optional
+        sampling rate of spike times, by default 30000
+    binsize : float, optional
+        bin size of ccg in seconds, by default 0.0005
+    duration : float, optional
+        total duration of ccg window in seconds, by default 0.02
+    jscale : float, optional
+        spikes are jittered uniformly within +/- jscale milliseconds, by default 5
+    njitter : int, optional
+        number of jittered surrogates, by default 100
+    alpha : float, optional
+        significance level, by default 0.05
+    ms_window : tuple, optional
+        range of lags (seconds) for monosynaptic connections, by default (0.8, 2.8) ms
+    conv_width : float, optional
+        width (seconds) of the convolution window for Stark and Abeles predictor, by default 0.005
+    n_jobs : int, optional
+        number of processes over which pairs are split, by default 1
+    seed : int, optional
+        seed for jitter, by default None
 
-    # TODO: make this take the same inputs as correlograms? e.g. spikes from both clusters sorted by time with corresponding cluster ids?
-    # # Make spike trains into 1d numpy array
-    # spikes0 = spike_trains[0]
-    # spikes1 = spike_trains[1]
+    Returns
+    -------
+    dict
+        't': lags of ccg bins (seconds),
+        'pairs': candidate pairs,
+        'ccg': observed ccgs (n_pairs x n_bins),
+        'ccg_jitter_mean': mean of jittered ccgs,
+        'global_band': upper and lower global bands (n_pairs x 2),
+        'pvals_jitter': per bin fraction of surrogates at least as high as observed,
+        'pvals_conv', 'pred_conv': Stark and Abeles p-values (excitation) and predictor,
+        'pvals': (n_pairs x 2) minimum convolution p-value within ms_window for i->j and j->i,
+        'connectivity': (n_neurons x n_neurons) boolean matrix, True at [i, j] if i excites j
+    """
+    n_neurons = len(spike_trains)
+    spike_samples = [
+        np.sort(np.round(np.asarray(_, dtype=float) * SampleRate)).astype(np.int64)
+        for _ in spike_trains
+    ]
+    if pairs is None:
+        pairs = np.vstack(np.triu_indices(n_neurons, k=1)).T
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+
+    halfbins = int(np.round(duration / binsize / 2))
+    t = np.arange(-halfbins, halfbins + 1) * binsize
+    binsize_samples = binsize * SampleRate
+    jitter = int(np.round(jscale * 0.001 * SampleRate))
 
-    # set up variables
-    halfbins = (
-        cp.round(duration / binsize / 2) if cuda else np.round(duration / binsize / 2)
+    # ---- observed and jittered ccgs, pairs split across processes ------
+    seeds = np.random.SeedSequence(seed).spawn(len(pairs))
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_jitter_pair)(
+            spike_samples[i],
+            spike_samples[j],
+            binsize_samples,
+            halfbins,
+            jitter,
+            njitter,
+            s,
+        )
+        for (i, j), s in zip(pairs, seeds)
     )
-    one_ms = 0.001
-    spikes_sorted, clus_sorted = ccg_spike_assemble(spike_trains)
-    spikes1 = spikes_sorted[
-        clus_sorted == 1
-    ]  # keep all spike times from cluster 1 for easy manipulation during jitter step
-
-    # run ccg on actual data
-    correlograms = ccg.correlograms(
-        spikes_sorted,
-        clus_sorted,
-        bin_size=binsize,
-        window_size=duration,
-        sample_rate=SampleRate,
+    n_bins = 2 * halfbins + 1
+    ccg = np.array([_[0] for _ in results]).reshape(-1, n_bins)
+    ccgj = np.array([_[1] for _ in results]).reshape(-1, njitter, n_bins)
+
+    # ---- jitter statistics ---------
+    global_band = np.stack(
+        (
+            np.quantile(ccgj.max(axis=2), 1 - alpha, axis=1),
+            np.quantile(ccgj.min(axis=2), alpha, axis=1),
+        ),
+        axis=1,
     )
+    pvals_jitter = (1 + np.sum(ccgj >= ccg[:, None, :], axis=1)) / (njitter + 1)
 
-    # Now run on jittered spike-trains!
-    # TODO: implement this in ALL cupy and compare times...does it matter if the spike jitter code is in numpy? Answer: it does 16ms with numpy vs 1 with cupy.
-    nspikes1 = len(spikes1)
-    ccgj = []
-    for n in range(njitter):
-
-        # Jitter spikes in second cluster
-        if cuda:
-            spike_trains[1] = (
-                cp.round(
-                    (
-                        spikes1
-                        + 2 * (one_ms * jscale) * cp.random.rand(nspikes1)
-                        - 1 * one_ms * jscale
-                    )
-                    * SampleRate
-                )
-                / SampleRate
-            )
-        else:
-            spike_trains[1] = (
-                np.round(
-                    (
-                        spikes1
-                        + 2 * (one_ms * jscale) * np.random.rand(nspikes1)
-                        - 1 * one_ms * jscale
-                    )
-                    * SampleRate
-                )
-                / SampleRate
-            )
-
-        # NRK TODO: start debugging here!
-        spikes_sorted, clus_sorted = ccg_spike_assemble(spike_trains)
-
-        # re-run ccg
-        ccgj.append(
-            ccg.correlograms(
-                spikes_sorted,
-                clus_sorted,
-                bin_size=binsize,
-                window_size=duration,
-                sample_rate=SampleRate,
-            )
-        )
+    # ---- convolution predictor ---------
+    pvals_conv, pred_conv, _ = eran_conv(
+        ccg, window_width=conv_width / binsize, wintype="gauss"
+    )
+
+    # ---- connections in either direction --------
+    in_window = (np.abs(t) >= ms_window[0] - 1e-9) & (np.abs(t) <= ms_window[1] + 1e-9)
+    pvals, conn = np.ones((len(pairs), 2)), np.zeros((len(pairs), 2), dtype=bool)
+    for d, direction in enumerate([t > 0, t < 0]):
+        bins = in_window & direction
+        if not bins.any():
+            continue
+        sig = (ccg[:, bins] > global_band[:, [0]]) & (pvals_conv[:, bins] < alpha)
+        conn[:, d] = sig.any(axis=1)
+        pvals[:, d] = pvals_conv[:, bins].min(axis=1)
+
+    connectivity = np.zeros((n_neurons, n_neurons), dtype=bool)
+    connectivity[pairs[:, 0], pairs[:, 1]] |= conn[:, 0]
+    connectivity[pairs[:, 1], pairs[:, 0]] |= conn[:, 1]
+
+    return dict(
+        t=t,
+        pairs=pairs,
+        ccg=ccg,
+        ccg_jitter_mean=ccgj.mean(axis=1),
+        global_band=global_band,
+        pvals_jitter=pvals_jitter,
+        pvals_conv=pvals_conv,
+        pred_conv=pred_conv,
+        pvals=pvals,
+        connectivity=connectivity,
+    )
 
 
 def ccg_spike_assemble(spike_trains):
-    """Assemble an array of sorted spike times and cluIDs for the input cluster ids the list clus_use """
+    """Assemble an array of sorted spike times and cluIDs for the input cluster ids the list clus_use"""
     spikes_all, clus_all = [], []
     for ids, spike_train in enumerate(spike_trains):
         spikes_all.append(spike_train),
         clus_all.append(np.ones_like(spike_train) * ids)
-    if cuda:
-        spikes_all, clus_all = cp.concatenate(spikes_all), cp.concatenate(clus_all)
-    else:
-        spikes_all, clus_all = np.concatenate(spikes_all), np.concatenate(clus_all)
+    spikes_all, clus_all = np.concatenate(spikes_all), np.concatenate(clus_all)
     spikes_sorted = spikes_all[spikes_all.argsort()]
     clus_sorted = clus_all[spikes_all.argsort()]
 
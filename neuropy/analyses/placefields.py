@@ -4,11 +4,14 @@ import ipywidgets as widgets
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 from matplotlib.gridspec import GridSpec
 from scipy.ndimage import gaussian_filter, gaussian_filter1d
 
 from .. import core
 from ..utils.signal_process import ThetaParams
+from ..utils import mathutil
+from ..utils.backend import get_backend
 from .. import plotting
 
 
@@ -59,53 +62,51 @@ class Pf1D(core.Ratemap):
 
         xbin = np.arange(np.min(x), np.max(x) + grid_bin, grid_bin)
 
+        # all spikes packed into a single array, so they are restricted, interpolated and binned at once
+        spiketimes, neuron_indx = neurons.get_packed_spikes()
+
         if epochs is not None:
             assert isinstance(epochs, core.Epoch), "epochs should be core.Epoch object"
+            epochs_df = epochs.to_dataframe().sort_values(by="start")
+            starts, stops = epochs_df.start.values, epochs_df.stop.values
 
-            spiketrains = [
-                np.concatenate(
-                    [
-                        spktrn[(spktrn >= epc.start) & (spktrn <= epc.stop)]
-                        for epc in epochs.to_dataframe().itertuples()
-                    ]
-                )
-                for spktrn in neurons.spiketrains
-            ]
+            def within_epochs(arr):
+                epoch_indx = np.searchsorted(starts, arr, side="right") - 1
+                return (epoch_indx >= 0) & (arr <= stops[np.maximum(epoch_indx, 0)])
+
+            spk_indx = within_epochs(spiketimes)
             # changing x, speed, time to only run epochs so occupancy map is consistent
-            indx = np.concatenate(
-                [
-                    np.where((t >= epc.start) & (t <= epc.stop))[0]
-                    for epc in epochs.to_dataframe().itertuples()
-                ]
-            )
+            indx = np.where(within_epochs(t))[0]
 
             speed_thresh = None
             print("Note: speed_thresh is ignored when epochs is provided")
         else:
-            spiketrains = neurons.time_slice(t_start, t_stop).spiketrains
+            spk_indx = (spiketimes >= t_start) & (spiketimes <= t_stop)
             indx = np.where(speed >= speed_thresh)[0]
+        spiketimes, neuron_indx = spiketimes[spk_indx], neuron_indx[spk_indx]
 
         # to avoid interpolation error, speed and position estimation for spiketrains should use time and speed of entire position (not only on threshold crossing time points)
         x_thresh = x[indx]
 
-        spk_pos, spk_t, spkcounts = [], [], []
-        for spktrn in spiketrains:
-            spk_spd = np.interp(spktrn, t, speed)
-            spk_x = np.interp(spktrn, t, x)
-            if speed_thresh is not None:
-                indices = np.where(spk_spd >= speed_thresh)[0]
-                spk_x = spk_x[indices]
-                spktrn = spktrn[indices]
-
-            spk_pos.append(spk_x)
-            spk_t.append(spktrn)
-            spkcounts.append(np.histogram(spk_x, bins=xbin)[0])
+        spk_x = np.interp(spiketimes, t, x)
+        if speed_thresh is not None:
+            spk_spd = np.interp(spiketimes, t, speed)
+            indices = spk_spd >= speed_thresh
+            spiketimes, spk_x = spiketimes[indices], spk_x[indices]
+            neuron_indx = neuron_indx[indices]
 
-        spkcounts = smooth_(np.asarray(spkcounts))
+        spkcounts = get_backend().bin_counts(spk_x, neuron_indx, xbin, len(neuron_ids))
+        spkcounts = smooth_(spkcounts.astype("float"))
         occupancy = np.histogram(x_thresh, bins=xbin)[0] / position_srate + 1e-16
         occupancy = smooth_(occupancy)
         tuning_curve = spkcounts / occupancy.reshape(1, -1)
 
+        # spikes of each neuron in order of time
+        order = np.argsort(neuron_indx, kind="stable")
+        split_indx = np.cumsum(np.bincount(neuron_indx, minlength=len(neuron_ids)))
+        spk_t = np.split(spiketimes[order], split_indx[:-1])
+        spk_pos = np.split(spk_x[order], split_indx[:-1])
+
         # ---- neurons with peak firing rate above thresh ------
         frate_thresh_indx = np.where(np.max(tuning_curve, axis=1) >= frate_thresh)[0]
         tuning_curve = tuning_curve[frate_thresh_indx, :]
@@ -122,22 +123,65 @@ class Pf1D(core.Ratemap):
         self.frate_thresh = frate_thresh
         self.speed_thresh = speed_thresh
 
-    def estimate_theta_phases(self, signal: core.Signal):
-        """Calculates phase of spikes computed for placefields
+    def estimate_theta_phases(self, signal: core.Signal, method="hilbert"):
+        """Calculates phase of spikes computed for placefields, phases of all spikes are interpolated at once
+
         Parameters
         ----------
-        theta_chan : int
-            lfp channel to use for calculating theta phases
+        signal : core.Signal
+            single channel lfp used for calculating theta phases
+        method : str, optional
+            method used by ThetaParams, 'hilbert' or 'waveshape', by default 'hilbert'
         """
         assert signal.n_channels == 1, "signal should have only a single trace"
         sig_t = signal.time
-        thetaparam = ThetaParams(signal.traces, fs=signal.sampling_rate)
+        thetaparam = ThetaParams(
+            signal.traces[0], fs=signal.sampling_rate, method=method
+        )
+
+        # unwrapped so that interpolation between samples across 360 -> 0 is correct
+        angle = np.unwrap(thetaparam.angle, period=360)
+        spiketimes = np.concatenate(self.ratemap_spiketrains)
+        phase = np.mod(np.interp(spiketimes, sig_t, angle), 360)
+        split_indx = np.cumsum([len(_) for _ in self.ratemap_spiketrains])[:-1]
+
+        self.ratemap_spiketrains_phases = np.split(phase, split_indx)
 
-        phase = []
-        for spiketrain in self.ratemap_spkitrains:
-            phase.append(np.interp(spiketrain, sig_t, thetaparam.angle))
+    def phase_precession(self, slope_bounds=(-0.05, 0.05), n_slopes=1001):
+        """Circular-linear regression of theta phase on position for spikes of all neurons at once (Kempter et al. 2012), requires estimate_theta_phases
 
-        self.ratemap_spiketrains_phases = phase
+        Parameters
+        ----------
+        slope_bounds : tuple, optional
+            range of slopes in cycles per cm, by default (-0.05, 0.05)
+        n_slopes : int, optional
+            number of slopes tested, by default 1001
+
+        Returns
+        -------
+        pd.DataFrame
+            slope (degrees/cm), phase_offset (degrees), rho (circular-linear correlation) and pval for each neuron
+        """
+        assert hasattr(self, "ratemap_spiketrains_phases"), "run estimate_theta_phases"
+        n_spikes = [len(_) for _ in self.ratemap_spiketrains_pos]
+        slope, phase_offset, rho, pval = mathutil.circular_linear_regression(
+            np.deg2rad(np.concatenate(self.ratemap_spiketrains_phases)),
+            np.concatenate(self.ratemap_spiketrains_pos),
+            groups=np.repeat(np.arange(len(n_spikes)), n_spikes),
+            n_groups=len(n_spikes),
+            slope_bounds=slope_bounds,
+            n_slopes=n_slopes,
+        )
+
+        return pd.DataFrame(
+            {
+                "neuron_id": self.neuron_ids,
+                "slope": slope * 360,
+                "phase_offset": np.mod(np.rad2deg(phase_offset), 360),
+                "rho": rho,
+                "pval": pval,
+            }
+        )
 
     def plot_with_phase(
         self, ax=None, normalize=True, stack=True, cmap="tab20b", subplots=(5, 8)
@@ -215,6 +259,201 @@ class Pf1D(core.Ratemap):
         return plotting.plot_raw_ratemaps()
 
 
+class LapRatemaps(core.DataWriter):
+    def __init__(
+        self,
+        neurons: core.Neurons,
+        position: core.Position,
+        laps: core.Epoch,
+        direction=None,
+        speed_thresh=None,
+        grid_bin=5,
+        sigma=1,
+    ):
+        """Lap by lap 1D ratemaps of all neurons computed in one pass, (n_laps x n_neurons x n_bins) tensor.
+
+        Parameters
+        ----------
+        neurons : core.Neurons
+            neurons obj containing spiketrains
+        position : core.Position
+            1D position
+        laps : core.Epoch
+            lap epochs, e.g. from position_util.run_direction, labels are used for direction splits
+        direction : str, optional
+            only use laps with this label, e.g. 'up' or 'down', by default None (all laps)
+        speed_thresh : float, optional
+            additional speed threshold within laps, by default None
+        grid_bin : int
+            bin size of position binning, by default 5 cm
+        sigma : float
+            standard deviation for smoothing occupancy and spikecounts in each position bin, in units of cm, default 1 cm
+
+        Attributes
+        ----------
+        spike_counts : (n_laps x n_neurons x n_bins)
+            smoothed spike counts
+        occupancy : (n_laps x n_bins)
+            smoothed occupancy in seconds
+        tuning_curves : (n_laps x n_neurons x n_bins)
+            firing rates, nan at bins not visited during a lap
+        """
+        super().__init__()
+        assert position.ndim == 1, "Only 1 dimensional position are acceptable"
+        assert isinstance(laps, core.Epoch), "laps should be core.Epoch object"
+
+        laps_df = laps.to_dataframe().sort_values(by="start").reset_index(drop=True)
+        if direction is not None:
+            laps_df = laps_df[laps_df.label == direction].reset_index(drop=True)
+        assert len(laps_df) > 0, "no laps found"
+        starts, stops = laps_df.start.values, laps_df.stop.values
+
+        x, t, speed = position.x, position.time, position.speed
+        xbin = np.arange(np.min(x), np.max(x) + grid_bin, grid_bin)
+        n_laps, n_neurons, n_bins = len(laps_df), neurons.n_neurons, len(xbin) - 1
+        smooth_ = lambda f: gaussian_filter1d(f, sigma / grid_bin, axis=-1)
+        bin_indx = lambda arr: np.clip(
+            np.searchsorted(xbin, arr, side="right") - 1, 0, n_bins - 1
+        )
+
+        def lap_indx(arr):
+            indx = np.searchsorted(starts, arr, side="right") - 1
+            valid = (indx >= 0) & (arr <= stops[np.maximum(indx, 0)])
+            return indx, valid
+
+        # ---- occupancy of each lap -------
+        frame_lap, valid = lap_indx(t)
+        if speed_thresh is not None:
+            valid &= speed >= speed_thresh
+        occupancy = (
+            np.bincount(
+                frame_lap[valid] * n_bins + bin_indx(x[valid]),
+                minlength=n_laps * n_bins,
+            ).reshape(n_laps, n_bins)
+            / position.sampling_rate
+        )
+
+        # ---- spike counts of all neurons in all laps ------
+        spiketimes, neuron_indx = neurons.get_packed_spikes()
+        spk_lap, valid = lap_indx(spiketimes)
+        spiketimes, spk_lap, neuron_indx = (
+            spiketimes[valid],
+            spk_lap[valid],
+            neuron_indx[valid],
+        )
+        if speed_thresh is not None:
+            spd_indx = np.interp(spiketimes, t, speed) >= speed_thresh
+            spiketimes, spk_lap = spiketimes[spd_indx], spk_lap[spd_indx]
+            neuron_indx = neuron_indx[spd_indx]
+        spk_bins = bin_indx(np.interp(spiketimes, t, x))
+        spike_counts = np.bincount(
+            (spk_lap * n_neurons + neuron_indx) * n_bins + spk_bins,
+            minlength=n_laps * n_neurons * n_bins,
+        ).reshape(n_laps, n_neurons, n_bins)
+
+        self.spike_counts = smooth_(spike_counts.astype("float"))
+        self.occupancy = smooth_(occupancy)
+        self.laps = laps_df
+        self.coords = xbin[:-1]
+        self.x_binsize = grid_bin
+        self.neuron_ids = neurons.neuron_ids
+        self.unvisited = occupancy == 0
+
+    @property
+    def n_laps(self):
+        return self.spike_counts.shape[0]
+
+    @property
+    def tuning_curves(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tuning = self.spike_counts / self.occupancy[:, np.newaxis, :]
+        tuning[np.broadcast_to(self.unvisited[:, np.newaxis, :], tuning.shape)] = np.nan
+        return tuning
+
+    def _lap_indices(self, laps=None):
+        if laps is None:
+            return np.arange(self.n_laps)
+        laps = np.asarray(laps)
+        return np.where(laps)[0] if laps.dtype == bool else laps
+
+    def get_ratemap(self, laps=None):
+        """Occupancy weighted ratemap combining laps, e.g. for training a decoder while leaving out test laps
+
+        Parameters
+        ----------
+        laps : array of int or bool, optional
+            laps to combine, by default None (all laps)
+
+        Returns
+        -------
+        core.Ratemap
+        """
+        indx = self._lap_indices(laps)
+        occupancy = self.occupancy[indx].sum(axis=0) + 1e-16
+        tuning_curves = self.spike_counts[indx].sum(axis=0) / occupancy
+        return core.Ratemap(
+            tuning_curves=tuning_curves,
+            coords=self.coords,
+            occupancy=occupancy,
+            neuron_ids=self.neuron_ids,
+        )
+
+    def get_direction(self, label):
+        """indices of laps with this label (direction)"""
+        return np.where(self.laps.label.values == label)[0]
+
+    def lap_correlation(self, reference_laps=None):
+        """Correlation of each neuron's lap ratemap with its ratemap combined over reference laps, for estimating drift/remapping across laps.
+
+        Parameters
+        ----------
+        reference_laps : array of int or bool, optional
+            laps used for reference ratemap, by default None (all laps)
+
+        Returns
+        -------
+        array (n_laps x n_neurons)
+            nan for laps where a neuron did not fire or bins were not visited
+        """
+        reference = self.get_ratemap(reference_laps).tuning_curves[np.newaxis]
+        tuning = self.tuning_curves
+        valid = ~np.isnan(tuning)
+
+        n = valid.sum(axis=-1)
+        a = np.where(valid, tuning, 0)
+        b = np.where(valid, reference, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a = np.where(valid, a - a.sum(axis=-1, keepdims=True) / n[..., None], 0)
+            b = np.where(valid, b - b.sum(axis=-1, keepdims=True) / n[..., None], 0)
+            return np.sum(a * b, axis=-1) / np.sqrt(
+                np.sum(a**2, axis=-1) * np.sum(b**2, axis=-1)
+            )
+
+    def population_vector_correlation(self):
+        """Correlation between population vectors (neurons x position bins visited in both laps) of every pair of laps
+
+        Returns
+        -------
+        array (n_laps x n_laps)
+        """
+        tuning = np.nan_to_num(self.tuning_curves)  # unvisited bins are zero
+        visited = (~self.unvisited).astype("float")
+        n_neurons = tuning.shape[1]
+
+        # sums over neurons and bins visited in both laps of each pair of laps
+        col_sum, col_sqsum = tuning.sum(axis=1), (tuning**2).sum(axis=1)
+        n = n_neurons * (visited @ visited.T)
+        sum_a, sum_b = col_sum @ visited.T, visited @ col_sum.T
+        sqsum_a, sqsum_b = col_sqsum @ visited.T, visited @ col_sqsum.T
+        tuning = tuning.reshape(self.n_laps, -1)
+        sum_ab = tuning @ tuning.T
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (sum_ab - sum_a * sum_b / n) / np.sqrt(
+                (sqsum_a - sum_a**2 / n) * (sqsum_b - sum_b**2 / n)
+            )
+
+
 class Pf2D:
     def __init__(
         self,
@@ -246,9 +485,8 @@ class Pf2D:
             f, sigma / grid_bin, axis=-1
         )  # divide by grid_bin to account for discrete spacing
 
-        spikes = neurons.time_slice(*period).spiketrains
         cell_ids = neurons.neuron_ids
-        nCells = len(spikes)
+        nCells = neurons.n_neurons
 
         # ----- Position---------
         xcoord = position.x
@@ -279,55 +517,54 @@ class Pf2D:
         y_thresh = y[running]
         t_thresh = t[running]
 
-        def make_pfs(
-            t_, x_, y_, spkAll_, occupancy_, speed_thresh_, maze_, x_grid_, y_grid_
-        ):
-            maps, spk_pos, spk_t = [], [], []
-            for cell in spkAll_:
-                # assemble spikes and position data
-                spk_maze = cell[np.where((cell > maze_[0]) & (cell < maze_[1]))]
-                spk_speed = np.interp(spk_maze, t_[1:], speed)
-                spk_y = np.interp(spk_maze, t_, y_)
-                spk_x = np.interp(spk_maze, t_, x_)
-
-                # speed threshold
-                spd_ind = np.where(spk_speed > speed_thresh_)
-                # spk_spd = spk_speed[spd_ind]
-                spk_x = spk_x[spd_ind]
-                spk_y = spk_y[spd_ind]
-
-                # Calculate maps
-                spk_map = np.histogram2d(spk_x, spk_y, bins=(x_grid_, y_grid_))[0]
-                spk_map = smooth_(spk_map)
-                maps.append(spk_map / occupancy_)
-
-                spk_t.append(spk_maze[spd_ind])
-                spk_pos.append([spk_x, spk_y])
-
-            return maps, spk_pos, spk_t
-
         # --- occupancy map calculation -----------
         # NRK todo: might need to normalize occupancy so sum adds up to 1
         occupancy = np.histogram2d(x_thresh, y_thresh, bins=(x_grid, y_grid))[0]
         occupancy = occupancy / trackingRate + 10e-16  # converting to seconds
         occupancy = smooth_(occupancy)
 
-        maps, spk_pos, spk_t = make_pfs(
-            t, x, y, spikes, occupancy, speed_thresh, period, x_grid, y_grid
+        # ---- all spikes interpolated and binned at once --------
+        spiketimes, neuron_indx = neurons.get_packed_spikes()
+        spk_indx = (spiketimes > period[0]) & (spiketimes < period[1])
+        spiketimes, neuron_indx = spiketimes[spk_indx], neuron_indx[spk_indx]
+        spk_speed = np.interp(spiketimes, t[1:], speed)
+        spd_ind = spk_speed > speed_thresh
+        spiketimes, neuron_indx = spiketimes[spd_ind], neuron_indx[spd_ind]
+        spk_x = np.interp(spiketimes, t, x)
+        spk_y = np.interp(spiketimes, t, y)
+
+        # bin index along each axis, same as histogram2d (last bin includes right edge)
+        n_x, n_y = len(x_grid) - 1, len(y_grid) - 1
+        bin_indx = lambda arr, grid: np.minimum(
+            np.searchsorted(grid, arr, side="right") - 1, len(grid) - 2
         )
+        x_indx, y_indx = bin_indx(spk_x, x_grid), bin_indx(spk_y, y_grid)
+        valid = (x_indx >= 0) & (y_indx >= 0) & (spk_x <= x_grid[-1])
+        valid &= spk_y <= y_grid[-1]
+        spk_maps = np.bincount(
+            (neuron_indx[valid] * n_x + x_indx[valid]) * n_y + y_indx[valid],
+            minlength=nCells * n_x * n_y,
+        ).reshape(nCells, n_x, n_y)
+        maps = smooth_(spk_maps.astype("float")) / occupancy[np.newaxis]
+
+        order = np.argsort(neuron_indx, kind="stable")
+        split_indx = np.cumsum(np.bincount(neuron_indx, minlength=nCells))[:-1]
+        spk_t = np.split(spiketimes[order], split_indx)
+        spk_pos = [
+            [_x, _y]
+            for _x, _y in zip(
+                np.split(spk_x[order], split_indx), np.split(spk_y[order], split_indx)
+            )
+        ]
 
         # ---- cells with peak frate abouve thresh ------
-        good_cells_indx = [
-            cell_indx
-            for cell_indx in range(nCells)
-            if np.max(maps[cell_indx]) > frate_thresh
-        ]
+        good_cells_indx = np.where(maps.max(axis=(1, 2)) > frate_thresh)[0]
 
         get_elem = lambda list_: [list_[_] for _ in good_cells_indx]
 
         self.spk_pos = get_elem(spk_pos)
         self.spk_t = get_elem(spk_t)
-        self.ratemaps = get_elem(maps)
+        self.ratemaps = list(maps[good_cells_indx])
         self.cell_ids = cell_ids[good_cells_indx]
         self.occupancy = occupancy
         self.speed = speed
@@ -0,0 +1,238 @@
+"""Spatial information, sparsity and stability of 1D place fields with significance from circularly shifted spikes.
+
+Each spike is assigned to a position frame once. A shuffle circularly shifts the frames of a unit's spikes along the (concatenated) frames used for occupancy, so shuffled ratemaps for all units and many shuffles are obtained by indexing precomputed position-bin indices and a single bincount.
+"""
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.ndimage import gaussian_filter1d
+
+from .. import core
+
+
+def spatial_information(tuning_curves, occupancy):
+    """Skaggs spatial information (bits/spike) of each tuning curve
+
+    Parameters
+    ----------
+    tuning_curves : array (..., n_bins)
+        firing rates in each position bin
+    occupancy : array (n_bins,)
+        time spent in each position bin
+
+    Returns
+    -------
+    array (...)
+        spatial information in bits/spike
+    """
+    p_occ = occupancy / np.sum(occupancy)
+    mean_rate = np.sum(tuning_curves * p_occ, axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = tuning_curves / mean_rate
+        info = p_occ * ratio * np.log2(ratio)
+    return np.nansum(info, axis=-1)
+
+
+def sparsity(tuning_curves, occupancy):
+    """Sparsity of each tuning curve (Skaggs et al. 1996), values close to 0 indicate compact place fields
+
+    Parameters
+    ----------
+    tuning_curves : array (..., n_bins)
+        firing rates in each position bin
+    occupancy : array (n_bins,)
+        time spent in each position bin
+
+    Returns
+    -------
+    array (...)
+    """
+    p_occ = occupancy / np.sum(occupancy)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sum(tuning_curves * p_occ, axis=-1) ** 2 / np.sum(
+            tuning_curves**2 * p_occ, axis=-1
+        )
+
+
+def _rowwise_corr(a, b):
+    """Pearson correlation between corresponding rows of a and b"""
+    a = a - a.mean(axis=-1, keepdims=True)
+    b = b - b.mean(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sum(a * b, axis=-1) / np.sqrt(
+            np.sum(a**2, axis=-1) * np.sum(b**2, axis=-1)
+        )
+
+
+def _shuffled_information(
+    spk_frames,
+    neuron_indx,
+    frame_bins,
+    occupancy,
+    n_neurons,
+    n_bins,
+    n_shuffles,
+    min_shift,
+    smooth,
+    seed,
+    max_elements=2**24,
+):
+    """Spatial information of n_shuffles circularly shifted ratemaps for all neurons (n_shuffles x n_neurons)"""
+    rng = np.random.default_rng(seed)
+    n_frames = len(frame_bins)
+    n_group = max(1, int(max_elements // max(len(spk_frames), 1)))
+
+    info = []
+    for s0 in range(0, n_shuffles, n_group):
+        n = min(n_group, n_shuffles - s0)
+        # each neuron is shifted independently in each shuffle
+        shifts = rng.integers(min_shift, n_frames - min_shift, size=(n, n_neurons))
+        shifted = (spk_frames[None, :] + shifts[:, neuron_indx]) % n_frames
+        rows = np.arange(n)[:, None] * n_neurons + neuron_indx[None, :]
+        counts = np.bincount(
+            (rows * n_bins + frame_bins[shifted]).ravel(),
+            minlength=n * n_neurons * n_bins,
+        ).reshape(n, n_neurons, n_bins)
+        info.append(spatial_information(smooth(counts) / occupancy, occupancy))
+
+    return np.concatenate(info, axis=0)
+
+
+def ratemap_metrics(
+    neurons: core.Neurons,
+    position: core.Position,
+    epochs: core.Epoch = None,
+    speed_thresh=3,
+    grid_bin=5,
+    sigma=1,
+    n_shuffles=1000,
+    min_shift=20,
+    block_dur=60,
+    n_jobs=1,
+    seed=None,
+    block_shuffles=50,
+):
+    """Spatial information, sparsity and stability of 1D place fields with shuffle based p-values for spatial information.
+
+    Position frames are selected as in Pf1D (speed above speed_thresh or within epochs). Each spike is assigned to the position frame preceding it and only spikes within selected frames are used. Shuffles circularly shift spikes of each neuron along the selected frames.
+
+    Parameters
+    ----------
+    neurons : core.Neurons
+        neurons obj containing spiketrains
+    position : core.Position
+        1D position
+    epochs : core.Epoch, optional
+        restrict calculation to these epochs, speed_thresh is ignored if provided, by default None
+    speed_thresh : float, optional
+        speed threshold in cm/s, by default 3
+    grid_bin : float, optional
+        bin size of position binning, by default 5 cm
+    sigma : float, optional
+        standard deviation for smoothing occupancy and spikecounts, in cm, by default 1
+    n_shuffles : int, optional
+        number of shuffles, by default 1000
+    min_shift : float, optional
+        minimum circular shift in seconds, by default 20
+    block_dur : float, optional
+        duration (seconds) of alternating blocks used for odd/even stability, by default 60
+    n_jobs : int, optional
+        number of processes over which blocks of shuffles are split, by default 1
+    seed : int, optional
+        seed for shuffles, by default None
+    block_shuffles : int, optional
+        number of shuffles in each block handed to a process, by default 50
+
+    Returns
+    -------
+    pd.DataFrame
+        for each neuron: spatial_info (bits/spike), sparsity, stability_odd_even and stability_halves (correlation between ratemaps), spatial_info_pval
+    """
+    assert position.ndim == 1, "Only 1 dimensional position are acceptable"
+    x, t, speed = position.x, position.time, position.speed
+    srate = position.sampling_rate
+
+    if epochs is not None:
+        assert isinstance(epochs, core.Epoch), "epochs should be core.Epoch object"
+        epochs_df = epochs.to_dataframe().sort_values(by="start")
+        epoch_indx = np.searchsorted(epochs_df.start.values, t, side="right") - 1
+        frames = np.where(
+            (epoch_indx >= 0) & (t <= epochs_df.stop.values[np.maximum(epoch_indx, 0)])
+        )[0]
+    else:
+        frames = np.where(speed >= speed_thresh)[0]
+
+    xbin = np.arange(np.min(x), np.max(x) + grid_bin, grid_bin)
+    n_bins, n_neurons = len(xbin) - 1, neurons.n_neurons
+    frame_bins = np.clip(
+        np.searchsorted(xbin, x[frames], side="right") - 1, 0, n_bins - 1
+    )
+    smooth = lambda f: gaussian_filter1d(f.astype("float"), sigma / grid_bin, axis=-1)
+
+    # ---- spikes assigned to selected frames ---------
+    spiketimes, neuron_indx = neurons.get_packed_spikes()
+    spk_position_frame = np.searchsorted(t, spiketimes, side="right") - 1
+    spk_frames = np.minimum(
+        np.searchsorted(frames, spk_position_frame), len(frames) - 1
+    )
+    valid = frames[spk_frames] == spk_position_frame
+    spk_frames, neuron_indx = spk_frames[valid], neuron_indx[valid]
+
+    def tuning(frame_mask):
+        """ratemaps from selected frames only"""
+        occ = smooth(np.bincount(frame_bins[frame_mask], minlength=n_bins) / srate)
+        occ = occ + 1e-16
+        spk_mask = frame_mask[spk_frames]
+        counts = np.bincount(
+            neuron_indx[spk_mask] * n_bins + frame_bins[spk_frames[spk_mask]],
+            minlength=n_neurons * n_bins,
+        ).reshape(n_neurons, n_bins)
+        return smooth(counts) / occ, occ
+
+    all_frames = np.ones(len(frames), dtype=bool)
+    tuning_curves, occupancy = tuning(all_frames)
+    info = spatial_information(tuning_curves, occupancy)
+
+    # ---- stability ---------
+    odd_blocks = ((t[frames] - t[frames[0]]) // block_dur) % 2 == 1
+    first_half = np.arange(len(frames)) < len(frames) // 2
+    stability_odd_even = _rowwise_corr(tuning(odd_blocks)[0], tuning(~odd_blocks)[0])
+    stability_halves = _rowwise_corr(tuning(first_half)[0], tuning(~first_half)[0])
+
+    # ---- shuffles, blocks of fixed size split across processes ------
+    # blocks and their seeds do not depend on n_jobs, so seeded results are reproducible
+    shift = int(min_shift * srate)
+    assert 2 * shift < len(frames), "min_shift is too long for the selected frames"
+    split_shuffles = np.diff(
+        np.append(np.arange(0, n_shuffles, block_shuffles), n_shuffles)
+    )
+    seeds = np.random.SeedSequence(seed).spawn(len(split_shuffles))
+    shuffled_info = Parallel(n_jobs=n_jobs)(
+        delayed(_shuffled_information)(
+            spk_frames,
+            neuron_indx,
+            frame_bins,
+            occupancy,
+            n_neurons,
+            n_bins,
+            n,
+            shift,
+            smooth,
+            s,
+        )
+        for n, s in zip(split_shuffles, seeds)
+    )
+    shuffled_info = np.concatenate(shuffled_info, axis=0)
+    pval = (1 + np.sum(shuffled_info >= info[None, :], axis=0)) / (n_shuffles + 1)
+
+    return pd.DataFrame(
+        {
+            "neuron_id": neurons.neuron_ids,
+            "spatial_info": info,
+            "sparsity": sparsity(tuning_curves, occupancy),
+            "stability_odd_even": stability_odd_even,
+            "stability_halves": stability_halves,
+            "spatial_info_pval": pval,
+        }
+    )
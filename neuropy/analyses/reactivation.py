@@ -4,15 +4,128 @@ import matplotlib.gridspec as gridspec
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import pingouin as pg
 import scipy.stats as stats
 from scipy.ndimage import gaussian_filter
 from sklearn.decomposition import PCA, FastICA
 from typing import Union
+
 # from ..utils.mathutil import getICA_Assembly
 from .. import core
+from ..utils.backend import get_backend
 from ..plotting import Fig
-from tqdm import tqdm
+
+
+def _windowed_pairwise_corr(spike_counts, valid_bins, windows, pairs_bool=None):
+    """Pairwise correlations of binned spike counts within (overlapping) windows from a single pass over bins.
+
+    Sums of counts and of their outer products are accumulated over blocks between consecutive window edges, correlations of a window are calculated from difference of running sums at its edges.
+
+    Parameters
+    ----------
+    spike_counts : array (n_neurons x n_bins)
+        binned spike counts
+    valid_bins : bool array (n_bins,)
+        bins which are used in the calculation
+    windows : int array (n_windows x 2)
+        start (inclusive) and stop (exclusive) bin of each window
+    pairs_bool : 2D bool array, optional
+        only these pairs are returned, by default None (all pairs)
+
+    Returns
+    -------
+    array (n_windows x n_pairs)
+        pairwise correlations, same as BinnedSpiketrain.get_pairwise_corr for each window
+    """
+    n_neurons = spike_counts.shape[0]
+    if pairs_bool is None:
+        pairs_bool = np.ones((n_neurons, n_neurons), dtype=bool)
+    pairs_bool = np.tril(pairs_bool.astype(bool), k=-1)
+
+    edges = np.unique(windows.ravel())
+    starts_at = {e: np.where(windows[:, 0] == e)[0] for e in edges}
+    stops_at = {e: np.where(windows[:, 1] == e)[0] for e in edges}
+
+    n = 0
+    s1 = np.zeros(n_neurons)
+    s2 = np.zeros((n_neurons, n_neurons))
+    open_windows = {}
+    corr = np.zeros((len(windows), pairs_bool.sum()))
+    for e0, e1 in zip(np.concatenate(([edges[0]], edges[:-1])), edges):
+        x = spike_counts[:, e0:e1][:, valid_bins[e0:e1]].astype("float")
+        n, s1, s2 = n + x.shape[1], s1 + x.sum(axis=1), s2 + x @ x.T
+
+        for w in stops_at[e1]:
+            n0, s1_0, s2_0 = open_windows.pop(w)
+            w_n, w_mean = n - n0, (s1 - s1_0) / (n - n0)
+            cov = (s2 - s2_0) / w_n - np.outer(w_mean, w_mean)
+            std = np.sqrt(np.diag(cov))
+            corr[w] = (cov / np.outer(std, std))[pairs_bool]
+        for w in starts_at[e1]:
+            open_windows[w] = (n, s1, s2)
+
+    return corr
+
+
+def _partial_corr(x, y, z):
+    """Partial correlation between x and each row of y controlling for each row of z, computed across pairs which are valid (not nan) in all three.
+
+    Parameters
+    ----------
+    x : array (n_pairs,)
+    y : array (n_y x n_pairs)
+    z : array (n_z x n_pairs)
+
+    Returns
+    -------
+    array (n_z x n_y)
+        partial correlations, nan where less than 3 valid pairs
+    """
+    vx = ~np.isnan(x)
+    vy, vz = (~np.isnan(y) & vx).astype("float"), (~np.isnan(z)).astype("float")
+    x0, y0, z0 = np.where(vx, x, 0), np.where(vy > 0, y, 0), np.where(vz > 0, z, 0)
+
+    # sums over pairs valid for each (z, y) combination
+    n = vz @ vy.T
+    sx, sxx = vz @ (vy * x0).T, vz @ (vy * x0**2).T
+    sy, syy = vz @ y0.T, vz @ (y0**2).T
+    sz, szz = z0 @ vy.T, (z0**2) @ vy.T
+    sxy, sxz, syz = vz @ (y0 * x0).T, (z0 @ (vy * x0).T), z0 @ y0.T
+
+    cov = lambda sab, sa, sb: sab - sa * sb / n
+    cxx, cyy, czz = cov(sxx, sx, sx), cov(syy, sy, sy), cov(szz, sz, sz)
+    rxy = cov(sxy, sx, sy) / np.sqrt(cxx * cyy)
+    rxz = cov(sxz, sx, sz) / np.sqrt(cxx * czz)
+    ryz = cov(syz, sy, sz) / np.sqrt(cyy * czz)
+
+    partial_corr = (rxy - rxz * ryz) / np.sqrt((1 - rxz**2) * (1 - ryz**2))
+    partial_corr[n <= 2] = np.nan
+    return partial_corr
+
+
+def _epochs_binned_spikes(neurons: core.Neurons, epochs: core.Epoch, bin_size):
+    """Binned spike counts within each epoch concatenated across epochs, same as binning neurons.time_slice(start, stop) of each epoch but without slicing the neurons.
+
+    Returns
+    -------
+    spike_counts : array (n_neurons x n_bins)
+    time : array (n_bins,)
+        start time of each bin
+    """
+    spiketimes, neuron_indx = neurons.get_packed_spikes()
+    bin_counts = get_backend().bin_counts
+
+    spike_counts, time = [], []
+    for e in epochs.itertuples():
+        n_bins = np.floor((e.stop - e.start) / bin_size)
+        bins = np.arange(n_bins + 1) * bin_size + e.start
+        lo = np.searchsorted(spiketimes, e.start, side="left")
+        hi = np.searchsorted(spiketimes, e.stop, side="right")
+        spike_counts.append(
+            bin_counts(spiketimes[lo:hi], neuron_indx[lo:hi], bins, neurons.n_neurons)
+        )
+        time.append(bins[:-1])
+
+    return np.hstack(spike_counts).astype("float"), np.concatenate(time)
 
 
 class ExplainedVariance(core.DataWriter):
@@ -100,8 +213,6 @@ class ExplainedVariance(core.DataWriter):
         self._calculate()
 
     def _calculate(self):
-        # TODO: Think about directly working on binned spiketrains, will be little faster but may require redundant additions like pariwise_corr as separate function
-
         matching = np.arange(self.matching[0], self.matching[1])
         control = np.arange(self.control[0], self.control[1])
 
@@ -137,6 +248,24 @@ class ExplainedVariance(core.DataWriter):
             control, control_window_size
         )[::slideby, [0, -1]]
 
+        # ---- binning once across matching and control periods ------
+        windows = np.vstack((matching_windows, control_windows))
+        t_start = windows[:, 0].min()
+        start_bins = np.round((windows[:, 0] - t_start) / self.bin_size).astype("int")
+        stop_bins = start_bins + np.floor(
+            (windows[:, 1] - windows[:, 0]) / self.bin_size
+        ).astype("int")
+        bins = t_start + np.arange(stop_bins.max() + 1) * self.bin_size
+        spiketimes, neuron_indx = self.neurons.get_packed_spikes()
+        spike_counts = get_backend().bin_counts(
+            spiketimes, neuron_indx, bins, self.neurons.n_neurons
+        )
+
+        valid_bins = np.ones(len(bins) - 1, dtype=bool)
+        if self.ignore_epochs is not None:
+            ignore_bins = self.ignore_epochs.flatten()
+            valid_bins = np.digitize(bins[:-1], ignore_bins) % 2 == 0
+
         with np.errstate(all="ignore", invalid="ignore"):
             template_corr = (
                 self.neurons.time_slice(self.template[0], self.template[1])
@@ -145,51 +274,26 @@ class ExplainedVariance(core.DataWriter):
                 )
                 .get_pairwise_corr(pairs_bool=self.pairs_bool)
             )
+            windows_corr = _windowed_pairwise_corr(
+                spike_counts,
+                valid_bins,
+                np.vstack((start_bins, stop_bins)).T,
+                self.pairs_bool,
+            )
             n_matching_windows = matching_windows.shape[0]
-            matching_paircorr = []
-            for w in matching_windows:
-                matching_paircorr.append(
-                    self.neurons.time_slice(w[0], w[1])
-                    .get_binned_spiketrains(self.bin_size)
-                    .get_pairwise_corr(pairs_bool=self.pairs_bool)
-                )
-
-            n_control_windows = control_windows.shape[0]
-            control_paircorr = []
-            for w in control_windows:
-                control_paircorr.append(
-                    self.neurons.time_slice(w[0], w[1])
-                    .get_binned_spiketrains(self.bin_size)
-                    .get_pairwise_corr(pairs_bool=self.pairs_bool)
-                )
-
-            partial_corr = np.zeros((n_control_windows, n_matching_windows))
-            rev_partial_corr = np.zeros((n_control_windows, n_matching_windows))
-            print(f"Calculating partial correlations for {len(matching_paircorr)} time windows")
-            for m_i, m_pairs in enumerate(tqdm(matching_paircorr)):
-                for c_i, c_pairs in enumerate(control_paircorr):
-                    df = pd.DataFrame({"t": template_corr, "m": m_pairs, "c": c_pairs})
-                    try:
-                        # if ((~np.isnan(df["m"])).sum() > 2) and ((~np.isnan(df["c"])).sum() > 2):
-                        # Make sure you have at least 3 neurons-pairs with valid pairwise correlations in the windows in question
-                        if df[['t', 'm', 'c']].dropna().shape[0] > 2:
-                            partial_corr[c_i, m_i] = pg.partial_corr(
-                                df, x="t", y="m", covar="c"
-                            ).r
-                            rev_partial_corr[c_i, m_i] = pg.partial_corr(
-                                df, x="t"
-                                , y="c", covar="m"
-                            ).r
-                        else:  # Don't calculate ev and rev unless you have > 3 samples from both the control and matching epochs
-                            partial_corr[c_i, m_i] = np.nan
-                            rev_partial_corr[c_i, m_i] = np.nan
-                    except AssertionError:
-
-                        partial_corr[c_i, m_i] = pg.partial_corr(
-                            df, x="t", y="m", covar="c"
-                        ).r
-                        pass
+            matching_paircorr = windows_corr[:n_matching_windows]
+            control_paircorr = windows_corr[n_matching_windows:]
 
+            print(
+                f"Calculating partial correlations for {n_matching_windows} time windows"
+            )
+            # both (n_control_windows x n_matching_windows)
+            partial_corr = _partial_corr(
+                template_corr, matching_paircorr, control_paircorr
+            )
+            rev_partial_corr = _partial_corr(
+                template_corr, control_paircorr, matching_paircorr
+            ).T
 
         self.ev = np.nanmean(partial_corr**2, axis=0)
         self.rev = np.nanmean(rev_partial_corr**2, axis=0)
@@ -309,9 +413,14 @@ class NeuronEnsembles(core.DataWriter):
         assert isinstance(epochs, core.Epoch), "epochs is not of type core.Epoch"
 
         # ---- removing neurons which do not fire during the epochs ------
+        spiketimes, neuron_indx = neurons.get_packed_spikes()
         frate = np.zeros(len(neurons))
         for e in epochs.itertuples():
-            frate += neurons.time_slice(e.start, e.stop).firing_rate
+            lo = np.searchsorted(spiketimes, e.start, side="left")
+            hi = np.searchsorted(spiketimes, e.stop, side="right")
+            frate += np.bincount(neuron_indx[lo:hi], minlength=len(neurons)) / (
+                e.stop - e.start
+            )
 
         neuron_indx_thresh = frate > 0
         if len(np.argwhere(neuron_indx_thresh)) < neurons.n_neurons:
@@ -325,14 +434,7 @@ class NeuronEnsembles(core.DataWriter):
 
     def _estimate_weights(self):
         """extracting statisticaly independent components from significant eigenvectors as detected using Marcenko-Pasteur distribution vinput = Matrix  (m x n) where 'm' are the number of cells and 'n' time bins ICA weights thus extracted have highiest weight positive V = ICA weights for each neuron in the coactivation (weight having the highiest value is kept positive) M1 =  originally extracted neuron weights"""
-        template = []
-        for e in self.epochs.itertuples():
-            template.append(
-                self.neurons.time_slice(e.start, e.stop)
-                .get_binned_spiketrains(bin_size=self.bin_size)
-                .spike_counts
-            )
-        template = np.hstack(template)
+        template = _epochs_binned_spikes(self.neurons, self.epochs, self.bin_size)[0]
 
         n_spikes = np.sum(template, axis=1)
         assert np.all(n_spikes > 0), f"Neurons with no spikes within epochs"
@@ -361,49 +463,37 @@ class NeuronEnsembles(core.DataWriter):
     def n_ensembles(self):
         return self.weights.shape[1]
 
-    def get_activation(self, epochs: core.Epoch, bin_size=0.250):
+    def get_activation(self, epochs: core.Epoch, bin_size=0.250, chunk_bins=100000):
         """Calculates activation strength of ensembles in given epochs. If number of epochs is more than one then activation strengths are calculated on combined binned spikecounts across epochs.
 
+        Activation strength of an ensemble with weights w at each bin with spike counts z is the quadratic form z @ P @ z with projection P = outer(w, w) with zeroed diagonal, calculated for all ensembles at once as (z @ w)**2 - (z**2) @ (w**2).
+
         Parameters
         ----------
         epochs : core.Epoch
             activation strength calculation is restricted to these epochs
         bin_size : float, optional
             bin size for spike counts, by default 0.250
+        chunk_bins : int, optional
+            number of time bins processed at once, by default 100000
 
         Returns
         -------
         array
-            activation strength of the ensembles (n_neurons x n_bins)
+            activation strength of the ensembles (n_ensembles x n_bins)
         time
             time corresponding to each bin (n_bins x 0)
         """
 
         W = self.weights
-        spkcnts, time = [], []
-        for e in epochs.itertuples():
-            e_binspk = self.neurons.time_slice(e.start, e.stop).get_binned_spiketrains(
-                bin_size=bin_size
-            )
-            spkcnts.append(e_binspk.spike_counts)
-            time.append(e_binspk.time)
-        spkcnts = np.hstack(spkcnts)
-        time = np.concatenate(time)
-
-        activation = []
-        for i in range(W.shape[1]):
-            projMat = np.outer(W[:, i], W[:, i])
-            np.fill_diagonal(projMat, 0)
-            activation.append(
-                np.asarray(
-                    [
-                        spkcnts[:, t] @ projMat @ spkcnts[:, t]
-                        for t in range(spkcnts.shape[1])
-                    ]
-                )
-            )
+        spkcnts, time = _epochs_binned_spikes(self.neurons, epochs, bin_size)
+
+        activation = np.zeros((W.shape[1], spkcnts.shape[1]))
+        for t0 in range(0, spkcnts.shape[1], chunk_bins):
+            z = spkcnts[:, t0 : t0 + chunk_bins].T
+            activation[:, t0 : t0 + chunk_bins] = ((z @ W) ** 2 - (z**2) @ (W**2)).T
 
-        return np.asarray(activation), time
+        return activation, time
 
     def plot_activation(self, time, activation, nrows=None, ncols=None):
         if nrows is None:
@@ -6,16 +6,81 @@ from ..utils import mathutil
 from .. import core
 
 
-def detect_off_epochs(mua: core.Mua, ignore_epochs: core.Epoch = None):
+def _get_counts_getter(mua: core.Mua or core.Neurons, bin_size=0.001):
+    """Returns a function that gives spike counts within a range of bins, so that full session mua does not have to be calculated. Spike counts are calculated from packed spikes using bin edges identical to Neurons.get_mua.
+
+    Returns
+    -------
+    get_counts, n_bins, t_start, bin_size
+    """
+    if isinstance(mua, core.Mua):
+        get_counts = lambda b0, b1: mua.spike_counts[b0:b1]
+        return get_counts, mua.n_bins, mua.t_start, mua.bin_size
+
+    assert isinstance(mua, core.Neurons), "mua should be core.Mua or core.Neurons"
+    spiketimes = mua.get_packed_spikes()[0]
+    t_start = mua.t_start
+    n_bins = len(np.arange(t_start, mua.t_stop, bin_size)) - 1
+
+    def get_counts(b0, b1):
+        edges = t_start + np.arange(b0, b1 + 1) * bin_size
+        edges_indx = np.searchsorted(spiketimes, edges, side="left")
+        counts = np.diff(edges_indx)
+        if b1 == n_bins:  # last bin includes right edge
+            counts[-1] += (
+                np.searchsorted(spiketimes, edges[-1], "right") - edges_indx[-1]
+            )
+        return counts
+
+    return get_counts, n_bins, t_start, bin_size
+
+
+def _iter_chunks(get_counts, n_bins, chunk_bins, is_boundary):
+    """Splits bins into chunks which end at a bin where is_boundary is True, consecutive chunks share this boundary bin. Events which never include a boundary bin are therefore never split across chunks.
+
+    Yields
+    ------
+    first bin, counts
+        index of first bin and spike counts within the chunk
+    """
+    b0 = 0
+    while True:
+        b1 = min(b0 + chunk_bins, n_bins)
+        counts = get_counts(b0, b1)
+        while b1 < n_bins:
+            boundary_indx = np.nonzero(is_boundary(counts[1:]))[0]
+            if len(boundary_indx) > 0:
+                b1 = b0 + boundary_indx[-1] + 2
+                counts = counts[: b1 - b0]
+                break
+            b1 = min(b1 + chunk_bins, n_bins)
+            counts = get_counts(b0, b1)
+
+        yield b0, counts
+        if b1 >= n_bins:
+            break
+        b0 = b1 - 1
+
+
+def detect_off_epochs(
+    mua: core.Mua or core.Neurons,
+    ignore_epochs: core.Epoch = None,
+    bin_size=0.001,
+    chunk_dur=3600,
+):
     """Detects OFF periods using multiunit activity. During these epochs neurons stop almost stop firing.
     These off periods were reported by Vyazovskiy et al. 2011 in cortex for sleep deprived animals.
 
     Parameters
     ----------
-    mua : core.Mua object
-        mua object holds total number of spikes in each bin
+    mua : core.Mua or core.Neurons object
+        mua object holds total number of spikes in each bin, if neurons are provided spike counts are calculated in chunks from spiketimes
     ignore_epochs: core.Epoch
         ignore these epochs from getting detected
+    bin_size: float
+        bin size (seconds) used when neurons are provided, by default 0.001
+    chunk_dur: float
+        duration (seconds) of chunks that are processed at a time, by default 3600 seconds
 
     References
     ----------
@@ -23,39 +88,68 @@ def detect_off_epochs(mua: core.Mua, ignore_epochs: core.Epoch = None):
 
 
     """
+    get_counts, n_bins, t_start, bin_size = _get_counts_getter(mua, bin_size)
+    chunk_bins = max(int(chunk_dur / bin_size), 2)
 
-    time = mua.time
-    frate = mua.firing_rate
+    # ---- median firing rate, from histogram of spike counts for neurons ------
+    if isinstance(mua, core.Mua):
+        median = np.median(mua.spike_counts)
+    else:
+        counts_hist = np.zeros(1, dtype="int")
+        for b0 in range(0, n_bins, chunk_bins):
+            chunk_hist = np.bincount(get_counts(b0, min(b0 + chunk_bins, n_bins)))
+            counts_hist = np.pad(
+                counts_hist, (0, max(len(chunk_hist) - len(counts_hist), 0))
+            )
+            counts_hist[: len(chunk_hist)] += chunk_hist
+        cum_hist = np.cumsum(counts_hist)
+        median_indx = [(n_bins - 1) // 2, n_bins // 2]
+        median = np.searchsorted(cum_hist, median_indx, "right").mean()
 
-    # off periods
-    off = np.diff(np.where(frate < np.median(frate), 1, 0))
-    start_off = np.where(off == 1)[0]
-    end_off = np.where(off == -1)[0]
+    # off periods: from the last bin above median to the last bin below median
+    offperiods, minValue = [], []
+    for b0, counts in _iter_chunks(
+        get_counts, n_bins, chunk_bins, is_boundary=lambda x: x >= median
+    ):
+        below = mathutil.contiguous_regions(counts < median) if len(counts) else []
+        below = np.asarray(below).reshape(-1, 2)
+        below = below[(below[:, 0] + b0 > 0) & (below[:, 1] + b0 < n_bins)]
+        if len(below) == 0:
+            continue
+        chunk_offperiods = np.vstack((below[:, 0] - 1, below[:, 1] - 1)).T
 
-    if start_off[0] > end_off[0]:
-        end_off = end_off[1:]
-    if start_off[-1] > end_off[-1]:
-        start_off = start_off[:-1]
+        # ---- minimum instantenous frate within intervals ------
+        minValue.append(
+            np.minimum.reduceat(counts, chunk_offperiods.ravel())[::2] / bin_size
+        )
+        offperiods.append(chunk_offperiods + b0)
 
-    offperiods = np.vstack((start_off, end_off)).T
-    duration = np.diff(offperiods, axis=1).squeeze()
+    offperiods = np.concatenate([np.zeros((0, 2), dtype="int")] + offperiods)
+    minValue = np.concatenate([np.zeros(0)] + minValue)
+    duration = np.diff(offperiods, axis=1)[:, 0]
 
-    # ---- calculate minimum instantenous frate within intervals ------
-    minValue = np.zeros(len(offperiods))
-    for i in range(0, len(offperiods)):
-        minValue[i] = min(frate[offperiods[i, 0] : offperiods[i, 1]])
+    if ignore_epochs is not None:
+        ignore_bins = (ignore_epochs.as_array() - t_start) / bin_size
+        ignore_bins = mathutil.merge_intervals(ignore_bins)
+        indx = np.searchsorted(ignore_bins[:, 0], offperiods[:, 1], side="right") - 1
+        overlap = (indx >= 0) & (ignore_bins[indx, 1] >= offperiods[:, 0])
+        offperiods, duration, minValue = (
+            offperiods[~overlap],
+            duration[~overlap],
+            minValue[~overlap],
+        )
 
     # --- selecting only top 10 percent of lowest peak instfiring -----
-    quantiles = pd.qcut(minValue, 10, labels=False)
-    top10percent = np.where(quantiles == 0)[0]
-    offperiods = offperiods[top10percent, :]
-    duration = duration[top10percent]
+    if len(minValue) > 0:
+        top10percent = np.where(minValue <= np.quantile(minValue, 0.1))[0]
+        offperiods = offperiods[top10percent, :]
+        duration = duration[top10percent]
 
     events = pd.DataFrame(
         {
-            "start": time[offperiods[:, 0]],
-            "stop": time[offperiods[:, 1]],
-            "duration": duration * mua.bin_size,
+            "start": t_start + offperiods[:, 0] * bin_size,
+            "stop": t_start + offperiods[:, 1] * bin_size,
+            "duration": duration * bin_size,
             "label": "",
         }
     )
@@ -64,29 +158,40 @@ def detect_off_epochs(mua: core.Mua, ignore_epochs: core.Epoch = None):
 
 
 def detect_pbe_epochs(
-    mua: core.Mua,
+    mua: core.Mua or core.Neurons,
     thresh=(3, None),
     edge_cutoff=0.5,
     duration=(0.1, None),
     distance=None,
+    bin_size=0.001,
+    chunk_dur=3600,
 ):
     """Detects putative population burst events
 
     Parameters
     ----------
+    mua : core.Mua or core.Neurons object
+        if neurons are provided, spike counts are calculated in chunks from spiketimes
     thresh : tuple, optional
         values based on zscore i.e, events with firing rate above thresh[0] and peak exceeding thresh[1], by default (0, 3) --> above mean and greater than 3 SD
     duration : float, optional
         minimum and maximum duration of pbe, in seconds, default = (0.1,None) seconds
     distance : float, optioal
         if two events are less than this time apart, they are merged, in seconds
+    bin_size: float
+        bin size (seconds) used when neurons are provided, by default 0.001
+    chunk_dur: float
+        duration (seconds) of chunks that are processed at a time, by default 3600 seconds
     """
 
     assert len(thresh) == 2, "thresh can only have two elements"
+    get_counts, n_bins, t_start, bin_size = _get_counts_getter(mua, bin_size)
+    chunk_bins = max(int(chunk_dur / bin_size), 2)
+
     if distance is None:
         distance = 1e-6
     else:
-        distance = distance / mua.bin_size
+        distance = distance / bin_size
 
     min_dur, max_dur = duration
     params = {
@@ -95,41 +200,52 @@ def detect_pbe_epochs(
         "distance": distance,
     }
 
-    lowthresh, highthresh = thresh
-    n_spikes = stats.zscore(mua.spike_counts)
-    n_spikes_thresh = np.where(n_spikes >= edge_cutoff, n_spikes, 0)
-    peaks, props = find_peaks(
-        n_spikes_thresh, height=[lowthresh, highthresh], prominence=0
-    )
-    starts, stops = props["left_bases"], props["right_bases"]
-    peaks_n_spikes = n_spikes_thresh[peaks]
-
-    # ----- merge overlapping epochs ------
-    n_epochs = len(starts)
-    ind_delete = []
-    for i in range(n_epochs - 1):
-        if starts[i + 1] - stops[i] < distance:
-
-            # stretch the second epoch to cover the range of both epochs
-            starts[i + 1] = min(starts[i], starts[i + 1])
-            stops[i + 1] = max(stops[i], stops[i + 1])
+    # ---- mean and std of spike counts for zscoring ------
+    sum_counts, sqsum_counts = 0, 0
+    for b0 in range(0, n_bins, chunk_bins):
+        counts = get_counts(b0, min(b0 + chunk_bins, n_bins)).astype("float")
+        sum_counts += counts.sum()
+        sqsum_counts += np.sum(counts**2)
+    mean = sum_counts / n_bins
+    std = np.sqrt(sqsum_counts / n_bins - mean**2)
 
-            peaks_n_spikes[i + 1] = max(peaks_n_spikes[i], peaks_n_spikes[i + 1])
-            peaks[i + 1] = [peaks[i], peaks[i + 1]][
-                np.argmax([peaks_n_spikes[i], peaks_n_spikes[i + 1]])
-            ]
+    # ---- peaks and their bases, chunks are split where zscore is below edge_cutoff ----
+    lowthresh, highthresh = thresh
+    starts, stops, peaks, peaks_n_spikes = [], [], [], []
+    for b0, counts in _iter_chunks(
+        get_counts,
+        n_bins,
+        chunk_bins,
+        is_boundary=lambda x: (x - mean) / std < edge_cutoff,
+    ):
+        n_spikes = (counts - mean) / std
+        n_spikes_thresh = np.where(n_spikes >= edge_cutoff, n_spikes, 0)
+        chunk_peaks, props = find_peaks(
+            n_spikes_thresh, height=[lowthresh, highthresh], prominence=0
+        )
+        starts.append(props["left_bases"] + b0)
+        stops.append(props["right_bases"] + b0)
+        peaks.append(chunk_peaks + b0)
+        peaks_n_spikes.append(n_spikes_thresh[chunk_peaks])
 
-            ind_delete.append(i)
+    starts, stops = np.concatenate(starts), np.concatenate(stops)
+    peaks, peaks_n_spikes = np.concatenate(peaks), np.concatenate(peaks_n_spikes)
 
-    epochs_arr = np.vstack((starts, stops, peaks, peaks_n_spikes)).T
-    starts, stops, peaks, peaks_n_spikes = np.delete(epochs_arr, ind_delete, axis=0).T
+    # ----- merge overlapping epochs, keeping the highest peak ------
+    epochs_arr, groups = mathutil.merge_intervals(
+        np.vstack((starts, stops)).T, gap=distance, ret_groups=True
+    )
+    peak_order = np.lexsort((-peaks_n_spikes, groups))
+    is_first = np.concatenate(([True], np.diff(groups[peak_order]) > 0))
+    peaks = peaks[peak_order[is_first]]
+    peaks_n_spikes = peaks_n_spikes[peak_order[is_first]]
+    starts, stops = epochs_arr.T
 
-    time = np.asarray(mua.time)
     epochs_df = pd.DataFrame(
         {
-            "start": time[starts.astype("int")],
-            "stop": time[stops.astype("int")],
-            "peak_time": time[peaks.astype("int")],
+            "start": t_start + starts * bin_size,
+            "stop": t_start + stops * bin_size,
+            "peak_time": t_start + peaks * bin_size,
             "peak_counts": peaks_n_spikes,
             "label": "pbe",
         }
@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 from ..utils.mathutil import gaussian_kernel1D
+from ..utils.backend import get_backend
 import scipy.signal as sg
 from .datawriter import DataWriter
 from . import Epoch
@@ -267,6 +268,19 @@ class Neurons(DataWriter):
     def get_all_spikes(self):
         return np.concatenate(self.spiketrains).astype("float")
 
+    def get_packed_spikes(self):
+        """All spikes packed into a single array sorted by time along with index of the neuron each spike belongs to. Avoids looping over spiketrains of object dtype.
+
+        Returns
+        -------
+        spiketimes, neuron_indx
+            sorted spike times (float) and index of neuron (int) for each spike
+        """
+        spiketimes = self.get_all_spikes()
+        neuron_indx = np.repeat(np.arange(self.n_neurons), self.n_spikes)
+        sort_indx = np.argsort(spiketimes, kind="stable")
+        return spiketimes[sort_indx], neuron_indx[sort_indx]
+
     @property
     def n_spikes(self):
         "number of spikes within each spiketrain"
@@ -341,8 +355,9 @@ class Neurons(DataWriter):
         n_bins = np.floor(duration / bin_size)
         # bins = np.arange(self.t_start, self.t_stop + bin_size, bin_size)
         bins = np.arange(n_bins + 1) * bin_size + self.t_start
-        spike_counts = np.asarray(
-            [np.histogram(_, bins=bins)[0] for _ in self.spiketrains]
+        spiketimes, neuron_indx = self.get_packed_spikes()
+        spike_counts = get_backend().bin_counts(
+            spiketimes, neuron_indx, bins, self.n_neurons
         ).astype("float")
         if ignore_epochs is not None:
             ignore_bins = ignore_epochs.flatten()
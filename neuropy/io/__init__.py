@@ -1,5 +1,5 @@
 from .neuroscopeio import NeuroscopeIO
-from .binarysignalio import BinarysignalIO
+from .binarysignalio import BinarysignalIO, read_growing_file_blocks, read_socket_blocks
 from .phyio import PhyIO
 from .optitrackio import OptitrackIO
 from .spykingcircusio import SpykingCircusIO
\ No newline at end of file
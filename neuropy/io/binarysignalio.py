@@ -2,6 +2,9 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 import numpy as np
+import os
+import socket
+import time
 
 from ..core import Epoch, Signal
 from ..core import Signal, Epoch
@@ -152,3 +155,112 @@ class BinarysignalIO:
             write_filename, dtype=self.dtype, mode="w+", shape=(len(read_data))
         )
         write_data[: len(read_data)] = read_data
+
+
+def read_growing_file_blocks(
+    filename,
+    n_channels,
+    dtype="int16",
+    sampling_rate=1250,
+    block_dur=1,
+    start_frame=0,
+    poll_interval=0.05,
+    timeout=10,
+):
+    """Yields blocks of traces from a binary file which is still being written to, e.g. .eeg file during an ongoing recording.
+
+    Parameters
+    ----------
+    filename : str or Path
+        binary file with interleaved channels
+    n_channels : int
+        number of channels in the file
+    dtype : str, optional
+        datatype of the file, by default "int16"
+    sampling_rate : int, optional
+        sampling rate, by default 1250
+    block_dur : float, optional
+        duration of each block in seconds, by default 1 second
+    start_frame : int, optional
+        frame from which to start reading, by default 0
+    poll_interval : float, optional
+        time (seconds) to wait before checking file size again, by default 0.05
+    timeout : float, optional
+        stops if file does not grow for this many seconds, remaining frames are yielded as a last (shorter) block, by default 10
+
+    Yields
+    ------
+    array (n_channels x n_frames)
+        traces of each block
+    """
+    frame_bytes = n_channels * np.dtype(dtype).itemsize
+    block_frames = int(block_dur * sampling_rate)
+    offset = start_frame * frame_bytes
+    last_read = time.time()
+
+    with open(filename, "rb") as f:
+        while True:
+            n_available = (os.path.getsize(filename) - offset) // frame_bytes
+            timed_out = time.time() - last_read > timeout
+            if (n_available >= block_frames) or (timed_out and n_available > 0):
+                n_frames = min(n_available, block_frames)
+                f.seek(offset)
+                data = np.fromfile(f, dtype=dtype, count=n_frames * n_channels)
+                offset += n_frames * frame_bytes
+                last_read = time.time()
+                yield data.reshape(-1, n_channels).T
+            elif timed_out:
+                break
+            else:
+                time.sleep(poll_interval)
+
+
+def read_socket_blocks(
+    n_channels,
+    host="localhost",
+    port=5000,
+    dtype="int16",
+    sampling_rate=1250,
+    block_dur=1,
+):
+    """Yields blocks of traces from a socket streaming interleaved samples, e.g. a local stand-in for acquisition software. Stops when the connection is closed.
+
+    Parameters
+    ----------
+    n_channels : int
+        number of channels in the stream
+    host : str, optional
+        by default "localhost"
+    port : int, optional
+        by default 5000
+    dtype : str, optional
+        datatype of samples, by default "int16"
+    sampling_rate : int, optional
+        sampling rate, by default 1250
+    block_dur : float, optional
+        duration of each block in seconds, by default 1 second
+
+    Yields
+    ------
+    array (n_channels x n_frames)
+        traces of each block
+    """
+    frame_bytes = n_channels * np.dtype(dtype).itemsize
+    block_bytes = int(block_dur * sampling_rate) * frame_bytes
+    buffer = bytearray()
+
+    with socket.create_connection((host, port)) as sock:
+        while True:
+            data = sock.recv(max(block_bytes - len(buffer), frame_bytes))
+            if not data:
+                break
+            buffer += data
+            while len(buffer) >= block_bytes:
+                block = np.frombuffer(bytes(buffer[:block_bytes]), dtype=dtype)
+                del buffer[:block_bytes]
+                yield block.reshape(-1, n_channels).T
+
+    n_remaining = len(buffer) // frame_bytes
+    if n_remaining > 0:
+        block = np.frombuffer(bytes(buffer[: n_remaining * frame_bytes]), dtype=dtype)
+        yield block.reshape(-1, n_channels).T
@@ -0,0 +1,274 @@
+"""Compute backends for spike lag and binning kernels.
+
+Kernels used by correlograms (`ccg_engine`), connectivity tests (`analyses.ms_connectivity`) and spike binning are implemented for each backend with the same signature and output:
+
+* 'numpy': vectorized NumPy, always available
+* 'numba': JIT compiled loops, used if numba is installed
+
+Backend is chosen automatically ('numba' if available, otherwise 'numpy'). It can be overridden with the environment variable NEUROPY_BACKEND or `set_backend`. If the requested backend can not be loaded, 'numpy' is used instead.
+"""
+
+import os
+import numpy as np
+
+
+class NumpyBackend:
+    """Vectorized kernels, lags and bins are accumulated with bincount"""
+
+    name = "numpy"
+
+    @staticmethod
+    def count_lags(
+        keys, labels, hi, i_start, i_stop, binsize, n_lags, pair_index, n_out
+    ):
+        """Accumulates lags between each spike in [i_start, i_stop) and all spikes following it within its window.
+
+        Parameters
+        ----------
+        keys : array
+            sorted spike samples
+        labels : array
+            cluster index of each spike
+        hi : array
+            for each spike, index of the first spike outside its window
+        pair_index : 2D array or None
+            output row for each (cluster, cluster) combination, -1 to ignore. If None, labels are used directly (autocorrelograms).
+        n_out : int
+            number of output rows
+
+        Returns
+        -------
+        array (n_out x n_lags)
+            counts of spikes at each lag
+        """
+        counts = np.zeros(n_out * n_lags, dtype=np.int64)
+        n_pairs = hi[i_start:i_stop] - np.arange(i_start + 1, i_stop + 1)
+        cum_pairs = np.concatenate(([0], np.cumsum(n_pairs)))
+
+        # ---- sub-chunks with bounded number of pairs to limit memory ------
+        max_pairs = max(2**22, n_out * n_lags)
+        sub_edges = np.searchsorted(
+            cum_pairs, np.arange(0, cum_pairs[-1], max_pairs), side="right"
+        )
+        sub_edges = np.unique(np.concatenate((sub_edges - 1, [len(n_pairs)])))
+
+        for s0, s1 in zip(sub_edges[:-1], sub_edges[1:]):
+            n = n_pairs[s0:s1]
+            total = n.sum()
+            if total == 0:
+                continue
+            i = np.arange(i_start + s0, i_start + s1)
+            j = np.arange(total) + np.repeat(
+                i + 1 - (cum_pairs[s0:s1] - cum_pairs[s0]), n
+            )
+            lag = (keys[j] - np.repeat(keys[i], n)) // binsize
+
+            if pair_index is None:
+                out_row = np.repeat(labels[i], n)
+            else:
+                out_row = pair_index[np.repeat(labels[i], n), labels[j]]
+                valid = out_row >= 0
+                out_row, lag = out_row[valid], lag[valid]
+
+            counts += np.bincount(out_row * n_lags + lag, minlength=n_out * n_lags)
+
+        return counts.reshape(n_out, n_lags)
+
+    @staticmethod
+    def count_window_lags(keys, queries, rows, lo, hi, binsize, halfbins, n_rows):
+        """Counts lags from each query to keys[lo:hi] in bins centered at zero lag.
+
+        Parameters
+        ----------
+        keys, queries : array
+            key and query times (samples)
+        rows : array
+            output row of each query
+        lo, hi : array
+            range of keys around each query
+        binsize : float
+            bin size in samples
+        halfbins : int
+            number of bins on either side of zero lag
+
+        Returns
+        -------
+        array (n_rows x 2*halfbins+1)
+        """
+        n_bins = 2 * halfbins + 1
+        n_pairs = hi - lo
+        total = n_pairs.sum()
+        if total == 0:
+            return np.zeros((n_rows, n_bins), dtype=np.int64)
+
+        start = np.cumsum(n_pairs) - n_pairs
+        indx = np.arange(total) + np.repeat(lo - start, n_pairs)
+        lag = np.floor((keys[indx] - np.repeat(queries, n_pairs)) / binsize + 0.5)
+        lag = lag.astype(np.int64) + halfbins
+        row = np.repeat(rows, n_pairs)
+        valid = (lag >= 0) & (lag < n_bins)
+
+        counts = np.bincount(
+            row[valid] * n_bins + lag[valid], minlength=n_rows * n_bins
+        )
+        return counts.reshape(n_rows, n_bins)
+
+    @staticmethod
+    def bin_counts(times, labels, edges, n_labels):
+        """Histogram of times for each label, same as np.histogram (last bin includes right edge).
+
+        Parameters
+        ----------
+        times : array
+            event times
+        labels : array
+            label (row) of each event
+        edges : array
+            increasing bin edges
+        n_labels : int
+            number of rows
+
+        Returns
+        -------
+        array (n_labels x len(edges)-1)
+        """
+        n_bins = len(edges) - 1
+        indx = np.searchsorted(edges, times, side="right") - 1
+        indx[times == edges[-1]] = n_bins - 1
+        valid = (indx >= 0) & (indx < n_bins)
+        counts = np.bincount(
+            labels[valid] * n_bins + indx[valid], minlength=n_labels * n_bins
+        )
+        return counts.reshape(n_labels, n_bins)
+
+
+def _count_lags_loop(
+    keys, labels, hi, i_start, i_stop, binsize, n_lags, pair_index, n_out
+):
+    counts = np.zeros((n_out, n_lags), dtype=np.int64)
+    use_pairs = pair_index.shape[0] > 0
+    for i in range(i_start, i_stop):
+        for j in range(i + 1, hi[i]):
+            if use_pairs:
+                row = pair_index[labels[i], labels[j]]
+                if row < 0:
+                    continue
+            else:
+                row = labels[i]
+            counts[row, (keys[j] - keys[i]) // binsize] += 1
+    return counts
+
+
+def _count_window_lags_loop(keys, queries, rows, lo, hi, binsize, halfbins, n_rows):
+    n_bins = 2 * halfbins + 1
+    counts = np.zeros((n_rows, n_bins), dtype=np.int64)
+    for q in range(len(queries)):
+        for k in range(lo[q], hi[q]):
+            lag = int(np.floor((keys[k] - queries[q]) / binsize + 0.5)) + halfbins
+            if lag >= 0 and lag < n_bins:
+                counts[rows[q], lag] += 1
+    return counts
+
+
+def _bin_counts_loop(times, labels, edges, n_labels):
+    n_bins = len(edges) - 1
+    counts = np.zeros((n_labels, n_bins), dtype=np.int64)
+    for s in range(len(times)):
+        indx = np.searchsorted(edges, times[s], side="right") - 1
+        if times[s] == edges[-1]:
+            indx = n_bins - 1
+        if indx >= 0 and indx < n_bins:
+            counts[labels[s], indx] += 1
+    return counts
+
+
+class NumbaBackend:
+    """Same kernels as NumpyBackend as JIT compiled loops, these release the GIL so thread pools run them in parallel"""
+
+    name = "numba"
+
+    def __init__(self):
+        import numba
+
+        jit = numba.njit(nogil=True, cache=True)
+        self._count_lags = jit(_count_lags_loop)
+        self._count_window_lags = jit(_count_window_lags_loop)
+        self._bin_counts = jit(_bin_counts_loop)
+
+    def count_lags(
+        self, keys, labels, hi, i_start, i_stop, binsize, n_lags, pair_index, n_out
+    ):
+        if pair_index is None:
+            pair_index = np.zeros((0, 0), dtype=np.int64)
+        return self._count_lags(
+            np.ascontiguousarray(keys, dtype=np.int64),
+            np.ascontiguousarray(labels, dtype=np.int64),
+            np.ascontiguousarray(hi, dtype=np.int64),
+            int(i_start),
+            int(i_stop),
+            int(binsize),
+            int(n_lags),
+            np.ascontiguousarray(pair_index, dtype=np.int64),
+            int(n_out),
+        )
+
+    def count_window_lags(self, keys, queries, rows, lo, hi, binsize, halfbins, n_rows):
+        return self._count_window_lags(
+            np.ascontiguousarray(keys, dtype=np.float64),
+            np.ascontiguousarray(queries, dtype=np.float64),
+            np.ascontiguousarray(rows, dtype=np.int64),
+            np.ascontiguousarray(lo, dtype=np.int64),
+            np.ascontiguousarray(hi, dtype=np.int64),
+            float(binsize),
+            int(halfbins),
+            int(n_rows),
+        )
+
+    def bin_counts(self, times, labels, edges, n_labels):
+        return self._bin_counts(
+            np.ascontiguousarray(times, dtype=np.float64),
+            np.ascontiguousarray(labels, dtype=np.int64),
+            np.ascontiguousarray(edges, dtype=np.float64),
+            int(n_labels),
+        )
+
+
+_BACKENDS = {"numpy": NumpyBackend, "numba": NumbaBackend}
+_backend = None
+
+
+def set_backend(name="auto"):
+    """Selects compute backend.
+
+    Parameters
+    ----------
+    name : str, optional
+        'auto', 'numpy' or 'numba', by default 'auto' (numba if available)
+
+    Returns
+    -------
+    backend object
+    """
+    global _backend
+    assert name in [
+        "auto",
+        *_BACKENDS,
+    ], f"backend should be one of auto, {list(_BACKENDS)}"
+
+    candidates = ["numba", "numpy"] if name == "auto" else [name, "numpy"]
+    for candidate in candidates:
+        try:
+            _backend = _BACKENDS[candidate]()
+            break
+        except ImportError:
+            if name != "auto":
+                print(f"{candidate} backend is not available, using numpy instead")
+
+    return _backend
+
+
+def get_backend():
+    """Currently selected backend, on first call it is chosen from environment variable NEUROPY_BACKEND (default 'auto')"""
+    if _backend is None:
+        set_backend(os.environ.get("NEUROPY_BACKEND", "auto").lower())
+    return _backend
@@ -0,0 +1,245 @@
+"""Cross-correlograms using spike index windows.
+
+Same output as `ccg.correlograms` but instead of shifting spike trains
+against each other one spike at a time, the window of spikes following each
+spike is found with `searchsorted` and lags are accumulated by the selected
+compute backend (`backend.get_backend`) over chunks of spikes. Chunks can be processed on a thread pool.
+"""
+
+import numpy as np
+from joblib import Parallel, delayed
+from .ccg import _as_array, _index_of, _unique, _symmetrize_correlograms
+from .backend import get_backend
+
+
+def _correlogram_counts(keys, labels, binsize, n_lags, pair_index, n_out, n_jobs=1):
+    """One-sided lag counts (n_out x n_lags), chunks of spikes are split across a thread pool"""
+    hi = np.searchsorted(keys, keys + n_lags * binsize, side="left")
+    n_pairs = np.cumsum(hi - np.arange(1, len(keys) + 1))
+
+    # ---- chunks with similar number of pairs -------
+    n_chunks = 4 * max(n_jobs, 1) if n_jobs != -1 else 32
+    edges = np.searchsorted(n_pairs, np.linspace(0, n_pairs[-1], n_chunks + 1)[1:-1])
+    edges = np.unique(np.concatenate(([0], edges, [len(keys)])))
+
+    count_lags = get_backend().count_lags
+    counts = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(count_lags)(
+            keys, labels, hi, i0, i1, binsize, n_lags, pair_index, n_out
+        )
+        for i0, i1 in zip(edges[:-1], edges[1:])
+    )
+    return np.sum(counts, axis=0).astype(np.int32)
+
+
+def correlograms(
+    spike_times,
+    spike_clusters,
+    cluster_ids=None,
+    sample_rate=1.0,
+    bin_size=None,
+    window_size=None,
+    symmetrize=True,
+    pairs=None,
+    acg_only=False,
+    n_jobs=1,
+):
+    """Compute pairwise cross-correlograms among the clusters appearing
+    in `spike_clusters`, drop-in replacement for `ccg.correlograms`.
+
+    Parameters
+    ----------
+    spike_times : array-like
+        Spike times in seconds, increasing.
+    spike_clusters : array-like
+        Spike-cluster mapping.
+    cluster_ids : array-like
+        The list of *all* unique clusters, in any order. That order will be used
+        in the output array.
+    sample_rate : float
+        Sampling rate.
+    bin_size : float
+        Size of the bin, in seconds.
+    window_size : float
+        Size of the window, in seconds.
+    symmetrize : boolean (True)
+        Whether the output should be symmetrized or not.
+    pairs : list of tuples, optional
+        (cluster_id, cluster_id) pairs for which correlograms are computed, by default None (all pairs)
+    acg_only : bool, optional
+        compute only autocorrelograms, by default False
+    n_jobs : int, optional
+        number of threads, by default 1
+
+    Returns
+    -------
+    correlograms : array
+        `(n_clusters, n_clusters, winsize_bins)` array with all pairwise CCGs, `(n_pairs, winsize_bins)` if pairs are provided and `(n_clusters, winsize_bins)` if acg_only.
+        Without symmetrization only non-negative lags are returned.
+    """
+    assert sample_rate > 0.0
+    assert not (acg_only and pairs is not None), "use either pairs or acg_only"
+
+    spike_times = np.asarray(spike_times, dtype=float)
+    assert np.all(np.diff(spike_times) >= 0), "The spike times must be increasing."
+    spike_samples = (spike_times * sample_rate).astype(np.int64)
+    spike_clusters = _as_array(spike_clusters)
+    assert spike_samples.shape == spike_clusters.shape
+
+    bin_size = np.clip(bin_size, 1e-5, 1e5)  # in seconds
+    binsize = int(sample_rate * bin_size)  # in samples
+    assert binsize >= 1
+    window_size = np.clip(window_size, 1e-5, 1e5)  # in seconds
+    winsize_bins = 2 * int(0.5 * window_size / bin_size) + 1
+    n_lags = winsize_bins // 2 + 1
+
+    if cluster_ids is None:
+        clusters = _unique(spike_clusters)
+    else:
+        clusters = _as_array(cluster_ids)
+    n_clusters = len(clusters)
+    labels = _index_of(spike_clusters, clusters)
+    keep = labels >= 0
+    spike_samples, labels = spike_samples[keep], labels[keep]
+
+    if len(spike_samples) == 0:
+        counts_shape = (n_clusters, n_clusters) if pairs is None else (len(pairs), 2)
+        counts_shape = (n_clusters,) if acg_only else counts_shape
+        counts = np.zeros(counts_shape + (n_lags,), dtype=np.int32)
+    elif acg_only:
+        # spikes of each cluster are laid out one after the other, offset so that windows never span two clusters
+        order = np.argsort(labels, kind="stable")
+        offset = spike_samples.max() + n_lags * binsize + 1
+        keys = spike_samples[order] + labels[order] * offset
+        counts = _correlogram_counts(
+            keys, labels[order], binsize, n_lags, None, n_clusters, n_jobs
+        )
+    elif pairs is None:
+        pair_index = np.arange(n_clusters**2).reshape(n_clusters, n_clusters)
+        counts = _correlogram_counts(
+            spike_samples, labels, binsize, n_lags, pair_index, n_clusters**2, n_jobs
+        ).reshape(n_clusters, n_clusters, n_lags)
+    else:
+        # each unordered pair is counted once, reversed or repeated pairs are mapped back below
+        requested = _index_of(np.asarray(pairs).reshape(-1, 2), clusters)
+        pairs_indx, inverse = np.unique(
+            np.sort(requested, axis=1), axis=0, return_inverse=True
+        )
+        pair_index = -np.ones((n_clusters, n_clusters), dtype=np.int64)
+        pair_index[pairs_indx[:, 0], pairs_indx[:, 1]] = np.arange(len(pairs_indx))
+        pair_index[pairs_indx[:, 1], pairs_indx[:, 0]] = np.arange(
+            len(pairs_indx), 2 * len(pairs_indx)
+        )
+        keep = np.isin(labels, pairs_indx)
+        counts = _correlogram_counts(
+            spike_samples[keep],
+            labels[keep],
+            binsize,
+            n_lags,
+            pair_index,
+            2 * len(pairs_indx),
+            n_jobs,
+        )
+        # rows for pairs with same cluster were written to the second half
+        counts_ab = counts[: len(pairs_indx)]
+        counts_ba = counts[len(pairs_indx) :]
+        same = pairs_indx[:, 0] == pairs_indx[:, 1]
+        counts_ab[same] = counts_ba[same]
+        counts = np.stack((counts_ab, counts_ba), axis=1)[inverse.ravel()]
+        flip = requested[:, 0] > requested[:, 1]
+        counts[flip] = counts[flip][:, ::-1]
+
+    if not symmetrize:
+        return counts[:, 0] if pairs is not None else counts
+
+    if acg_only:
+        return np.hstack((counts[:, 1:][:, ::-1], counts))
+    elif pairs is None:
+        return _symmetrize_correlograms(counts)
+    else:
+        counts_ab, counts_ba = counts[:, 0], counts[:, 1]
+        counts_ab[:, 0] = np.maximum(counts_ab[:, 0], counts_ba[:, 0])
+        return np.hstack((counts_ba[:, 1:][:, ::-1], counts_ab))
+
+
+def autocorrelograms(
+    spike_times,
+    spike_clusters,
+    cluster_ids=None,
+    sample_rate=1.0,
+    bin_sizes=(0.001,),
+    window_sizes=(0.05,),
+    n_jobs=1,
+):
+    """Autocorrelograms of all clusters at several bin and window sizes from a single pass over spikes.
+
+    Lags are counted once at the resolution of sampling_rate up to the largest window and then summed into bins of each requested size, so the result for each (bin_size, window_size) is identical to `correlograms(..., acg_only=True)`.
+
+    Parameters
+    ----------
+    spike_times : array-like
+        Spike times in seconds, increasing.
+    spike_clusters : array-like
+        Spike-cluster mapping.
+    cluster_ids : array-like, optional
+        The list of *all* unique clusters, in any order, by default None
+    sample_rate : float
+        Sampling rate.
+    bin_sizes : list of float
+        bin sizes in seconds
+    window_sizes : list of float
+        window sizes in seconds, one for each bin size
+    n_jobs : int, optional
+        number of threads, by default 1
+
+    Returns
+    -------
+    list of arrays
+        `(n_clusters, winsize_bins)` autocorrelograms for each (bin_size, window_size)
+    """
+    assert sample_rate > 0.0
+    assert len(bin_sizes) == len(window_sizes), "one window_size for each bin_size"
+
+    spike_times = np.asarray(spike_times, dtype=float)
+    assert np.all(np.diff(spike_times) >= 0), "The spike times must be increasing."
+    spike_samples = (spike_times * sample_rate).astype(np.int64)
+    spike_clusters = _as_array(spike_clusters)
+    assert spike_samples.shape == spike_clusters.shape
+
+    binsizes, n_lags = [], []
+    for bin_size, window_size in zip(bin_sizes, window_sizes):
+        bin_size = np.clip(bin_size, 1e-5, 1e5)
+        window_size = np.clip(window_size, 1e-5, 1e5)
+        binsizes.append(int(sample_rate * bin_size))
+        n_lags.append(int(0.5 * window_size / bin_size) + 1)
+    binsizes, n_lags = np.array(binsizes), np.array(n_lags)
+    assert np.all(binsizes >= 1)
+    n_samples = np.max(binsizes * n_lags)  # largest lag (in samples) needed
+
+    if cluster_ids is None:
+        clusters = _unique(spike_clusters)
+    else:
+        clusters = _as_array(cluster_ids)
+    n_clusters = len(clusters)
+    labels = _index_of(spike_clusters, clusters)
+    keep = labels >= 0
+    spike_samples, labels = spike_samples[keep], labels[keep]
+
+    # ---- lag counts at sampling resolution -------
+    if len(spike_samples) == 0:
+        counts = np.zeros((n_clusters, n_samples), dtype=np.int32)
+    else:
+        order = np.argsort(labels, kind="stable")
+        offset = spike_samples.max() + n_samples + 1
+        keys = spike_samples[order] + labels[order] * offset
+        counts = _correlogram_counts(
+            keys, labels[order], 1, n_samples, None, n_clusters, n_jobs
+        )
+
+    acgs = []
+    for binsize, n in zip(binsizes, n_lags):
+        binned = counts[:, : n * binsize].reshape(n_clusters, n, binsize).sum(axis=2)
+        binned = binned.astype(np.int32)
+        acgs.append(np.hstack((binned[:, 1:][:, ::-1], binned)))
+
+    return acgs
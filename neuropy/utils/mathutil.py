@@ -2,10 +2,10 @@ import numpy as np
 import math
 import pandas as pd
 from sklearn.decomposition import FastICA, PCA
-from scipy import stats
+from scipy import stats, special
 from hmmlearn.hmm import GaussianHMM
 from sklearn.mixture import GaussianMixture
-from .ccg import correlograms
+from .ccg_engine import correlograms
 import scipy.signal as sg
 import typing
 
@@ -234,6 +234,42 @@ def contiguous_regions(condition):
     return idx
 
 
+def merge_intervals(arr: np.ndarray, gap=0, ret_groups=False):
+    """Merges intervals which overlap or are separated by less than gap.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        n x 2 array of start and stop of intervals
+    gap : float, optional
+        intervals separated by less than this are merged, by default 0 (only overlapping intervals are merged)
+    ret_groups : bool, optional
+        if True, also returns index of the merged interval each input interval belongs to, by default False
+
+    Returns
+    -------
+    np.ndarray
+        m x 2 array of merged intervals sorted by start
+    """
+    arr = np.asarray(arr).reshape(-1, 2)
+    if len(arr) == 0:
+        return (arr, np.zeros(0, dtype="int")) if ret_groups else arr
+
+    sort_indx = np.argsort(arr[:, 0], kind="stable")
+    arr = arr[sort_indx]
+    max_stop = np.maximum.accumulate(arr[:, 1])
+    is_new = np.concatenate(([True], (arr[1:, 0] - max_stop[:-1]) >= gap))
+    new_indx = np.where(is_new)[0]
+    merged = np.vstack((arr[new_indx, 0], np.maximum.reduceat(arr[:, 1], new_indx))).T
+
+    if ret_groups:
+        groups = np.zeros(len(arr), dtype="int")
+        groups[sort_indx] = np.cumsum(is_new) - 1
+        return merged, groups
+    else:
+        return merged
+
+
 def schmitt_threshold(arr: np.array, low_thresh: float, high_thresh: float):
     """Detect high and low states in an array using two thresholds (Schmitt trigger). Works best for bimodal data.
 
@@ -479,3 +515,95 @@ def gini(arr, eps=1e-8):
 
     # Gini coefficient:
     return (np.sum((2 * index - N - 1) * arr)) / (N * np.sum(arr))
+
+
+def circular_linear_regression(
+    phase,
+    x,
+    groups=None,
+    n_groups=None,
+    slope_bounds=(-1, 1),
+    n_slopes=1001,
+    max_elements=2**24,
+):
+    """Circular-linear regression of phase on x, computed for many groups (e.g. place fields) at once.
+
+    Slope maximizing the mean resultant length of the residuals is found on a grid, its significance is given by circular-linear correlation.
+
+    Parameters
+    ----------
+    phase : array
+        phases in radians
+    x : array
+        linear variable, e.g. position
+    groups : array of int, optional
+        group (0 ... n_groups-1) of each sample, by default None (single group)
+    n_groups : int, optional
+        number of groups, by default None (max(groups) + 1)
+    slope_bounds : tuple, optional
+        range of slopes in cycles per unit of x, by default (-1, 1)
+    n_slopes : int, optional
+        number of slopes tested, by default 1001
+    max_elements : int, optional
+        slopes are tested in chunks of at most this many (slope, sample) elements
+
+    Returns
+    -------
+    slope, phase_offset, rho, pval : arrays of length n_groups
+        slope (cycles per unit x), phase offset (radians), circular-linear correlation coefficient and its p-value, all NaN for groups without samples, rho is 0 (p-value 1) when phase or fitted phase does not vary
+
+    References
+    ----------
+    1) Kempter, R., Leibold, C., Buzsáki, G., Diba, K., & Schmidt, R. (2012). Quantifying circular–linear associations: Hippocampal phase precession. Journal of neuroscience methods, 207(1), 113-124.
+    """
+    phase, x = np.asarray(phase, dtype=float), np.asarray(x, dtype=float)
+    groups = np.zeros(len(phase), dtype=int) if groups is None else np.asarray(groups)
+    n_groups = groups.max() + 1 if n_groups is None else n_groups
+    n = np.bincount(groups, minlength=n_groups)
+    group_sum = lambda arr: np.bincount(groups, weights=arr, minlength=n_groups)
+
+    # ---- slope maximizing resultant length of residuals -------
+    slopes = np.linspace(slope_bounds[0], slope_bounds[1], n_slopes)
+    chunk = max(1, int(max_elements // max(len(phase), 1)))
+    best_r = np.full(n_groups, -np.inf)
+    slope = np.zeros(n_groups)
+    for s0 in range(0, n_slopes, chunk):
+        s = slopes[s0 : s0 + chunk]
+        residual = phase[None, :] - 2 * np.pi * s[:, None] * x[None, :]
+        rows = (np.arange(len(s))[:, None] * n_groups + groups[None, :]).ravel()
+        size = len(s) * n_groups
+        r = np.hypot(
+            np.bincount(rows, weights=np.cos(residual).ravel(), minlength=size),
+            np.bincount(rows, weights=np.sin(residual).ravel(), minlength=size),
+        ).reshape(len(s), n_groups)
+        better = r.max(axis=0) > best_r
+        best_r[better] = r.max(axis=0)[better]
+        slope[better] = s[r.argmax(axis=0)][better]
+
+    residual = phase - 2 * np.pi * slope[groups] * x
+    phase_offset = np.arctan2(group_sum(np.sin(residual)), group_sum(np.cos(residual)))
+
+    # ---- circular-linear correlation ------
+    theta = np.mod(2 * np.pi * np.abs(slope[groups]) * x, 2 * np.pi)
+    circ_mean = lambda a: np.arctan2(group_sum(np.sin(a)), group_sum(np.cos(a)))
+    sin_phase = np.sin(phase - circ_mean(phase)[groups])
+    sin_theta = np.sin(theta - circ_mean(theta)[groups])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rho = group_sum(sin_phase * sin_theta) / np.sqrt(
+            group_sum(sin_phase**2) * group_sum(sin_theta**2)
+        )
+        lambda_20 = group_sum(sin_phase**2) / n
+        lambda_02 = group_sum(sin_theta**2) / n
+        lambda_22 = group_sum(sin_phase**2 * sin_theta**2) / n
+        z = rho * np.sqrt(n * lambda_20 * lambda_02 / lambda_22)
+    pval = special.erfc(np.abs(z) / np.sqrt(2))
+
+    # no spread in phase or in fitted phase (e.g. zero slope) means no correlation
+    flat = (n > 0) & (lambda_20 * lambda_02 < np.finfo(float).eps)
+    rho[flat], pval[flat] = 0, 1
+
+    # groups without samples have no fit
+    slope[n == 0], phase_offset[n == 0] = np.nan, np.nan
+
+    return slope, phase_offset, rho, pval
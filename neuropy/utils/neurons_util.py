@@ -1,9 +1,11 @@
+import hashlib
+from collections import OrderedDict
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.cluster import KMeans, SpectralClustering, AgglomerativeClustering
 from sklearn.preprocessing import StandardScaler
 from .. import core
-from .ccg import correlograms
+from . import ccg_engine
 from typing import List, Union
 from scipy.ndimage import gaussian_filter1d
 from scipy.optimize import curve_fit
@@ -111,7 +113,7 @@ def estimate_neuron_type(
     # ---- calculate acgs -------
     acgs = np.vstack(
         [
-            calculate_neurons_acg(_, bin_size=0.0005, window_size=0.1)
+            calculate_neurons_acgs(_, bin_sizes=[0.0005], window_sizes=[0.1])[0]
             for _ in all_neurons
         ]
     )
@@ -253,6 +255,79 @@ def estimate_neuron_type(
     return np.split(neuron_type, np.cumsum(n_neurons)[:-1])
 
 
+# autocorrelograms keyed by (hash of spiketrains, sampling_rate, bin_size, window_size), least recently used entries are dropped
+_acg_cache = OrderedDict()
+_acg_cache_size = 32
+
+
+def _spiketrains_hash(neurons: core.Neurons):
+    """Digest of spike times of all neurons, changes whenever any spiketrain is edited"""
+    digest = hashlib.blake2b(digest_size=16)
+    for spiketrain in neurons.spiketrains:
+        spiketrain = np.ascontiguousarray(spiketrain, dtype="float64")
+        digest.update(np.int64(len(spiketrain)).tobytes())
+        digest.update(spiketrain.tobytes())
+    return digest.hexdigest()
+
+
+def calculate_neurons_acgs(
+    neurons: core.Neurons, bin_sizes, window_sizes, n_jobs=1, use_cache=True
+):
+    """Autocorrelograms of all neurons at several bin and window sizes computed from a single pass over packed spikes.
+
+    Results are cached by the content of spiketrains and the acg parameters, so different analyses (e.g. neuron type classification and theta modulation) requesting the same autocorrelograms do not recompute them.
+
+    Parameters
+    ----------
+    neurons : core.Neurons
+        object containing spiketrains
+    bin_sizes : list of float
+        bin sizes in seconds
+    window_sizes : list of float
+        window sizes in seconds, one for each bin size
+    n_jobs : int, optional
+        number of threads, by default 1
+    use_cache : bool, optional
+        whether to read/store results in cache, by default True
+
+    Returns
+    -------
+    list of arrays
+        n_neurons x time autocorrelograms for each (bin_size, window_size)
+    """
+    assert len(bin_sizes) == len(window_sizes), "one window_size for each bin_size"
+    spikes_hash = _spiketrains_hash(neurons) if use_cache else None
+    keys = [
+        (spikes_hash, neurons.sampling_rate, float(b), float(w))
+        for b, w in zip(bin_sizes, window_sizes)
+    ]
+
+    cached = {_: _acg_cache[_] for _ in keys if use_cache and _ in _acg_cache}
+    missing = [_ for _ in dict.fromkeys(keys) if _ not in cached]
+
+    if missing:
+        spiketimes, neuron_indx = neurons.get_packed_spikes()
+        acgs = ccg_engine.autocorrelograms(
+            spiketimes,
+            neuron_indx,
+            cluster_ids=np.arange(neurons.n_neurons),
+            sample_rate=neurons.sampling_rate,
+            bin_sizes=[_[2] for _ in missing],
+            window_sizes=[_[3] for _ in missing],
+            n_jobs=n_jobs,
+        )
+        cached.update(zip(missing, acgs))
+
+    if use_cache:
+        for key in keys:
+            _acg_cache[key] = cached[key]
+            _acg_cache.move_to_end(key)
+        while len(_acg_cache) > _acg_cache_size:
+            _acg_cache.popitem(last=False)
+
+    return [cached[_].copy() for _ in keys]
+
+
 def calculate_neurons_acg(
     neurons: core.Neurons,
     bin_size=0.001,
@@ -271,29 +346,13 @@ def calculate_neurons_acg(
         [description], by default 0.05
     """
 
-    spikes = neurons.spiketrains
-
-    correlo = []
-    for cell in spikes:
-        cell_id = np.zeros(len(cell)).astype(int)
-        acg = correlograms(
-            cell,
-            cell_id,
-            sample_rate=neurons.sampling_rate,
-            bin_size=bin_size,
-            window_size=window_size,
-        ).squeeze()
-
-        if acg.size == 0:
-            acg = np.zeros(acg.shape[-1])
-
-        correlo.append(acg)
+    return calculate_neurons_acgs(neurons, [bin_size], [window_size])[0]
 
-    return np.array(correlo)
 
-
-def calculate_neurons_ccg(neurons: core.Neurons, bin_size=0.001, window_size=0.25):
-    """_summary_
+def calculate_neurons_ccg(
+    neurons: core.Neurons, bin_size=0.001, window_size=0.25, n_jobs=1
+):
+    """Cross-correlograms between all pairs of neurons
 
     Parameters
     ----------
@@ -303,6 +362,8 @@ def calculate_neurons_ccg(neurons: core.Neurons, bin_size=0.001, window_size=0.2
         _description_, by default 0.001
     window_size : float, optional
         _description_, by default 0.25
+    n_jobs : int, optional
+        number of threads used for calculating correlograms, by default 1
 
     Returns
     -------
@@ -315,18 +376,14 @@ def calculate_neurons_ccg(neurons: core.Neurons, bin_size=0.001, window_size=0.2
     t = np.arange(window_size / bin_size + 1) * bin_size - window_size / 2
     ccgs = np.zeros((len(spikes), len(spikes), len(t))) * np.nan
     spike_ind = np.asarray([_ for _ in range(len(spikes)) if spikes[_].size != 0])
-    clus_id = np.concatenate([[_] * len(spikes[_]) for _ in range(len(spikes))]).astype(
-        int
-    )
-    sort_ind = np.argsort(np.concatenate(spikes))
-    spikes = np.concatenate(spikes)[sort_ind]
-    clus_id = clus_id[sort_ind]
-    ccgs_ = correlograms(
-        spikes,
+    spiketimes, clus_id = neurons.get_packed_spikes()
+    ccgs_ = ccg_engine.correlograms(
+        spiketimes,
         clus_id,
         sample_rate=neurons.sampling_rate,
         bin_size=bin_size,
         window_size=window_size,
+        n_jobs=n_jobs,
     )
     grid = np.ix_(spike_ind, spike_ind, np.arange(len(t)))
     ccgs[grid] = ccgs_
@@ -1,16 +1,20 @@
+import warnings
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Any
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.ndimage as filtSig
 import scipy.signal as sg
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 from scipy import fftpack, stats
+import scipy.fft as sfft
 from scipy.fftpack import next_fast_len
 from scipy.ndimage import gaussian_filter
 import seaborn as sns
-from scipy.interpolate import interp2d
+from scipy import sparse
+from scipy.integrate import trapezoid
 
 try:
     from ..plotting import Fig
@@ -125,7 +129,16 @@ class Spectrogram(core.Signal):
         spec: nfreq x nbins x nevents array containing spectrogram for each event
               ranging from -buffer_sec[0] to buffer_sec[1]"""
 
-        event_times = event_times.squeeze()
+        frames, ignore_bool = self._pe_frames(
+            event_times, buffer_sec, ignore_epochs, print_ignored_frames
+        )
+        return self._gather_pe_frames(frames, ignore_bool)
+
+    def _pe_frames(
+        self, event_times, buffer_sec, ignore_epochs=None, print_ignored_frames=True
+    ):
+        """Frame indices (n_events x n_bins) of peri-event windows, -1 for missing events and frames outside the spectrogram, and boolean array of frames within ignore_epochs"""
+        event_times = np.asarray(event_times, dtype=float).squeeze()
         assert event_times.ndim == 1, "event_times must be broadcastable to ndim=1"
 
         # Should not be necessary, keep ls - just in case
@@ -142,44 +155,40 @@ class Spectrogram(core.Signal):
                 f"Events {np.where(~keep_bool)[0]} are outside of data range and were dropped"
             )
 
-        sxx_list = []
         ntime_bins = int(np.ceil(np.sum(buffer_sec) * self.sampling_rate))
-        for t_event in event_times:
-            if not np.isnan(t_event):
-                start_time = t_event - buffer_sec[0]
-                stop_time = t_event + buffer_sec[1]
-                wvlet_temp = self.time_slice(t_start=start_time, t_stop=stop_time)
-
-                # Add/remove one frame at end if array size doesn't match expected number of time bins
-                if len(wvlet_temp.time) != ntime_bins:
-                    if len(wvlet_temp.time) == (ntime_bins + 1):
-                        stop_time -= 0.5 / self.sampling_rate
-                    elif len(wvlet_temp.time) == (ntime_bins - 1):
-                        stop_time += 0.5 / self.sampling_rate
-                    else:
-                        print("Error - time bins off by more than 1")
-                    wvlet_temp = self.time_slice(t_start=start_time, t_stop=stop_time)
-                sxx_temp = wvlet_temp.traces
-
-                # Ignore times if specified - these are likely already NaN in the spectrogram
-                if ignore_epochs is not None:
-                    time_bins = np.linspace(start_time, stop_time, ntime_bins)
-                    ignore_bool, ignore_times, _ = ignore_epochs.contains(time_bins)
-
-                    # Display ignored frames
-                    if np.sum(ignore_bool) > 0:
-                        sxx_temp[:, ignore_bool] = np.nan
-                        if print_ignored_frames:
-                            print(
-                                f"{np.sum(ignore_bool)} frames between {ignore_times.min():.1F} and {ignore_times.max():.1F} ignored (sent to nan)"
-                            )
-
-            else:  # Fill in with nans if event is missing
-                wvlet_temp = self.time_slice(t_start=1, t_stop=1 + np.sum(buffer_sec))
-                sxx_temp = np.ones_like(wvlet_temp.traces) * np.nan
-            sxx_list.append(sxx_temp)
-
-        return np.stack(sxx_list, axis=2)
+        start_times = event_times - buffer_sec[0]
+        missing = np.isnan(start_times)
+        first_frame = np.zeros(len(event_times), dtype=int)
+        first_frame[~missing] = np.floor(
+            (start_times[~missing] - self.t_start) * self.sampling_rate
+        ).astype(int)
+        frames = first_frame[:, None] + np.arange(ntime_bins)[None, :]
+        frames[missing[:, None] | (frames < 0) | (frames >= self.n_frames)] = -1
+
+        ignore_bool = np.zeros(frames.shape, dtype=bool)
+        if ignore_epochs is not None:
+            # Ignore times if specified - these are likely already NaN in the spectrogram
+            time_bins = self.t_start + frames / self.sampling_rate
+            valid = frames >= 0
+            ignore_bool[valid] = ignore_epochs.contains(time_bins[valid])[0]
+
+            # Display ignored frames
+            if print_ignored_frames:
+                for event in np.where(ignore_bool.any(axis=1))[0]:
+                    ignore_times = time_bins[event, ignore_bool[event]]
+                    print(
+                        f"{len(ignore_times)} frames between {ignore_times.min():.1F} and {ignore_times.max():.1F} ignored (sent to nan)"
+                    )
+
+        return frames, ignore_bool
+
+    def _gather_pe_frames(self, frames, ignore_bool):
+        """Spectrogram at frames (n_events x n_bins), nan for missing or ignored frames, returns n_freqs x n_bins x n_events array"""
+        dtype = np.result_type(self.traces.dtype, np.float32)
+        invalid = (frames < 0) | ignore_bool
+        sxx = np.asarray(self.traces[:, np.maximum(frames, 0)], dtype=dtype)
+        sxx[:, invalid] = np.nan
+        return np.moveaxis(sxx, 1, 2)
 
     def get_pe_mean_spec(
         self,
@@ -187,6 +196,7 @@ class Spectrogram(core.Signal):
         buffer_sec=(0.5, 0.5),
         ignore_epochs: core.Epoch = None,
         print_ignored_frames: bool = False,
+        chunk_events=500,
     ):
         """Get peri-event mean spectrogram.
 
@@ -198,18 +208,29 @@ class Spectrogram(core.Signal):
 
         ignore_epochs: core.Epoch class of epochs to ignore when calculating mean spectrogram
 
+        chunk_events: number of events gathered at a time, the mean is accumulated across chunks so that spectrograms of all events are never held in memory
+
         Returns
         -------
         Spectrogram class with traces = mean spectrogram and times ranging from -buffer_sec[0] to buffer_sec[1]
         """
 
-        # Get spectrogram for each event
-        sxx_by_event = self.get_pe_spec(
+        frames, ignore_bool = self._pe_frames(
             event_times, buffer_sec, ignore_epochs, print_ignored_frames
         )
 
-        # Take the mean
-        sxx_mean = np.nanmean(sxx_by_event, axis=2)
+        # Take the mean, ignoring nans, one chunk of events at a time
+        sxx_sum = np.zeros((len(self.freqs), frames.shape[1]))
+        sxx_count = np.zeros_like(sxx_sum)
+        for e0 in range(0, len(frames), chunk_events):
+            sxx = self._gather_pe_frames(
+                frames[e0 : e0 + chunk_events], ignore_bool[e0 : e0 + chunk_events]
+            )
+            sxx_sum += np.nansum(sxx, axis=2)
+            sxx_count += np.sum(~np.isnan(sxx), axis=2)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sxx_mean = sxx_sum / sxx_count
 
         return Spectrogram(
             sxx_mean,
@@ -316,6 +337,28 @@ def whiten(strain, interp_psd, dt):
     return white_ht
 
 
+def _morlet_kernels(freqs, fs, ncycles, nfft, max_half, n_sigma=5):
+    """FFTs (length nfft) of complex morlet wavelets centered at sample 0, each truncated to +/- n_sigma standard deviations and at most max_half samples
+
+    Returns
+    -------
+    array (n_freqs x nfft), complex64
+    """
+    kernels = np.zeros((len(freqs), nfft), dtype=np.complex64)
+    for i, f in enumerate(freqs):
+        sigma = ncycles / (2 * np.pi * f)
+        half = int(min(max_half, np.ceil(n_sigma * sigma * fs)))
+        t = np.arange(-half, half + 1) / fs
+        A = (sigma * np.sqrt(np.pi)) ** -0.5
+        wavelet = A * np.exp(-(t**2) / (2 * sigma**2)) * np.exp(2j * np.pi * f * t)
+        # negative lags wrap around to the end for circular convolution
+        wrapped = np.zeros(nfft, dtype=complex)
+        wrapped[: half + 1] = wavelet[half:]
+        wrapped[nfft - half :] = wavelet[:half]
+        kernels[i] = sfft.fft(wrapped)
+    return kernels
+
+
 class WaveletSg(Spectrogram):
     def __init__(
         self,
@@ -324,6 +367,9 @@ class WaveletSg(Spectrogram):
         norm_sig=False,
         ncycles=7,
         sigma=None,
+        freq_chunk=10,
+        block_dur=60,
+        n_jobs=1,
     ) -> None:
         """Wavelet spectrogram on core.Signal object
 
@@ -339,6 +385,12 @@ class WaveletSg(Spectrogram):
             number of cycles for wavelet,higher number gives better frequency resolution at higher frequencies, by default 7 cycles
         sigma : int, optional
             smoothing to apply on spectrum along time axis for each frequency trace, in units of seconds, by default None
+        freq_chunk : int, optional
+            number of frequencies convolved together, by default 10
+        block_dur : float, optional
+            duration (seconds) of time blocks for overlap-save convolution, by default 60
+        n_jobs : int, optional
+            number of threads over which frequency chunks are split, by default 1
 
         Suggestions/References
         ----------------------
@@ -354,38 +406,188 @@ class WaveletSg(Spectrogram):
         if norm_sig:
             trace = stats.zscore(trace)
 
-        sxx = self._wt(trace, freqs, signal.sampling_rate, ncycles)
         sampling_rate = signal.sampling_rate
+        sxx = self._wt(
+            trace,
+            np.asarray(freqs),
+            sampling_rate,
+            ncycles,
+            freq_chunk=freq_chunk,
+            block_size=int(block_dur * sampling_rate),
+            n_jobs=n_jobs,
+        )
 
         if sigma is not None:
-            # TODO it is slow for large array, maybe move to a method and use fastlen padding
             sampling_period = 1 / sampling_rate
-            sxx = filtSig.gaussian_filter1d(sxx, sigma=sigma / sampling_period, axis=-1)
+            filtSig.gaussian_filter1d(
+                sxx, sigma=sigma / sampling_period, axis=-1, output=sxx
+            )
 
         super().__init__(
             traces=sxx, freqs=freqs, sampling_rate=sampling_rate, t_start=signal.t_start
         )
 
-    def _wt(self, signal, freqs, fs, ncycles):
-        """wavelet transform"""
+    def _wt(self, signal, freqs, fs, ncycles, freq_chunk=10, block_size=None, n_jobs=1):
+        """wavelet transform amplitude (n_freqs x n_samples, float32)
+
+        The signal is convolved block by block (overlap-save). FFT of each block is shared by all frequencies, which are processed in chunks on a thread pool. Wavelets are truncated to 5 standard deviations (at most 4 seconds).
+        """
         n = len(signal)
-        fastn = next_fast_len(n)
-        signal = np.pad(signal, (0, fastn - n), "constant", constant_values=0)
-        signal = np.tile(signal, (len(freqs), 1))
-        conv_val = np.zeros((len(freqs), n), dtype=complex)
+        max_half = int(4 * fs)
+        block_size = n if block_size is None else max(min(block_size, n), 1)
+        nfft = next_fast_len(block_size + 2 * max_half)
+        block_size = nfft - 2 * max_half
+        kernels = _morlet_kernels(freqs, fs, ncycles, nfft, max_half)
+
+        # zeros beyond the signal, as in linear convolution
+        padded = np.concatenate((np.zeros(max_half), signal, np.zeros(nfft)))
+        sxx = np.zeros((len(freqs), n), dtype="float32")
+        chunks = np.arange(0, len(freqs), freq_chunk)
+
+        def convolve_chunk(sig_fft, f0, s0, s1):
+            conv = sfft.ifft(sig_fft * kernels[f0 : f0 + freq_chunk], axis=-1)
+            sxx[f0 : f0 + freq_chunk, s0:s1] = np.abs(
+                conv[:, max_half : max_half + s1 - s0]
+            )
 
-        freqs = freqs[:, np.newaxis]
-        t_wavelet = np.arange(-4, 4, 1 / fs)[np.newaxis, :]
+        with Parallel(n_jobs=n_jobs, prefer="threads") as parallel:
+            for s0 in range(0, n, block_size):
+                s1 = min(s0 + block_size, n)
+                sig_fft = sfft.fft(padded[s0 : s0 + nfft])
+                parallel(delayed(convolve_chunk)(sig_fft, f0, s0, s1) for f0 in chunks)
 
-        sigma = ncycles / (2 * np.pi * freqs)
-        A = (sigma * np.sqrt(np.pi)) ** -0.5
-        real_part = np.exp(-(t_wavelet ** 2) / (2 * sigma ** 2))
-        img_part = np.exp(2j * np.pi * (t_wavelet * freqs))
-        wavelets = A * real_part * img_part
+        return sxx
+
+
+def _freq_interp_matrix(f, freqs):
+    """Sparse matrix (len(freqs) x len(f)) which linearly interpolates spectra sampled at f to freqs, same as np.interp (nearest value outside f)"""
+    freqs = np.clip(np.asarray(freqs, dtype=float), f[0], f[-1])
+    hi = np.clip(np.searchsorted(f, freqs, side="right"), 1, len(f) - 1)
+    lo = hi - 1
+    w = (freqs - f[lo]) / (f[hi] - f[lo])
+    rows = np.repeat(np.arange(len(freqs)), 2)
+    cols = np.stack((lo, hi), axis=1).ravel()
+    vals = np.stack((1 - w, w), axis=1).ravel()
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(len(freqs), len(f)))
+
+
+def _spectrogram_windows(
+    trace, fs, nperseg, step, tapers, out, interp=None, max_elements=2**24
+):
+    """Power spectral density (same as scipy.signal.spectrogram with scaling='density') of all windows of trace, averaged across tapers.
+
+    Windows are strided views of trace, each group of windows is transformed for all tapers with a single rfft. If interp (sparse matrix from _freq_interp_matrix) is provided, each group is resampled along frequency before being written. Result is written to out (n_freqs x n_windows).
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(trace, nperseg)[::step]
+    n_tapers, n_windows = len(tapers), len(windows)
+    scale = 2 / (fs * n_tapers * np.sum(tapers**2, axis=1)[:, None, None])
+    n_group = max(1, int(max_elements // (n_tapers * nperseg)))
+
+    for w0 in range(0, n_windows, n_group):
+        x = windows[w0 : w0 + n_group]
+        x = x - x.mean(axis=1, keepdims=True)
+        psd = np.abs(sfft.rfft(x[None, :, :] * tapers[:, None, :], axis=-1)) ** 2
+        psd = np.sum(psd * scale, axis=0)
+        # one-sided density: DC (and nyquist for even nperseg) are not doubled
+        psd[:, 0] /= 2
+        if nperseg % 2 == 0:
+            psd[:, -1] /= 2
+        out[:, w0 : w0 + n_group] = psd.T if interp is None else interp @ psd.T
+
+
+def batch_spectrogram(
+    signal: core.Signal,
+    window=1,
+    overlap=0.5,
+    norm_sig=True,
+    multitaper=False,
+    NW=5,
+    n_tapers=6,
+    freqs=None,
+    channel_indx=None,
+    filename=None,
+    n_jobs=1,
+):
+    """Fourier (or multitaper) spectrograms of several channels of a signal.
+
+    All windows of a channel are taken as strided views and transformed for all tapers with one rfft per group of windows. Channels are split across a thread pool and written to a float32 array, optionally memory mapped to a .npy file for long recordings.
+
+    Parameters
+    ----------
+    signal : core.Signal
+        signal, traces can be memory mapped
+    window : float, optional
+        length of each segment in seconds, by default 1
+    overlap : float, optional
+        length of overlap between adjacent segments in seconds, by default 0.5
+    norm_sig : bool, optional
+        whether to zscore each channel, by default True
+    multitaper : bool, optional
+        whether to use dpss tapers, otherwise a tukey window as in scipy.signal.spectrogram, by default False
+    NW : float, optional
+        time-halfbandwidth product of dpss tapers, by default 5
+    n_tapers : int, optional
+        number of dpss tapers, by default 6
+    freqs : array, optional
+        frequencies (e.g. log-spaced) at which spectra are linearly interpolated, each group of windows is resampled before being written so the full spectrogram is never stored, by default None (all fft frequencies)
+    channel_indx : list, optional
+        indices of channels, by default None (all channels)
+    filename : str, optional
+        .npy file to which spectrograms are written as memmap, by default None
+    n_jobs : int, optional
+        number of threads over which channels are split, by default 1
+
+    Returns
+    -------
+    sxx : array (n_channels x n_freqs x n_windows), float32
+    f : array
+        frequencies
+    t : array
+        time of center of windows relative to signal.t_start
+
+    NOTE: same as scipy.signal.spectrogram (scaling='density', detrend='constant') averaged across tapers
+    """
+    fs = signal.sampling_rate
+    nperseg, noverlap = int(window * fs), int(overlap * fs)
+    step = nperseg - noverlap
+    assert 0 < nperseg <= signal.n_frames, "window should be shorter than signal"
+    assert step > 0, "overlap should be less than window"
+
+    if channel_indx is None:
+        channel_indx = np.arange(signal.n_channels)
+    if multitaper:
+        tapers = np.atleast_2d(sg.windows.dpss(M=nperseg, NW=NW, Kmax=n_tapers))
+    else:
+        tapers = sg.get_window(("tukey", 0.25), nperseg)[None, :]
+
+    f = sfft.rfftfreq(nperseg, 1 / fs)
+    interp = None
+    if freqs is not None:
+        interp = _freq_interp_matrix(f, freqs)
+        f = np.asarray(freqs)
+    n_windows = (signal.n_frames - nperseg) // step + 1
+    t = (nperseg / 2 + step * np.arange(n_windows)) / fs
+    shape = (len(channel_indx), len(f), n_windows)
+    if filename is None:
+        sxx = np.zeros(shape, dtype="float32")
+    else:
+        sxx = np.lib.format.open_memmap(
+            filename, mode="w+", dtype="float32", shape=shape
+        )
+
+    def channel_spectrogram(i, chan):
+        trace = np.asarray(signal.traces[chan], dtype="float")
+        if norm_sig:
+            trace = stats.zscore(trace)
+        _spectrogram_windows(trace, fs, nperseg, step, tapers, sxx[i], interp)
 
-        conv_val = sg.fftconvolve(signal, wavelets, mode="same", axes=-1)
-        conv_val = np.asarray(conv_val)[:, :n]
-        return np.abs(conv_val).astype("float32")
+    Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(channel_spectrogram)(i, chan) for i, chan in enumerate(channel_indx)
+    )
+    if filename is not None:
+        sxx.flush()
+
+    return sxx, f, t
 
 
 class FourierSg(Spectrogram):
@@ -412,7 +614,7 @@ class FourierSg(Spectrogram):
         overlap : float, optional
             length of overlap between adjacent segments, by default 0.5
         freqs : np.array
-            If provided, the spectrogram will use interpolation to evaluate at these frequencies
+            If provided, the spectrogram will use linear interpolation along frequency to evaluate at these frequencies (e.g. log-spaced)
         multitaper: bool,
             whether to use multitaper for estimation, by default False
         sigma : int, optional
@@ -427,15 +629,9 @@ class FourierSg(Spectrogram):
         if norm_sig:
             trace = stats.zscore(trace)
 
-        if multitaper:
-            sxx, f, t = self._ft(trace, signal.sampling_rate, window, overlap, mt=True)
-        else:
-            sxx, f, t = self._ft(trace, signal.sampling_rate, window, overlap)
-
-            if freqs is not None:
-                func_sxx = interp2d(t, f, sxx)
-                sxx = func_sxx(t, freqs)
-                f = freqs
+        sxx, f, t = self._ft(
+            trace, signal.sampling_rate, window, overlap, mt=multitaper, freqs=freqs
+        )
 
         sampling_rate = 1 / (t[1] - t[0])
 
@@ -451,27 +647,17 @@ class FourierSg(Spectrogram):
             t_start=signal.t_start + t[0],
         )
 
-    def _ft(self, signal, fs, window, overlap, mt=False):
+    def _ft(self, signal, fs, window, overlap, mt=False, freqs=None):
         """fourier transform"""
-        window = int(window * fs)
-        overlap = int(overlap * fs)
-
-        f = None
-        if mt:
-            tapers = sg.windows.dpss(M=window, NW=5, Kmax=6)
-
-            sxx_taper = []
-            for taper in tapers:
-                f, t, sxx = sg.spectrogram(
-                    signal, window=taper, fs=fs, noverlap=overlap
-                )
-                sxx_taper.append(sxx)
-            sxx = np.dstack(sxx_taper).mean(axis=2)
-
-        else:
-            f, t, sxx = sg.spectrogram(signal, fs=fs, nperseg=window, noverlap=overlap)
-
-        return sxx, f, t
+        sxx, f, t = batch_spectrogram(
+            core.Signal(signal[None, :], fs),
+            window=window,
+            overlap=overlap,
+            norm_sig=False,
+            multitaper=mt,
+            freqs=freqs,
+        )
+        return sxx[0], f, t
 
 
 def hilbertfast(arr, ax=-1):
@@ -494,6 +680,68 @@ def hilbertfast(arr, ax=-1):
     return hilbertsig
 
 
+def _bicoherence_sums(
+    trace,
+    nperseg,
+    noverlap,
+    nfft,
+    freq_ind,
+    single_precision=False,
+    chunk_segments=256,
+    max_elements=2**22,
+):
+    """Sums over STFT segments of triple products X(f1) X(f2) conj(X(f1+f2)) and of power, same segments as scipy.signal.stft (hann window, zero padded boundaries).
+
+    Segments are transformed chunk_segments at a time and frequencies f1 are processed in blocks, so neither the complex spectrogram nor all triple products are held in memory.
+
+    Returns
+    -------
+    triple_sum : array (n_freqs x n_freqs), complex
+    power_sum : array, sum of |X|^2 at frequencies 0 ... 2*freq_ind[-1]
+    n_segments : int
+    """
+    step = nperseg - noverlap
+    dtype = np.float32 if single_precision else np.float64
+    win = sg.get_window("hann", nperseg).astype(dtype)
+    win = win / win.sum() / nperseg
+
+    # boundary zeros and padding to an integer number of segments as in sg.stft
+    x = np.concatenate(
+        (np.zeros(nperseg // 2), trace - trace.mean(), np.zeros(nperseg // 2))
+    )
+    x = np.concatenate((x, np.zeros((-(len(x) - nperseg) % step) % nperseg)))
+    segments = np.lib.stride_tricks.sliding_window_view(x, nperseg)[::step]
+
+    n = len(freq_ind)
+    k0 = 2 * freq_ind[0]
+    n_f = 2 * freq_ind[-1] + 1
+    n_block = max(1, int(max_elements // (n * chunk_segments)))
+    triple_sum = np.zeros((n, n), dtype=complex)
+    power_sum = np.zeros(n_f)
+
+    for s0 in range(0, len(segments), chunk_segments):
+        X = sfft.rfft(segments[s0 : s0 + chunk_segments].astype(dtype) * win, n=nfft)
+        X = X.T[:n_f]
+        if len(X) < n_f:  # frequency sums beyond nyquist
+            X = np.vstack((X, np.zeros((n_f - len(X), X.shape[1]), dtype=X.dtype)))
+        power_sum += np.sum(np.abs(X) ** 2, axis=1)
+
+        X_f = X[freq_ind]
+        # X_f1f2[i, :, j] is X at freq_ind[i] + freq_ind[j] (contiguous frequencies)
+        X_f1f2 = np.lib.stride_tricks.sliding_window_view(
+            X[k0 : k0 + 2 * n - 1], n, axis=0
+        )
+        for i0 in range(0, n, n_block):
+            triple_sum[i0 : i0 + n_block] += np.einsum(
+                "is,js,isj->ij",
+                X_f[i0 : i0 + n_block],
+                X_f,
+                np.conjugate(X_f1f2[i0 : i0 + n_block]),
+            )
+
+    return triple_sum, power_sum, len(segments)
+
+
 @dataclass
 class bicoherence:
 
@@ -505,6 +753,9 @@ class bicoherence:
         fhigh: int, highest frequency
         window: int, segment size
         noverlap:
+        n_jobs: int, number of processes over which channels are split
+        single_precision: bool, use float32/complex64 for fourier transforms and triple products
+        chunk_segments: int, number of STFT segments transformed at a time
 
         bicoher (freq_req x freq_req, array): bicoherence matrix
         freq {array}: frequencies at which bicoherence was calculated
@@ -528,6 +779,9 @@ class bicoherence:
     fs: int = 1250
     window: int = 4 * 1250
     overlap: int = 2 * 1250
+    n_jobs: int = 1
+    single_precision: bool = False
+    chunk_segments: int = 256
 
     def compute(self, signal: np.array):
         """Computes bicoherence
@@ -542,71 +796,49 @@ class bicoherence:
         if signal.ndim == 1:
             signal = signal[np.newaxis, :]
 
-        # ----- subtracting mean and complex spectrogram -------------
-        signal = signal - np.mean(signal, axis=-1, keepdims=True)  # zero mean
-        f, _, sxx = sg.stft(
-            signal,
-            window="hann",
-            nperseg=self.window,
-            noverlap=self.overlap,
-            fs=self.fs,
-            # mode="complex",
-            nfft=fftpack.next_fast_len(self.window),
-            # detrend=False,
-            # scaling="spectrum",
-        )
-        sxx = np.require(sxx, dtype=complex)
-        sxx = sxx / self.window  # scaling the fourier transform
-
         # ------ Getting required frequencies and their indices -------------
+        nfft = fftpack.next_fast_len(self.window)
+        f = sfft.rfftfreq(nfft, 1 / self.fs)
         freq_ind = np.where((f > self.flow) & (f < self.fhigh))[0]
         freq_req = f[freq_ind]
 
         """ ===========================================
         bispectrum = |mean( X(f1) * X(f2) * conj(X(f1+f2)) )|
-        normalization = sqrt( mean(|X(f1) * X(f2)|^2) * mean(|X(f1+f2)|^2) )
+        normalization = sqrt( mean(|X(f1)|^2) * mean(|X(f2)|^2) * mean(|X(f1+f2)|^2) )
 
         where,
-            X is complex spectrogram
-            P is real/absolute square spectrogram
+            X is complex spectrogram, sums over segments are accumulated for each channel in a separate process
         ================================================="""
 
-        X_f2 = sxx[:, freq_ind, :]  # complex spectrogram of required frequencies
-        P_f2 = np.abs(X_f2) ** 2  # absolute square of spectrogram
-
-        def bicoh_product(f_ind):
-            X_f1 = sxx[:, f_ind, np.newaxis, :]
-            X_f1f2 = sxx[:, freq_ind + f_ind, :]
-
-            # ----- bispectrum triple product --------------
-            bispec_freq = np.mean((X_f1 * X_f2) * np.conjugate(X_f1f2), axis=-1)
-
-            # ----- normalization to calculate bicoherence ---------
-            P_f1 = np.abs(X_f1) ** 2
-            P_f1f2 = np.abs(X_f1f2) ** 2
-            norm = np.sqrt(
-                np.mean(P_f1, axis=-1)
-                * np.mean(P_f2, axis=-1)
-                * np.mean(P_f1f2, axis=-1)
+        sums = Parallel(n_jobs=self.n_jobs)(
+            delayed(_bicoherence_sums)(
+                np.asarray(trace, dtype="float"),
+                self.window,
+                self.overlap,
+                nfft,
+                freq_ind,
+                self.single_precision,
+                self.chunk_segments,
             )
-            # norm = np.sqrt(
-            #     np.mean(np.abs(X_f1 * X_f2) ** 2, axis=-1) * np.mean(P_f1f2, axis=-1)
-            # )
-
-            return bispec_freq / norm
-
-        bispec = Parallel(n_jobs=10, require="sharedmem")(
-            delayed(bicoh_product)(f_ind) for f_ind in freq_ind
+            for trace in signal
         )
-
-        bispec = np.dstack(bispec)
+        n_segments = sums[0][2]
+        bispec = np.stack([_[0] for _ in sums]) / n_segments
+        power = np.stack([_[1] for _ in sums]) / n_segments
+
+        # ----- normalization to calculate bicoherence ---------
+        P_f = power[:, freq_ind]
+        P_f1f2 = power[:, freq_ind[:, None] + freq_ind[None, :]]
+        norm = np.sqrt(P_f[:, :, None] * P_f[:, None, :] * P_f1f2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            bispec = bispec / norm
         bicoher = np.abs(bispec)
 
         self.bicoher = bicoher.squeeze()
         self.bispec = bispec.squeeze()
         self.freq = freq_req
         self.freq_ind = freq_ind
-        self.dof = 2 * sxx.shape[-1]
+        self.dof = 2 * n_segments
         self.significance = np.sqrt(6 / self.dof)  # 95 percentile
 
         return bicoher
@@ -646,12 +878,69 @@ class bicoherence:
         cb.outline.set_linewidth(0.5)
 
 
-def power_correlation(signal, fs=1250, window=2, overlap=1, fband=None):
+def _spectral_moments(
+    trace,
+    fs,
+    nperseg,
+    step,
+    tapers,
+    freq_indx,
+    window_labels,
+    n_labels,
+    products=True,
+    max_elements=2**24,
+):
+    """Number of windows, sum (n_labels x n_freqs) and sum of outer products (n_labels x n_freqs x n_freqs) of the spectra of windows with each label.
+
+    Groups of windows are transformed for all tapers by _spectrogram_windows and reduced right away, so the spectrogram is never stored. Windows labelled -1 are skipped, products are not accumulated if products=False.
+    """
+    n_freqs = len(freq_indx)
+    select = sparse.csr_matrix(
+        (np.ones(n_freqs), (np.arange(n_freqs), freq_indx)),
+        shape=(n_freqs, nperseg // 2 + 1),
+    )
+    counts = np.zeros(n_labels)
+    sums = np.zeros((n_labels, n_freqs))
+    prods = np.zeros((n_labels, n_freqs, n_freqs)) if products else None
+
+    n_group = max(1, int(max_elements // (len(tapers) * nperseg)))
+    out = np.zeros((n_freqs, n_group))
+    for w0 in range(0, len(window_labels), n_group):
+        labels = window_labels[w0 : w0 + n_group]
+        if np.all(labels < 0):
+            continue
+        n = len(labels)
+        segment = trace[w0 * step : (w0 + n - 1) * step + nperseg]
+        _spectrogram_windows(segment, fs, nperseg, step, tapers, out[:, :n], select)
+        for label in np.unique(labels[labels >= 0]):
+            x = out[:, :n][:, labels == label]
+            counts[label] += x.shape[1]
+            sums[label] += x.sum(axis=1)
+            if products:
+                prods[label] += x @ x.T
+
+    return counts, sums, prods
+
+
+def _moments_corrcoef(counts, sums, prods):
+    """Correlation matrices (n_labels x n_freqs x n_freqs) from the output of _spectral_moments"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sums / counts[:, None]
+        cov = prods / counts[:, None, None] - mean[:, :, None] * mean[:, None, :]
+        std = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        return cov / (std[:, :, None] * std[:, None, :])
+
+
+def power_correlation(
+    signal, fs=1250, window=2, overlap=1, fband=None, multitaper=False
+):
     """Power power correlation between frequencies
 
+    Spectra of all windows are computed with batched ffts and only sums and cross products across windows are kept, so the spectrogram is never stored.
+
     Parameters
     ----------
-    signal : [type]
+    signal : array
         timeseries for which to calculate
     fs : int, optional
         sampling frequency of the signal, by default 1250
@@ -659,36 +948,201 @@ def power_correlation(signal, fs=1250, window=2, overlap=1, fband=None):
         window size for calculating spectrogram, by default 2
     overlap : int, optional
         overlap between adjacent windows, by default 1
-    fband : [type], optional
-        return correlations between these frequencies only, by default None
+    fband : tuple, optional
+        (low, high) return correlations between these frequencies only, by default None
+    multitaper : bool, optional
+        whether to use dpss tapers (NW=5, 6 tapers), otherwise a tukey window as in scipy.signal.spectrogram, by default False
 
     Returns
     -------
-    [type]
-        [description]
+    f_req : array
+        frequencies
+    corr_freq : array (n_freqs x n_freqs)
+        correlation between power at each pair of frequencies, diagonal is set to 0
     """
-    f, t, sxx = sg.spectrogram(
-        signal, fs=fs, nperseg=int(window * fs), noverlap=(overlap * fs)
-    )
+    signal = np.asarray(signal, dtype=float)
+    nperseg, noverlap = int(window * fs), int(overlap * fs)
+    step = nperseg - noverlap
+    assert 0 < nperseg <= len(signal), "window should be shorter than signal"
+    assert step > 0, "overlap should be less than window"
+
+    if multitaper:
+        tapers = np.atleast_2d(sg.windows.dpss(M=nperseg, NW=5, Kmax=6))
+    else:
+        tapers = sg.get_window(("tukey", 0.25), nperseg)[None, :]
+
+    f = sfft.rfftfreq(nperseg, 1 / fs)
     if fband is not None:
         assert len(fband) == 2, "fband length should of length of 2"
-        f_req_ind = np.where((1 < f) & (f < 100))[0]
-        f_req = f[f_req_ind]
-        corr_freq = np.corrcoef(sxx[f_req_ind, :])
+        f_req_ind = np.where((f >= fband[0]) & (f <= fband[1]))[0]
     else:
-        corr_freq = np.corrcoef(sxx)
-
+        f_req_ind = np.arange(len(f))
+    f_req = f[f_req_ind]
+
+    n_windows = (len(signal) - nperseg) // step + 1
+    window_labels = np.zeros(n_windows, dtype=int)
+    corr_freq = _moments_corrcoef(
+        *_spectral_moments(
+            signal, fs, nperseg, step, tapers, f_req_ind, window_labels, 1
+        )
+    )[0]
     np.fill_diagonal(corr_freq, val=0)
 
     return f_req, corr_freq
 
 
+@lru_cache(maxsize=32)
+def _icsd_inverse(coords, method="spline", diam=500, cond=0.3, n_grid=2000):
+    """Inverse of the forward matrix F (lfp = F @ csd) of inverse CSD (Pettersen et al. 2006) for contacts at coords, cached for each geometry.
+
+    CSD is assumed to be a disc of diameter diam (um), either constant within the half distances to neighboring contacts ('step') or a natural cubic spline through contacts that goes to zero one spacing beyond the outermost contacts ('spline').
+
+    Parameters
+    ----------
+    coords : tuple
+        increasing depth of contacts in um
+    method : str, optional
+        'spline' or 'step', by default 'spline'
+    diam : float, optional
+        diameter (um) of the cylinder of current sources, by default 500
+    cond : float, optional
+        extracellular conductivity (S/m), by default 0.3
+
+    Returns
+    -------
+    array (n_contacts x n_contacts)
+    """
+    from scipy.interpolate import CubicSpline
+
+    z = np.asarray(coords, dtype=float) * 1e-6
+    n, radius = len(z), diam * 1e-6 / 2
+    spacing = np.diff(z)
+    edges = np.concatenate(
+        ([z[0] - spacing[0] / 2], z[:-1] + spacing / 2, [z[-1] + spacing[-1] / 2])
+    )
+
+    if method == "step":
+        grid = np.linspace(edges[0], edges[-1], n_grid)
+        basis = (grid[None, :] >= edges[:-1, None]) & (grid[None, :] < edges[1:, None])
+        basis[-1, -1] = True
+    else:
+        knots = np.concatenate(([z[0] - spacing[0]], z, [z[-1] + spacing[-1]]))
+        grid = np.linspace(knots[0], knots[-1], n_grid)
+        unit = np.vstack((np.zeros(n), np.eye(n), np.zeros(n)))
+        basis = CubicSpline(knots, unit, bc_type="natural")(grid).T
+
+    dist = np.abs(z[:, None] - grid[None, :])
+    kernel = np.sqrt(dist**2 + radius**2) - dist
+    forward = trapezoid(kernel[:, None, :] * basis[None, :, :], x=grid, axis=-1)
+
+    return np.linalg.inv(forward / (2 * cond))
+
+
+def event_triggered_csd(
+    signal,
+    probegroup: core.ProbeGroup,
+    event_times,
+    window=(-0.1, 0.1),
+    method="spline",
+    diam=500,
+    cond=0.3,
+    connected_only=True,
+    chunk_events=500,
+):
+    """Event-triggered average lfp and current source density of each shank.
+
+    Event-locked lfp of all shanks is gathered chunk_events at a time straight from the (memory mapped) traces and summed, so events are never all held in memory. Contacts of each shank are ordered by depth using probegroup coordinates.
+
+    Parameters
+    ----------
+    signal : core.Signal or BinarysignalIO
+        lfp, rows are matched to probegroup by channel_id
+    probegroup : core.ProbeGroup
+        probe geometry
+    event_times : array
+        times of events in seconds (e.g. ripple or sharp wave peaks)
+    window : tuple, optional
+        time (seconds) before and after each event, by default (-0.1, 0.1)
+    method : str, optional
+        'classic', 'spline' or 'step', by default 'spline'
+    diam, cond : float, optional
+        source diameter (um) and conductivity (S/m) for inverse CSD, see _icsd_inverse
+    connected_only : bool, optional
+        use only connected channels, by default True
+    chunk_events : int, optional
+        number of events gathered at a time, by default 500
+
+    Returns
+    -------
+    dict
+        Csd (with lfp, csdmap, csd_coords and time relative to events) for each shank_id. Contacts of a shank at the same depth are averaged, chan_label then holds the channels averaged at each depth
+    """
+    if not isinstance(signal, core.Signal):
+        signal = signal.get_signal()  # memory mapped traces of BinarysignalIO
+    fs = signal.sampling_rate
+
+    probe_df = probegroup.to_dataframe()
+    if connected_only:
+        probe_df = probe_df[probe_df["connected"] == True]
+    probe_df = probe_df[np.isin(probe_df.channel_id, signal.channel_id)]
+    probe_df = probe_df.sort_values(by=["shank_id", "y"], ascending=[True, False])
+    row_of_channel = {c: i for i, c in enumerate(signal.channel_id)}
+    rows = np.array([row_of_channel[c] for c in probe_df.channel_id])
+
+    # ---- events completely within the signal -------
+    frame_offsets = np.arange(int(window[0] * fs), int(window[1] * fs) + 1)
+    first_frames = np.floor((np.asarray(event_times) - signal.t_start) * fs).astype(int)
+    first_frames = first_frames[
+        (first_frames + frame_offsets[0] >= 0)
+        & (first_frames + frame_offsets[-1] < signal.n_frames)
+    ]
+    assert len(first_frames) > 0, "no events within signal"
+
+    lfp_sum = np.zeros((len(rows), len(frame_offsets)))
+    for e0 in range(0, len(first_frames), chunk_events):
+        frames = first_frames[e0 : e0 + chunk_events, None] + frame_offsets[None, :]
+        lfp_sum += np.sum(signal.traces[rows[:, None, None], frames[None]], axis=1)
+    mean_lfp = lfp_sum / len(first_frames)
+
+    csds = {}
+    for shank_id in probe_df.shank_id.unique():
+        indx = np.where(probe_df.shank_id.values == shank_id)[0]
+        # contacts at the same depth (e.g. multi-column shanks) are averaged
+        depths, depth_indx = np.unique(probe_df.y.values[indx], return_inverse=True)
+        depths, depth_indx = depths[::-1], len(depths) - 1 - depth_indx.ravel()
+        chans = probe_df.channel_id.values[indx]
+        if len(depths) < len(indx):
+            avg = (depth_indx[None, :] == np.arange(len(depths))[:, None]).astype(float)
+            lfp = (avg / avg.sum(axis=1, keepdims=True)) @ mean_lfp[indx]
+            depth_chans = np.empty(len(depths), dtype=object)
+            for d in range(len(depths)):
+                depth_chans[d] = chans[depth_indx == d]
+            chans = depth_chans
+        else:
+            lfp = mean_lfp[indx]
+        csd = Csd(
+            lfp=lfp,
+            coords=depths,
+            chan_label=chans,
+            fs=fs,
+            time=frame_offsets / fs,
+        )
+        if method == "classic":
+            csd.classic()
+        else:
+            csd.icsd(method=method, diam=diam, cond=cond)
+        csds[shank_id] = csd
+
+    return csds
+
+
 @dataclass
 class Csd:
     lfp: np.array
     coords: np.array
     chan_label: np.array = None
     fs: int = 1250
+    time: np.array = None
 
     def classic(self):
         coords = self.coords.copy()
@@ -696,10 +1150,38 @@ class Csd:
         csd = -(self.lfp[:-2, :] - 2 * self.lfp[1:-1, :] + self.lfp[2:, :])
         self.csdmap = stats.zscore(csd, axis=None)
         self.csd_coords = coords[1:-1]
-        self.time = np.linspace(-1, 1, nframes) * (nframes / self.fs)
+        if self.time is None:
+            self.time = np.linspace(-1, 1, nframes) * (nframes / self.fs)
+
+    def icsd(self, method="spline", diam=500, cond=0.3):
+        """Inverse current source density (Pettersen et al. 2006) at each contact, inverse matrices are cached for each contact geometry
+
+        Parameters
+        ----------
+        method : str, optional
+            'spline' or 'step', by default 'spline'
+        diam : float, optional
+            diameter of current sources in um (same units as coords), by default 500
+        cond : float, optional
+            extracellular conductivity in S/m, by default 0.3
+        """
+        assert method in ["spline", "step"], "method should be 'spline' or 'step'"
+        assert len(np.unique(self.coords)) == len(
+            self.coords
+        ), "contacts should be at unique depths, average contacts at the same depth first"
+        order = np.argsort(self.coords)
+        inverse = _icsd_inverse(
+            tuple(np.asarray(self.coords, dtype=float)[order]), method, diam, cond
+        )
+        csd = np.zeros(self.lfp.shape)
+        csd[order] = inverse @ np.asarray(self.lfp, dtype=float)[order]
 
-    def icsd(self, lfp, coords):
-        pass
+        # sources are positive, as in classic
+        self.csdmap = csd
+        self.csd_coords = np.asarray(self.coords).copy()
+        if self.time is None:
+            nframes = self.lfp.shape[1]
+            self.time = np.linspace(-1, 1, nframes) * (nframes / self.fs)
 
     def plot(self, ax=None, smooth=3, plotLFP=False, **kwargs):
         if smooth is not None:
@@ -725,19 +1207,116 @@ class Csd:
             ax.plot(self.time, lfp.T + self.coords, "gray", lw=1)
 
 
-def mtspect(signal, nperseg, noverlap, fs=1250):
-    window = nperseg
-    overlap = noverlap
+def mtspect(signal, nperseg, noverlap, fs=1250, NW=5, n_tapers=6):
+    """Multitaper power spectral density, same as scipy.signal.welch averaged across dpss tapers.
+
+    All windows are transformed for all tapers with batched ffts instead of one welch call per taper.
 
-    tapers = sg.windows.dpss(M=window, NW=5, Kmax=6)
+    Parameters
+    ----------
+    signal : array
+        timeseries, spectra are calculated along last axis
+    nperseg : int
+        length of each segment in samples
+    noverlap : int
+        overlap between adjacent segments in samples
+    fs : int, optional
+        sampling frequency of the signal, by default 1250
+    NW : float, optional
+        time-halfbandwidth product of dpss tapers, by default 5
+    n_tapers : int, optional
+        number of dpss tapers, by default 6
 
-    psd_taper = []
-    for taper in tapers:
-        f, psd = sg.welch(signal, window=taper, fs=fs, noverlap=overlap)
-        psd_taper.append(psd)
-    psd = np.asarray(psd_taper).mean(axis=0)
+    Returns
+    -------
+    f : array
+        frequencies
+    psd : array (..., n_freqs)
+        power spectral density
+    """
+    signal = np.asarray(signal, dtype=float)
+    nperseg = int(nperseg)
+    step = nperseg - int(noverlap)
+    assert 0 < nperseg <= signal.shape[-1], "nperseg should be shorter than signal"
+    assert step > 0, "noverlap should be less than nperseg"
+
+    tapers = np.atleast_2d(sg.windows.dpss(M=nperseg, NW=NW, Kmax=n_tapers))
+    f = sfft.rfftfreq(nperseg, 1 / fs)
+    freq_indx = np.arange(len(f))
+    window_labels = np.zeros((signal.shape[-1] - nperseg) // step + 1, dtype=int)
+
+    traces = signal.reshape(-1, signal.shape[-1])
+    psd = np.zeros((len(traces), len(f)))
+    for i, trace in enumerate(traces):
+        counts, sums, _ = _spectral_moments(
+            trace, fs, nperseg, step, tapers, freq_indx, window_labels, 1, False
+        )
+        psd[i] = sums[0] / counts[0]
 
-    return f, psd
+    return f, psd.reshape(signal.shape[:-1] + (len(f),))
+
+
+def _pac_band_features(trace, fs, phase_bands, amp_bands, n_bins):
+    """Phase bin (n_phase_bands x n_frames) and hilbert amplitude (n_amp_bands x n_frames, float32) of each band, every band is filtered once"""
+    trace = np.asarray(trace, dtype=float)
+    phase_bins = np.zeros((len(phase_bands), len(trace)), dtype=np.int16)
+    for i, (lf, hf) in enumerate(phase_bands):
+        hil = hilbertfast(filter_sig.bandpass(trace, lf=lf, hf=hf, fs=fs))
+        angle = np.angle(hil, deg=True) + 180
+        phase_bins[i] = np.minimum((angle * n_bins / 360).astype(int), n_bins - 1)
+
+    amps = np.zeros((len(amp_bands), len(trace)), dtype=np.float32)
+    for i, (lf, hf) in enumerate(amp_bands):
+        amps[i] = np.abs(hilbertfast(filter_sig.bandpass(trace, lf=lf, hf=hf, fs=fs)))
+
+    return phase_bins, amps
+
+
+def _tort_mi(phase_bins, amps, n_bins, max_elements=2**24):
+    """Tort et al. (2010) modulation index for every (phase band, amplitude band) pair, mean amplitudes in phase bins are accumulated with bincount over chunks of frames
+
+    Returns
+    -------
+    array (n_phase_bands x n_amp_bands)
+    """
+    n_amp, n_frames = amps.shape
+    n_chunk = max(1, int(max_elements // n_amp))
+    amp_rows = np.arange(n_amp)[:, None] * n_bins
+
+    sums = np.zeros((len(phase_bins), n_amp * n_bins))
+    counts = np.zeros((len(phase_bins), n_bins))
+    for t0 in range(0, n_frames, n_chunk):
+        amp = amps[:, t0 : t0 + n_chunk].ravel()
+        for p, bins in enumerate(phase_bins[:, t0 : t0 + n_chunk]):
+            sums[p] += np.bincount(
+                (amp_rows + bins[None, :]).ravel(),
+                weights=amp,
+                minlength=n_amp * n_bins,
+            )
+            counts[p] += np.bincount(bins, minlength=n_bins)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_amp = sums.reshape(-1, n_amp, n_bins) / counts[:, None, :]
+        mean_amp = np.nan_to_num(mean_amp)
+        prob = mean_amp / mean_amp.sum(axis=-1, keepdims=True)
+        entropy = -np.nansum(prob * np.log(prob), axis=-1)
+
+    return (np.log(n_bins) - entropy) / np.log(n_bins)
+
+
+def _pac_comodulogram(phase_bins, amps, frames, n_bins, n_shuffles, min_shift, seed):
+    """Modulation indices within frames and those of n_shuffles surrogates in which amplitudes are circularly shifted (at least min_shift frames) relative to phases"""
+    phase_bins, amps = phase_bins[:, frames], amps[:, frames]
+    mi = _tort_mi(phase_bins, amps, n_bins)
+
+    rng = np.random.default_rng(seed)
+    n_frames = phase_bins.shape[1]
+    shifts = rng.integers(min_shift, n_frames - min_shift + 1, size=n_shuffles)
+    mi_shuffle = np.zeros((n_shuffles,) + mi.shape)
+    for i, shift in enumerate(shifts):
+        mi_shuffle[i] = _tort_mi(np.roll(phase_bins, shift, axis=1), amps, n_bins)
+
+    return mi, mi_shuffle
 
 
 @dataclass
@@ -779,11 +1358,147 @@ class PAC:
 
         self.pac = mean_amplfp / np.sum(mean_amplfp)
 
-    def comodulo(self, lfp, method="tort", njobs=5):
-        """comodulogram for frequencies of interest"""
+    def band_features(self, signal: core.Signal, phase_bands, amp_bands, n_jobs=1):
+        """Hilbert phase bins and amplitudes of phase and amplitude bands for each channel, can be passed to comodulo to reuse filtered bands across calls
+
+        Parameters
+        ----------
+        signal : core.Signal
+            lfp
+        phase_bands : array (n_phase_bands x 2)
+            low and high frequencies of phase bands
+        amp_bands : array (n_amp_bands x 2)
+            low and high frequencies of amplitude bands
+        n_jobs : int, optional
+            number of processes, by default 1
+
+        Returns
+        -------
+        list
+            (phase bins, amplitudes) for each channel
+        """
+        phase_bands = np.asarray(phase_bands, dtype=float).reshape(-1, 2)
+        amp_bands = np.asarray(amp_bands, dtype=float).reshape(-1, 2)
+        fs, n_bins = signal.sampling_rate, 360 // self.binsz
+        return Parallel(n_jobs=n_jobs)(
+            delayed(_pac_band_features)(trace, fs, phase_bands, amp_bands, n_bins)
+            for trace in signal.traces
+        )
 
-        if method == "tort":
-            phase_lfp = filter_sig.bandpass(lfp, lf=4, hf=5)
+    def comodulo(
+        self,
+        signal: core.Signal,
+        phase_bands,
+        amp_bands,
+        epochs: core.Epoch = None,
+        n_shuffles=0,
+        min_shift=1,
+        method="tort",
+        n_jobs=1,
+        seed=None,
+        features=None,
+    ):
+        """Comodulogram (Tort et al. 2010) for all pairs of phase and amplitude bands, for each channel and each state.
+
+        Every band is filtered once per channel. Filtered bands can be computed once with band_features and passed as features, so repeated calls with different epochs or shuffles on the same signal skip filtering. Modulation indices of all band pairs are calculated with bincounts over phase bins. Channels and states are split across a process pool.
+
+        Parameters
+        ----------
+        signal : core.Signal
+            lfp, one comodulogram for each channel
+        phase_bands : array (n_phase_bands x 2)
+            low and high frequencies of phase bands, e.g. np.stack((np.arange(2, 14, 1), np.arange(4, 16, 1)), axis=1)
+        amp_bands : array (n_amp_bands x 2)
+            low and high frequencies of amplitude bands
+        epochs : core.Epoch, optional
+            states, one comodulogram is calculated for each label using frames within its epochs, by default None (all frames)
+        n_shuffles : int, optional
+            number of surrogates with amplitudes circularly shifted relative to phases, by default 0
+        min_shift : float, optional
+            minimum circular shift in seconds, by default 1
+        method : str, optional
+            only 'tort' is available, by default 'tort'
+        n_jobs : int, optional
+            number of processes, by default 1
+        seed : int, optional
+            seed for shuffles, by default None
+        features : list, optional
+            output of band_features for the same signal and bands, by default None (bands are filtered)
+
+        Returns
+        -------
+        array (n_channels x n_states x n_phase_bands x n_amp_bands)
+            modulation indices, also stored in self.comodulogram. If n_shuffles > 0, p-values and z-scores relative to surrogates are stored in self.comodulogram_pval and self.comodulogram_zscore
+        """
+        assert method == "tort", "only tort method is implemented"
+        assert isinstance(signal, core.Signal), "signal should be core.Signal object"
+        phase_bands = np.asarray(phase_bands, dtype=float).reshape(-1, 2)
+        amp_bands = np.asarray(amp_bands, dtype=float).reshape(-1, 2)
+        fs, n_bins = signal.sampling_rate, 360 // self.binsz
+
+        # ----- filtered bands for each channel ------
+        if features is None:
+            features = self.band_features(signal, phase_bands, amp_bands, n_jobs)
+        assert len(features) == signal.n_channels, "features should be for each channel"
+        for phase_bins, amps in features:
+            assert phase_bins.shape == (len(phase_bands), signal.n_frames) and (
+                amps.shape == (len(amp_bands), signal.n_frames)
+            ), "features do not match signal or bands"
+
+        # ----- frames of each state -------
+        if epochs is None:
+            states = ["all"]
+            state_frames = [np.arange(signal.n_frames)]
+        else:
+            epochs_df = epochs.to_dataframe().sort_values(by="start")
+            states = list(epochs_df.label.unique())
+            t = signal.t_start + np.arange(signal.n_frames) / fs
+            state_frames = []
+            for state in states:
+                starts, stops = epochs_df[epochs_df.label == state][
+                    ["start", "stop"]
+                ].values.T
+                indx = np.searchsorted(starts, t, side="right") - 1
+                state_frames.append(
+                    np.where((indx >= 0) & (t <= stops[np.maximum(indx, 0)]))[0]
+                )
+
+        if n_shuffles > 0:
+            assert all(
+                len(_) > 2 * int(min_shift * fs) for _ in state_frames
+            ), "min_shift is too long for the frames of some states"
+        seeds = np.random.SeedSequence(seed).spawn(len(features) * len(states))
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(_pac_comodulogram)(
+                phase_bins,
+                amps,
+                frames,
+                n_bins,
+                n_shuffles,
+                int(min_shift * fs),
+                seeds[c * len(states) + i],
+            )
+            for c, (phase_bins, amps) in enumerate(features)
+            for i, frames in enumerate(state_frames)
+        )
+
+        shape = (len(features), len(states), len(phase_bands), len(amp_bands))
+        self.comodulogram = np.array([_[0] for _ in results]).reshape(shape)
+        self.comodulo_states = states
+        self.comodulo_phase_bands = phase_bands
+        self.comodulo_amp_bands = amp_bands
+        if n_shuffles > 0:
+            mi_shuffle = np.array([_[1] for _ in results])
+            mi_shuffle = mi_shuffle.reshape(shape[:2] + (n_shuffles,) + shape[2:])
+            mi = self.comodulogram[:, :, None]
+            self.comodulogram_pval = (1 + np.sum(mi_shuffle >= mi, axis=2)) / (
+                n_shuffles + 1
+            )
+            self.comodulogram_zscore = (
+                self.comodulogram - mi_shuffle.mean(axis=2)
+            ) / mi_shuffle.std(axis=2)
+
+        return self.comodulogram
 
     def plot(self, ax=None, **kwargs):
         """Bar plot for phase amplitude coupling
@@ -816,6 +1531,38 @@ class PAC:
         return ax
 
 
+def _gather_segments(arr, starts, stops):
+    """Values of arr[start:stop] for all segments concatenated along with length of each segment"""
+    lengths = stops - starts
+    offsets = np.cumsum(lengths) - lengths
+    indx = np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+    return arr[indx], lengths, offsets
+
+
+def _segment_argmin(values, lengths, offsets):
+    """Index (relative to segment start) of first minimum in each non-empty segment of concatenated values"""
+    seg_min = np.minimum.reduceat(values, offsets)
+    is_min = np.flatnonzero(values == np.repeat(seg_min, lengths))
+    seg = np.searchsorted(offsets, is_min, side="right") - 1
+    first = is_min[np.searchsorted(seg, np.arange(len(lengths)))]
+    return first - offsets
+
+
+def _level_crossings(arr, starts, stops, level, last=False):
+    """First (or last) sign change of arr[start:stop] - level within each segment, NaN if there is none"""
+    seg, lengths, offsets = _gather_segments(arr, starts, stops)
+    seg_id = np.repeat(np.arange(len(lengths)), lengths)
+    sign = np.sign(seg - level[seg_id])
+    change = np.flatnonzero(
+        (sign[1:] != sign[:-1]) & (seg_id[1:] == seg_id[:-1])
+    )
+    segs, first = np.unique(seg_id[change], return_index=True)
+    pick = np.append(first[1:], len(change)) - 1 if last else first
+    crossings = np.full(len(lengths), np.nan)
+    crossings[segs] = change[pick] - offsets[segs] + starts[segs]
+    return crossings
+
+
 @dataclass
 class ThetaParams:
     """Estimating various theta oscillation features like phase, asymmetry etc.
@@ -835,6 +1582,7 @@ class ThetaParams:
         eegSrate = self.fs
 
         peak, trough, theta_amp, theta_360, thetalfp = 5 * [None]
+        cycle_mean = None
         if self.method == "hilbert":
             thetalfp = filter_sig.bandpass(self.lfp, lf=1, hf=25)
             hil_theta = hilbertfast(thetalfp)
@@ -852,26 +1600,13 @@ class ThetaParams:
             distance = int(0.08 * self.fs)
 
             peak = sg.find_peaks(thetalfp, height=0, distance=distance)[0]
-            trough = stats.binned_statistic(
-                np.arange(len(thetalfp)), thetalfp, bins=peak, statistic=np.argmin
-            )[0]
-            trough = peak[:-1] + trough
 
-            def get_desc(arr):
-                arr = stats.zscore(arr)
-                return np.where(np.diff(np.sign(arr)))[0][0]
+            # ---- trough and zero crossings within each peak to peak cycle -----
+            cycle, lengths, offsets = _gather_segments(thetalfp, peak[:-1], peak[1:])
+            trough = peak[:-1] + _segment_argmin(cycle, lengths, offsets)
 
-            def get_asc(arr):
-                arr = stats.zscore(arr)
-                return np.where(np.diff(np.sign(arr)))[0][-1]
-
-            zero_up = stats.binned_statistic(
-                np.arange(len(thetalfp)), thetalfp, bins=peak, statistic=get_asc
-            )[0]
-
-            zero_down = stats.binned_statistic(
-                np.arange(len(thetalfp)), thetalfp, bins=peak, statistic=get_desc
-            )[0]
+            # zero crossings are relative to the mean of the peak to peak cycle around each trough
+            cycle_mean = np.add.reduceat(cycle, offsets) / lengths
 
             # ---- linear interpolation of angles ---------
             loc = np.concatenate((trough, peak))
@@ -898,9 +1633,19 @@ class ThetaParams:
             peak = peak[1:]
         if trough[-1] > peak[-1]:
             trough = trough[:-1]
+            if cycle_mean is not None:
+                cycle_mean = cycle_mean[:-1]
 
         assert len(trough) == len(peak)
 
+        # ---- zero crossings aligned with rise_mid and fall_mid ------
+        zero_up, zero_down = None, None
+        if cycle_mean is not None:
+            zero_up = _level_crossings(thetalfp, trough, peak, cycle_mean, last=True)
+            zero_down = _level_crossings(
+                thetalfp, peak[:-1], trough[1:], cycle_mean[1:]
+            )
+
         rising_time = (peak[1:] - trough[1:]) / eegSrate
         falling_time = (trough[1:] - peak[:-1]) / eegSrate
 
@@ -911,51 +1656,24 @@ class ThetaParams:
         self.lfp_filtered = thetalfp
         self.rise_time = rising_time
         self.fall_time = falling_time
+        self.zero_up = zero_up
+        self.zero_down = zero_down
+
+    def _half_amplitude_points(self, starts, stops):
+        """In each segment, point closest to the midpoint between max and min of the segment"""
+        seg, lengths, offsets = _gather_segments(self.lfp_filtered, starts, stops)
+        seg_max = np.maximum.reduceat(seg, offsets)
+        seg_min = np.minimum.reduceat(seg, offsets)
+        target = np.repeat((seg_max + seg_min) / 2, lengths)
+        return starts + _segment_argmin(np.abs(seg - target), lengths, offsets)
 
     @property
     def rise_mid(self):
-        theta_trough = self.trough
-        theta_peak = self.peak
-        thetalfp = self.lfp_filtered
-        rise_midpoints = np.array(
-            [
-                trough
-                + np.argmin(
-                    np.abs(
-                        thetalfp[trough:peak]
-                        - (
-                            max(thetalfp[trough:peak])
-                            - np.ptp(thetalfp[trough:peak]) / 2
-                        )
-                    )
-                )
-                for (trough, peak) in zip(theta_trough, theta_peak)
-            ]
-        )
-        return rise_midpoints
+        return self._half_amplitude_points(self.trough, self.peak)
 
     @property
     def fall_mid(self):
-        theta_peak = self.peak
-        theta_trough = self.trough
-        thetalfp = self.lfp_filtered
-        fall_midpoints = np.array(
-            [
-                peak
-                + np.argmin(
-                    np.abs(
-                        thetalfp[peak:trough]
-                        - (
-                            max(thetalfp[peak:trough])
-                            - np.ptp(thetalfp[peak:trough]) / 2
-                        )
-                    )
-                )
-                for (peak, trough) in zip(theta_peak[:-1], theta_trough[1:])
-            ]
-        )
-
-        return fall_midpoints
+        return self._half_amplitude_points(self.peak[:-1], self.trough[1:])
 
     @property
     def peak_width(self):
@@ -1068,21 +1786,17 @@ def psd_auc(signal: core.Signal, freq_band: tuple, window=10, overlap=5):
     ), "signal should be a neuropy.core.Signal object"
 
     fs = signal.sampling_rate
-    aucChans = []
-    for sig in signal.traces:
-        f, pxx = sg.welch(
-            stats.zscore(sig),
-            fs=fs,
-            nperseg=int(window * fs),
-            noverlap=int(overlap * fs),
-            axis=-1,
-        )
-        f_theta = np.where((f > freq_band[0]) & (f < freq_band[1]))[0]
-        area_in_freq = np.trapz(pxx[f_theta], x=f[f_theta])
-
-        aucChans.append(area_in_freq)
+    f, pxx = sg.welch(
+        stats.zscore(signal.traces, axis=-1),
+        fs=fs,
+        nperseg=int(window * fs),
+        noverlap=int(overlap * fs),
+        axis=-1,
+    )
+    f_theta = np.where((f > freq_band[0]) & (f < freq_band[1]))[0]
+    aucChans = trapezoid(pxx[:, f_theta], x=f[f_theta], axis=-1)
 
-    return aucChans
+    return list(aucChans)
 
 
 def hilbert_amplitude_stat(signals, freq_band, fs, statistic="mean"):
@@ -1108,6 +1822,12 @@ def hilbert_amplitude_stat(signals, freq_band, fs, statistic="mean"):
     if statistic == "std":
         get_stat = lambda x: np.std(x)
 
+    if isinstance(signals, np.ndarray) and signals.ndim == 2:
+        # all channels filtered together
+        filtered = filter_sig.bandpass(signals, lf=freq_band[0], hf=freq_band[1], fs=fs)
+        amplitude_envelope = np.abs(hilbertfast(filtered))
+        return np.array([get_stat(_) for _ in amplitude_envelope])
+
     bandpower_stat = np.zeros(len(signals))
     for i, sig in enumerate(signals):
         filtered = filter_sig.bandpass(sig, lf=freq_band[0], hf=freq_band[1], fs=fs)
@@ -1117,6 +1837,131 @@ def hilbert_amplitude_stat(signals, freq_band, fs, statistic="mean"):
     return bandpower_stat
 
 
+def band_power_survey(
+    signal,
+    bands,
+    window=1,
+    method="hilbert",
+    statistic="mean",
+    psd_window=0.5,
+    norm_sig=True,
+    channel_indx=None,
+    block_dur=60,
+    n_jobs=1,
+):
+    """Band power of many channels in consecutive windows for several frequency bands, e.g. to select channels for ripple/theta detection.
+
+    Signal is read block by block (blocks are a multiple of window, with margins for filter edges), so memory mapped recordings are never fully loaded. All selected channels of a block are filtered together and the hilbert transform has the same (fast) length for every block. Blocks are split across a thread pool.
+
+    Parameters
+    ----------
+    signal : core.Signal or BinarysignalIO
+        multi-channel signal
+    bands : list of tuples
+        (low, high) frequencies of each band
+    window : float, optional
+        duration of windows in seconds, by default 1
+    method : str, optional
+        'hilbert': statistic of hilbert amplitude of bandpassed signal (as in hilbert_amplitude_stat),
+        'psd': area under Welch power spectrum within band (as in psd_auc), by default 'hilbert'
+    statistic : str, optional
+        'mean', 'median' or 'std' of hilbert amplitude within each window, by default 'mean'
+    psd_window : float, optional
+        length of Welch segments (50% overlap) within each window for method='psd', by default 0.5 seconds
+    norm_sig : bool, optional
+        whether to zscore each channel (statistics from a first pass over blocks), by default True
+    channel_indx : list, optional
+        indices of channels, by default None (all channels)
+    block_dur : float, optional
+        approximate duration of blocks in seconds, by default 60
+    n_jobs : int, optional
+        number of threads, by default 1
+
+    Returns
+    -------
+    power : array (n_channels x n_bands x n_windows), float32
+    t : array
+        center of each window in seconds, relative to start of signal
+    """
+    assert method in ["hilbert", "psd"], "method should be 'hilbert' or 'psd'"
+    assert statistic in ["mean", "median", "std"], "statistic should be mean/median/std"
+    bands = np.asarray(bands, dtype=float).reshape(-1, 2)
+    fs = signal.sampling_rate
+    if channel_indx is None:
+        channel_indx = np.arange(signal.n_channels)
+    channel_indx = list(np.asarray(channel_indx).reshape(-1))
+
+    if isinstance(signal, core.Signal):
+        read = lambda f1, f2: np.asarray(signal.traces[channel_indx, f1:f2], "float")
+    else:
+        read = lambda f1, f2: np.asarray(
+            signal.frame_slice(channel_indx, f1, f2).traces, "float"
+        )
+
+    win = int(window * fs)
+    n_frames = signal.n_frames
+    n_windows = n_frames // win
+    assert n_windows > 0, "signal is shorter than window"
+    block = max(1, int(block_dur * fs) // win) * win
+    block_starts = np.arange(0, n_windows * win, block)
+    margin = int(np.ceil(max(1, 10 / bands[:, 0].min()) * fs))
+    if method == "psd":
+        margin = 0
+    nfft = next_fast_len(block + 2 * margin)
+
+    # ---- zscore statistics accumulated over blocks -------
+    mean, std = np.zeros((len(channel_indx), 1)), np.ones((len(channel_indx), 1))
+    if norm_sig:
+
+        def block_sums(f1):
+            x = read(f1, f1 + block)
+            return x.sum(axis=1), np.sum(x**2, axis=1)
+
+        sums = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(block_sums)(f1) for f1 in np.arange(0, n_frames, block)
+        )
+        mean = np.sum([_[0] for _ in sums], axis=0)[:, None] / n_frames
+        std = np.sqrt(
+            np.sum([_[1] for _ in sums], axis=0)[:, None] / n_frames - mean**2
+        )
+
+    get_stat = dict(mean=np.mean, median=np.median, std=np.std)[statistic]
+    power = np.zeros((len(channel_indx), len(bands), n_windows), dtype="float32")
+
+    def block_power(b0):
+        b1 = min(b0 + block, n_windows * win)
+        f1, f2 = max(b0 - margin, 0), min(b1 + margin, n_frames)
+        x = (read(f1, f2) - mean) / std
+        w0, nwin = b0 // win, (b1 - b0) // win
+
+        if method == "hilbert":
+            for j, (lf, hf) in enumerate(bands):
+                filtered = filter_sig.bandpass(x, lf=lf, hf=hf, fs=fs)
+                amp = np.abs(sg.hilbert(filtered, N=nfft, axis=-1))
+                amp = amp[:, b0 - f1 : b1 - f1].reshape(len(x), nwin, win)
+                power[:, j, w0 : w0 + nwin] = get_stat(amp, axis=-1)
+        else:
+            seg = int(psd_window * fs)
+            segments = np.lib.stride_tricks.sliding_window_view(
+                x.reshape(len(x), nwin, win), seg, axis=-1
+            )[..., :: max(seg // 2, 1), :]
+            taper = sg.get_window("hann", seg)
+            f = sfft.rfftfreq(seg, 1 / fs)
+            psd = _segments_psd(segments, fs, taper, len(f)).mean(axis=-2)
+            for j, (lf, hf) in enumerate(bands):
+                f_band = np.where((f > lf) & (f < hf))[0]
+                power[:, j, w0 : w0 + nwin] = trapezoid(
+                    psd[..., f_band], x=f[f_band], axis=-1
+                )
+
+    Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(block_power)(b0) for b0 in block_starts
+    )
+    t = (np.arange(n_windows) + 0.5) * window
+
+    return power, t
+
+
 def theta_phase_specfic_extraction(signal, y, fs, binsize=20, slideby=None):
     """Breaks y into theta phase specific components
 
@@ -1325,41 +2170,312 @@ def irasa(
     psd_osc = np.compress(~mask_freqs, psd_osc, axis=-1)
 
     if return_fit:
-        # Aperiodic fit in semilog space for each channel
-        from scipy.optimize import curve_fit
+        return (
+            freqs,
+            psd_aperiodic,
+            psd_osc,
+            _irasa_fit(freqs, psd_aperiodic, psd_osc, ch_names),
+        )
+    else:
+        return freqs, psd_aperiodic, psd_osc
+
+
+def _irasa_fit(freqs, psd_aperiodic, psd_osc, ch_names):
+    """Aperiodic fit in semilog space for each channel, see irasa"""
+    from scipy.optimize import curve_fit
 
-        intercepts, slopes, r_squared = [], [], []
+    intercepts, slopes, r_squared = [], [], []
 
-        def func(t, a, b):
-            # See https://github.com/fooof-tools/fooof
-            return a + np.log(t ** b)
+    def func(t, a, b):
+        # See https://github.com/fooof-tools/fooof
+        return a + np.log(t ** b)
 
-        for y in np.atleast_2d(psd_aperiodic):
-            y_log = np.log(y)
-            # Note that here we define bounds for the slope but not for the
-            # intercept.
-            popt, pcov = curve_fit(
-                func, freqs, y_log, p0=(2, -1), bounds=((-np.inf, -10), (np.inf, 2))
+    for y in np.atleast_2d(psd_aperiodic):
+        y_log = np.log(y)
+        # Note that here we define bounds for the slope but not for the
+        # intercept.
+        popt, pcov = curve_fit(
+            func, freqs, y_log, p0=(2, -1), bounds=((-np.inf, -10), (np.inf, 2))
+        )
+        intercepts.append(popt[0])
+        slopes.append(popt[1])
+        # Calculate R^2: https://stackoverflow.com/q/19189362/10581531
+        residuals = y_log - func(freqs, *popt)
+        ss_res = np.sum(residuals ** 2)
+        ss_tot = np.sum((y_log - np.mean(y_log)) ** 2)
+        r_squared.append(1 - (ss_res / ss_tot))
+
+    # Create fit parameters dataframe
+    fit_params = {
+        "Chan": ch_names,
+        "Intercept": intercepts,
+        "Slope": slopes,
+        "R^2": r_squared,
+        "std(osc)": np.std(psd_osc, axis=-1, ddof=1),
+    }
+    return pd.DataFrame(fit_params)
+
+
+def _median_bias(n):
+    """Bias of median of n chi-square (2 dof) estimates relative to their mean, as used by scipy.signal.welch"""
+    ii_2 = 2 * np.arange(1.0, (n - 1) // 2 + 1)
+    return 1 + np.sum(1.0 / (ii_2 + 1) - 1.0 / ii_2)
+
+
+def _segments_psd(segments, fs, taper, n_freqs):
+    """One-sided power spectral density (same scaling as scipy.signal.welch) of each segment (last axis), constant detrended and tapered, first n_freqs frequencies"""
+    nperseg = segments.shape[-1]
+    x = segments - segments.mean(axis=-1, keepdims=True)
+    psd = np.abs(sfft.rfft(x * taper, axis=-1)[..., :n_freqs]) ** 2
+    psd *= 2 / (fs * np.sum(taper**2))
+    psd[..., 0] /= 2
+    if nperseg % 2 == 0 and n_freqs == nperseg // 2 + 1:
+        psd[..., -1] /= 2
+    return psd
+
+
+def _irasa_resampling(win, hset):
+    """For each h in hset, integer factors (up, down) and number of source samples that are resampled by h and 1/h to obtain win samples plus a margin covering the resample_poly filter"""
+    import fractions
+
+    factors = []
+    for h in hset:
+        # Get the upsampling/downsampling (h, 1/h) factors as integer
+        rat = fractions.Fraction(str(h))
+        up, down = rat.numerator, rat.denominator
+        margin = int(np.ceil(10 * max(up, down) / min(up, down))) + 2
+        n_up = int(np.ceil(win / h)) + 2 * margin
+        n_down = int(np.ceil(win * h)) + 2 * margin
+        factors.append((up, down, n_up, n_down))
+    return factors
+
+
+def _irasa_windows(
+    traces,
+    centers,
+    fs,
+    win,
+    hset,
+    n_freqs,
+    taper,
+    average="median",
+    max_elements=2**23,
+):
+    """Original and resampled (geometric mean of h and 1/h) power spectra of windows centered at frames centers, averaged across windows.
+
+    Centers are grouped into blocks of nearby windows. Each block is resampled once by every h and 1/h and all its windows are taken from the resampled block, so overlapping windows share resampled samples. A block spans at most max_elements samples after resampling and never bridges gaps longer than the extended segment of a window.
+
+    Returns
+    -------
+    psd : array (n_channels x n_freqs)
+    psds : array (n_hset x n_channels x n_freqs)
+    """
+    traces = np.atleast_2d(traces)
+    n_chans = traces.shape[0]
+    factors = _irasa_resampling(win, hset)
+    ext = max(win, max(_[3] for _ in factors))
+    step = np.min(np.diff(centers)) if len(centers) > 1 else win
+    n_chunk = max(1, int((max_elements / (n_chans * 2 * np.max(hset)) - ext) // step))
+
+    # ---- blocks of windows that are resampled together ------
+    edges = np.where(np.diff(centers) > ext)[0] + 1
+    edges = np.concatenate(([0], edges, [len(centers)]))
+    blocks = [
+        (w0, min(w0 + n_chunk, e1))
+        for e0, e1 in zip(edges[:-1], edges[1:])
+        for w0 in range(e0, e1, n_chunk)
+    ]
+
+    def windows(x, starts):
+        """win samples of x (n_channels x n_samples) from each start"""
+        return x[:, starts[:, None] + np.arange(win)[None, :]]
+
+    psd = np.zeros((n_chans, len(centers), n_freqs))
+    psds_up = np.zeros((len(hset), n_chans, len(centers), n_freqs))
+    psds_down = np.zeros_like(psds_up)
+    for w0, w1 in blocks:
+        c = centers[w0:w1]
+        s0 = c[0] - ext // 2
+        block = np.asarray(traces[:, s0 : c[-1] + ext // 2 + 1], dtype="float")
+        psd[:, w0:w1] = _segments_psd(
+            windows(block, c - s0 - win // 2), fs, taper, n_freqs
+        )
+
+        for i, (h, (up, down, _, _)) in enumerate(zip(hset, factors)):
+            # sample k of a resampled block is at source frame s0 + k * down / up
+            block_up = sg.resample_poly(block, up, down, axis=-1)
+            block_down = sg.resample_poly(block, down, up, axis=-1)
+            starts_up = np.round((c - s0) * h).astype(int) - win // 2
+            starts_down = np.round((c - s0) / h).astype(int) - win // 2
+            psds_up[i, :, w0:w1] = _segments_psd(
+                windows(block_up, starts_up), h * fs, taper, n_freqs
+            )
+            psds_down[i, :, w0:w1] = _segments_psd(
+                windows(block_down, starts_down), fs / h, taper, n_freqs
             )
-            intercepts.append(popt[0])
-            slopes.append(popt[1])
-            # Calculate R^2: https://stackoverflow.com/q/19189362/10581531
-            residuals = y_log - func(freqs, *popt)
-            ss_res = np.sum(residuals ** 2)
-            ss_tot = np.sum((y_log - np.mean(y_log)) ** 2)
-            r_squared.append(1 - (ss_res / ss_tot))
-
-        # Create fit parameters dataframe
-        fit_params = {
-            "Chan": ch_names,
-            "Intercept": intercepts,
-            "Slope": slopes,
-            "R^2": r_squared,
-            "std(osc)": np.std(psd_osc, axis=-1, ddof=1),
-        }
-        return freqs, psd_aperiodic, psd_osc, pd.DataFrame(fit_params)
+
+    if average == "median":
+        bias = _median_bias(len(centers))
+        average = lambda p: np.median(p, axis=-2) / bias
     else:
-        return freqs, psd_aperiodic, psd_osc
+        average = lambda p: np.mean(p, axis=-2)
+
+    # Geometric mean of h and 1/h
+    return average(psd), np.sqrt(average(psds_up) * average(psds_down))
+
+
+def irasa_epochs(
+    signal: core.Signal,
+    epochs: core.Epoch = None,
+    band=(1, 30),
+    hset=np.arange(1.1, 1.95, 0.05),
+    win_sec=4,
+    overlap_sec=2,
+    window="hamming",
+    average="median",
+    channel_indx=None,
+    return_fit=False,
+    n_jobs=1,
+):
+    """IRASA (see irasa) computed on Welch windows for many channels and for each epoch label (e.g. brain state) in one call.
+
+    Windows whose extended segment (window plus resampling margins) lies entirely within epochs of a label are used for that label. Nearby windows are resampled together by every h and 1/h, so on a whole signal the cost is about the same as irasa. The gain is that all channels and states are handled in one call, with groups of channels and labels split across a process pool. States without any window get NaN spectra.
+
+    Parameters
+    ----------
+    signal : core.Signal
+        signal, traces can be memory mapped
+    epochs : core.Epoch, optional
+        epochs whose labels define states, by default None (whole signal)
+    band : tuple, optional
+        broad band frequency range, by default (1, 30)
+    hset : array, optional
+        resampling factors, by default 1.1 to 1.9 in steps of 0.05
+    win_sec : float, optional
+        length of Welch windows in seconds, by default 4
+    overlap_sec : float, optional
+        overlap between Welch windows in seconds, by default 2
+    window : str, optional
+        taper, by default 'hamming'
+    average : str, optional
+        'median' or 'mean' across windows, by default 'median'
+    channel_indx : list, optional
+        indices of channels, by default None (all channels)
+    return_fit : bool, optional
+        whether to fit the aperiodic component for each channel and state, by default False
+    n_jobs : int, optional
+        number of processes, by default 1
+
+    Returns
+    -------
+    freqs : array
+    psd_aperiodic : array (n_states x n_channels x n_freqs)
+    psd_oscillatory : array (n_states x n_channels x n_freqs)
+    states : list
+        label of each state
+    n_windows : array (n_states,)
+        number of windows used for each state
+    fit_params : pd.DataFrame (optional)
+        fit parameters of each channel and state, only if return_fit=True
+    """
+    fs = signal.sampling_rate
+    hset = np.round(np.asarray(hset), 4)  # avoid float precision error with np.arange.
+    assert hset.ndim == 1 and hset.size > 1, "2 or more resampling fators are required."
+    band = sorted(band)
+    assert band[0] > 0, "first element of band must be > 0."
+    assert band[1] < (fs / 2), "second element of band must be < (sf / 2)."
+    assert average in ["median", "mean"], "average should be 'median' or 'mean'"
+
+    win = int(win_sec * fs)
+    step = win - int(overlap_sec * fs)
+    assert step > 0, "overlap_sec should be less than win_sec"
+    ext = max(win, max(_[3] for _ in _irasa_resampling(win, hset)))
+    freqs = sfft.rfftfreq(win, 1 / fs)
+    n_freqs = np.searchsorted(freqs, band[1], side="right")
+    taper = sg.get_window(window, win)
+
+    if channel_indx is None:
+        channel_indx = np.arange(signal.n_channels)
+    channel_indx = np.asarray(channel_indx)
+
+    # ----- windows of each state ---------
+    if epochs is None:
+        states = ["all"]
+        bounds = [np.array([[0, signal.n_frames]])]
+    else:
+        epochs_df = epochs.to_dataframe()
+        states = list(epochs_df.label.unique())
+        bounds = [
+            (
+                (
+                    epochs_df[epochs_df.label == state][["start", "stop"]].values
+                    - signal.t_start
+                )
+                * fs
+            ).astype(int)
+            for state in states
+        ]
+    state_centers = []
+    for state, state_bounds in zip(states, bounds):
+        centers = [
+            np.arange(
+                max(start, 0) + ext // 2, min(stop, signal.n_frames) - ext // 2, step
+            )
+            for start, stop in state_bounds
+        ]
+        centers = np.sort(np.concatenate(centers)).astype(int)
+        if len(centers) == 0:
+            warnings.warn(
+                f"epochs of {state} are too short for win_sec and hset, its spectra are NaN"
+            )
+        state_centers.append(centers)
+    n_windows = np.array([len(_) for _ in state_centers])
+    assert n_windows.sum() > 0, "epochs are too short for win_sec and hset"
+
+    # ----- states and groups of channels in parallel -------
+    chan_groups = np.array_split(
+        channel_indx, min(effective_n_jobs(n_jobs), len(channel_indx))
+    )
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_irasa_windows)(
+            signal.traces[chans], centers, fs, win, hset, n_freqs, taper, average
+        )
+        for centers in state_centers
+        if len(centers) > 0
+        for chans in chan_groups
+    )
+    valid = n_windows > 0
+    psd = np.full((len(states), len(channel_indx), n_freqs), np.nan)
+    psds = np.full((len(hset),) + psd.shape, np.nan)
+    psd[valid] = np.concatenate([_[0] for _ in results]).reshape(
+        valid.sum(), len(channel_indx), -1
+    )
+    psds[:, valid] = np.concatenate([_[1] for _ in results], axis=1).reshape(
+        len(hset), valid.sum(), len(channel_indx), -1
+    )
+
+    # median across resampling factors gives the aperiodic component
+    psd_aperiodic = np.median(psds, axis=0)
+    psd_osc = psd - psd_aperiodic
+
+    mask_freqs = (freqs[:n_freqs] >= band[0]) & (freqs[:n_freqs] <= band[1])
+    freqs = freqs[:n_freqs][mask_freqs]
+    psd_aperiodic, psd_osc = psd_aperiodic[..., mask_freqs], psd_osc[..., mask_freqs]
+
+    if return_fit:
+        fit_params = pd.concat(
+            [
+                _irasa_fit(freqs, ap, osc, signal.channel_id[channel_indx]).assign(
+                    State=state
+                )
+                for state, ap, osc, n in zip(states, psd_aperiodic, psd_osc, n_windows)
+                if n > 0
+            ],
+            ignore_index=True,
+        )
+        return freqs, psd_aperiodic, psd_osc, states, n_windows, fit_params
+    else:
+        return freqs, psd_aperiodic, psd_osc, states, n_windows
 
 
 def plot_miniscope_noise(
@@ -0,0 +1,121 @@
+"""Frequency-frequency power correlations for each brain state.
+
+Spectra of all windows of a channel are computed for all tapers with batched
+ffts (`signal_process._spectrogram_windows`) and reduced on the fly into
+sums and cross products for the state of each window. Correlation matrices
+for every state are then obtained from a single pass over the signal,
+without storing the spectrogram or repeating it for each state.
+"""
+
+import numpy as np
+import scipy.fft as sfft
+import scipy.signal as sg
+from joblib import Parallel, delayed
+
+from .. import core
+from .signal_process import _spectral_moments, _moments_corrcoef
+
+
+def _window_states(epochs: core.Epoch, n_windows, nperseg, step, fs, t_start=0):
+    """State index of each window (-1 if the window is not entirely within epochs) and list of states"""
+    window_states = -np.ones(n_windows, dtype=int)
+    if epochs is None:
+        window_states[:] = 0
+        return window_states, ["all"]
+
+    epochs_df = epochs.to_dataframe()
+    states = list(epochs_df.label.unique())
+    for i, state in enumerate(states):
+        bounds = epochs_df[epochs_df.label == state][["start", "stop"]].values
+        bounds = ((bounds - t_start) * fs).astype(int)
+        first = np.ceil(np.maximum(bounds[:, 0], 0) / step).astype(int)
+        last = np.minimum((bounds[:, 1] - nperseg) // step, n_windows - 1)
+        for w0, w1 in zip(first, last):
+            window_states[w0 : w1 + 1] = i
+
+    return window_states, states
+
+
+def power_correlation_by_state(
+    signal: core.Signal,
+    epochs: core.Epoch = None,
+    window=2,
+    overlap=1,
+    fband=(1, 100),
+    multitaper=True,
+    NW=5,
+    n_tapers=6,
+    channel_indx=None,
+    n_jobs=1,
+):
+    """Power power correlation between frequencies for each epoch label (e.g. brain state).
+
+    Spectrogram windows are laid out once over the whole signal and each window that lies entirely within epochs of a label is used for that label. Channels are split across a thread pool.
+
+    Parameters
+    ----------
+    signal : core.Signal
+        signal, traces can be memory mapped
+    epochs : core.Epoch, optional
+        epochs whose labels define states, by default None (whole signal)
+    window : float, optional
+        length of each segment in seconds, by default 2
+    overlap : float, optional
+        length of overlap between adjacent segments in seconds, by default 1
+    fband : tuple, optional
+        correlations are calculated between these frequencies only, by default (1, 100)
+    multitaper : bool, optional
+        whether to use dpss tapers, otherwise a tukey window as in scipy.signal.spectrogram, by default True
+    NW : float, optional
+        time-halfbandwidth product of dpss tapers, by default 5
+    n_tapers : int, optional
+        number of dpss tapers, by default 6
+    channel_indx : list, optional
+        indices of channels, by default None (all channels)
+    n_jobs : int, optional
+        number of threads over which channels are split, by default 1
+
+    Returns
+    -------
+    freqs : array
+    corr : array (n_states x n_channels x n_freqs x n_freqs)
+        correlation between power at each pair of frequencies, diagonal is set to 0
+    states : list
+        label of each state
+    n_windows : array (n_states,)
+        number of windows used for each state
+    """
+    fs = signal.sampling_rate
+    nperseg, noverlap = int(window * fs), int(overlap * fs)
+    step = nperseg - noverlap
+    assert 0 < nperseg <= signal.n_frames, "window should be shorter than signal"
+    assert step > 0, "overlap should be less than window"
+    assert len(fband) == 2, "fband length should of length of 2"
+
+    if channel_indx is None:
+        channel_indx = np.arange(signal.n_channels)
+    if multitaper:
+        tapers = np.atleast_2d(sg.windows.dpss(M=nperseg, NW=NW, Kmax=n_tapers))
+    else:
+        tapers = sg.get_window(("tukey", 0.25), nperseg)[None, :]
+
+    f = sfft.rfftfreq(nperseg, 1 / fs)
+    freq_indx = np.where((f >= fband[0]) & (f <= fband[1]))[0]
+    n_windows = (signal.n_frames - nperseg) // step + 1
+    window_states, states = _window_states(
+        epochs, n_windows, nperseg, step, fs, signal.t_start
+    )
+
+    def channel_moments(chan):
+        trace = np.asarray(signal.traces[chan], dtype="float")
+        return _spectral_moments(
+            trace, fs, nperseg, step, tapers, freq_indx, window_states, len(states)
+        )
+
+    moments = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(channel_moments)(chan) for chan in channel_indx
+    )
+    corr = np.stack([_moments_corrcoef(*_) for _ in moments], axis=1)
+    corr[..., np.arange(len(freq_indx)), np.arange(len(freq_indx))] = 0
+
+    return f[freq_indx], corr, states, moments[0][0].astype(int)
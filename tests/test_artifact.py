@@ -0,0 +1,26 @@
+import numpy as np
+from neuropy.core import Epoch, Signal
+from neuropy.analyses import detect_artifact_epochs
+
+
+def test_artifact_flat_channel():
+    rng = np.random.default_rng(0)
+    fs = 1000
+    traces = rng.standard_normal((4, fs * 60))
+    # disconnected channel, flat except for small deviations in a few frames
+    traces[0] = 0
+    traces[0, rng.choice(fs * 60, 300, replace=False)] = 0.1
+    traces[1, 20 * fs : 21 * fs] += 50
+    signal = Signal(traces, fs)
+
+    for combine in ["or", "vote", "mean"]:
+        epochs, mask = detect_artifact_epochs(
+            signal, 8, 5, 1, combine=combine, min_votes=1, return_mask=True
+        )
+        assert epochs.n_epochs == 1
+        start, stop = epochs.as_array()[0]
+        assert 19.5 < start <= 20 and 21 <= stop < 21.5
+
+        unpacked = np.unpackbits(mask, count=signal.n_frames).astype(bool)
+        mask_epochs = Epoch.from_boolean_array(unpacked, t=signal.time)
+        assert np.allclose(mask_epochs.as_array(), epochs.as_array(), atol=2 / fs)
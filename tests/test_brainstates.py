@@ -0,0 +1,112 @@
+import numpy as np
+from neuropy.analyses.brainstates import _refine_rem_after_wake
+
+
+def test_refine_rem_after_wake():
+    states = np.random.choice(
+        ["AW", "QW", "NOISE", "REM", "NREM", ""],
+        size=2000,
+        p=[0.3, 0.2, 0.05, 0.3, 0.1, 0.05],
+    ).astype("U5")
+    n_indx = 4
+
+    expected = states.copy()
+    for rem_indx in np.where(expected == "REM")[0]:
+        start_indx = np.max([0, rem_indx - n_indx])
+        wk_bool = np.isin(expected[start_indx:rem_indx], ["AW", "QW", "NOISE"])
+        if wk_bool.sum() >= n_indx:
+            expected[rem_indx] = "QW"
+
+    assert np.all(_refine_rem_after_wake(states, n_indx) == expected)
+
+
+def test_emg_corr_windows():
+    from neuropy.analyses.brainstates import _emg_corr_windows
+    from neuropy.utils.signal_process import filter_sig
+
+    rng = np.random.default_rng(0)
+    fs, n_chans = 1250, 6
+    traces = rng.standard_normal((n_chans, fs * 30)) + rng.standard_normal(fs * 30)
+    pairs_bool = rng.random((n_chans, n_chans)) < 0.6
+    ii, jj = np.nonzero(np.tril(pairs_bool, k=-1))
+    yf = filter_sig.bandpass(traces, lf=300, hf=600, fs=fs)
+
+    for n_window, hop in [(1250, 1250), (1250, 314), (1252, 1250)]:
+        n_windows = (traces.shape[1] - n_window) // hop + 1
+        expected = [
+            np.corrcoef(yf[:, w * hop : w * hop + n_window])[ii, jj].mean()
+            for w in range(n_windows)
+        ]
+        corr = _emg_corr_windows(
+            traces, fs, n_window, hop, n_windows, pairs_bool, block_dur=7
+        )
+        assert np.allclose(corr, expected, atol=1e-3)
+
+
+def test_online_brainstate_classifier():
+    from neuropy import core
+    from neuropy.analyses.brainstates import (
+        OnlineBrainstateClassifier,
+        detect_brainstates_epochs,
+    )
+
+    # alternating 60 s of "sleep" (delta) and "wake" (theta, correlated high frequencies)
+    rng = np.random.default_rng(0)
+    fs, n_frames = 1250, 1250 * 600
+    t = np.arange(n_frames) / fs
+    wake = (t // 60) % 2 == 1
+    common = rng.standard_normal(n_frames)
+    wake_lfp = 3 * np.sin(2 * np.pi * 7 * t) + 2 * common
+    sleep_lfp = 3 * np.sin(2 * np.pi * 2 * t) + 0.5 * common
+    traces = rng.standard_normal((4, n_frames)) + np.where(wake, wake_lfp, sleep_lfp)
+    signal = core.Signal(traces, fs)
+
+    epochs = detect_brainstates_epochs(signal, 0, 1, None, chunk_dur=60)
+    clf = OnlineBrainstateClassifier(epochs.metadata, fs, signal.channel_id)
+    results, f0 = [], 0
+    for block_size in rng.integers(100, 5000, n_frames // 100):
+        results += clf.update(traces[:, f0 : f0 + block_size])
+        f0 += block_size
+        if f0 >= n_frames:
+            break
+    times = np.array([_[0] for _ in results])
+    states = np.array([_[1] for _ in results])
+    assert np.allclose(times, np.arange(1, 600))
+
+    # frame-interleaved 1D blocks of another size give the same states
+    clf = OnlineBrainstateClassifier(epochs.metadata, fs, signal.channel_id)
+    interleaved = traces.T.ravel()
+    states_1d = [
+        state
+        for f0 in range(0, n_frames, 3000)
+        for _, state in clf.update(interleaved[f0 * 4 : (f0 + 3000) * 4])
+    ]
+    assert np.array_equal(states_1d, states)
+
+    # away from transitions (causal smoothing lags), wake and sleep are recovered
+    settled = (times % 60) > 30
+    is_wake = np.isin(states, ["AW", "QW"])
+    assert np.mean(is_wake[settled] == ((times[settled] // 60) % 2 == 1)) > 0.9
+    assert not np.any(states[:50] == "NOISE")
+
+
+def test_emg_from_lfp():
+    from neuropy import core
+    from neuropy.analyses.brainstates import emg_from_LFP
+    from neuropy.utils.signal_process import filter_sig
+
+    rng = np.random.default_rng(1)
+    fs, n_chans = 1250, 4
+    traces = rng.standard_normal((n_chans, fs * 40)) + rng.standard_normal(fs * 40)
+    signal = core.Signal(traces, fs)
+    yf = filter_sig.bandpass(traces, lf=300, hf=600, fs=fs)
+    ii, jj = np.tril_indices(n_chans, k=-1)
+
+    emg = emg_from_LFP(signal, window=2, overlap=1)
+    expected = [
+        np.corrcoef(yf[:, w * fs : w * fs + 2 * fs])[ii, jj].mean()
+        for w in range(len(emg))
+    ]
+    assert len(emg) == 38
+    assert np.allclose(emg, expected, atol=1e-3)
+    assert np.allclose(emg_from_LFP(signal, 2, 1, n_jobs=3), emg, atol=1e-6)
@@ -0,0 +1,97 @@
+import numpy as np
+from neuropy.utils import backend, ccg, ccg_engine
+
+
+def test_ccg_engine():
+    spiketimes = np.sort(np.random.uniform(0, 60, 5000))
+    spiketimes = np.round(spiketimes * 30000) / 30000
+    clus_id = np.random.randint(0, 8, len(spiketimes))
+    kw = dict(sample_rate=30000, bin_size=0.001, window_size=0.1)
+
+    ccgs = ccg.correlograms(spiketimes, clus_id, **kw)
+    assert np.array_equal(ccg_engine.correlograms(spiketimes, clus_id, **kw), ccgs)
+
+    acgs = ccg_engine.correlograms(spiketimes, clus_id, acg_only=True, **kw)
+    assert np.array_equal(acgs, ccgs[np.arange(8), np.arange(8)])
+
+    pairs = [(0, 1), (5, 2), (3, 3)]
+    pair_ccgs = ccg_engine.correlograms(spiketimes, clus_id, pairs=pairs, **kw)
+    for pair_ccg, (i, j) in zip(pair_ccgs, pairs):
+        assert np.array_equal(pair_ccg, ccgs[i, j])
+
+    # reversed and repeated pairs
+    pairs = [(0, 1), (1, 0), (5, 2), (0, 1), (3, 3), (2, 5), (3, 3)]
+    pair_ccgs = ccg_engine.correlograms(spiketimes, clus_id, pairs=pairs, **kw)
+    for pair_ccg, (i, j) in zip(pair_ccgs, pairs):
+        assert np.array_equal(pair_ccg, ccgs[i, j])
+
+    ccgs = ccg_engine.correlograms(spiketimes, clus_id, symmetrize=False, **kw)
+    pair_ccgs = ccg_engine.correlograms(
+        spiketimes, clus_id, pairs=pairs, symmetrize=False, **kw
+    )
+    for pair_ccg, (i, j) in zip(pair_ccgs, pairs):
+        assert np.array_equal(pair_ccg, ccgs[i, j])
+
+
+def test_autocorrelograms():
+    spiketimes = np.sort(np.random.uniform(0, 60, 5000))
+    clus_id = np.random.randint(0, 8, len(spiketimes))
+    bin_sizes, window_sizes = [0.0005, 0.001, 0.0025], [0.1, 0.5, 0.3]
+
+    acgs = ccg_engine.autocorrelograms(
+        spiketimes, clus_id, None, 30000, bin_sizes, window_sizes
+    )
+    for acg, bin_size, window_size in zip(acgs, bin_sizes, window_sizes):
+        expected = ccg.correlograms(
+            spiketimes,
+            clus_id,
+            sample_rate=30000,
+            bin_size=bin_size,
+            window_size=window_size,
+        )
+        assert np.array_equal(acg, expected[np.arange(8), np.arange(8)])
+
+
+def test_backends_agree():
+    spiketimes = np.sort(np.random.uniform(0, 60, 5000))
+    clus_id = np.random.randint(0, 8, len(spiketimes))
+    kw = dict(sample_rate=30000, bin_size=0.001, window_size=0.1)
+    edges = np.arange(0, 60.5, 0.5)
+
+    results = []
+    for name in ["numpy", "numba"]:
+        b = backend.set_backend(name)
+        results.append(
+            (
+                ccg_engine.correlograms(spiketimes, clus_id, **kw),
+                b.bin_counts(spiketimes, clus_id, edges, 8),
+            )
+        )
+    backend.set_backend()
+
+    assert np.array_equal(results[0][0], results[1][0])
+    assert np.array_equal(results[0][1], results[1][1])
+
+
+def test_neurons_acgs_cache():
+    from neuropy.core import Neurons
+    from neuropy.utils.neurons_util import calculate_neurons_acgs
+
+    rng = np.random.default_rng(0)
+    spiketrains = np.array(
+        [np.sort(rng.uniform(0, 100, 2000)) for _ in range(3)], dtype=object
+    )
+    neurons = Neurons(spiketrains=spiketrains, t_stop=100, sampling_rate=30000)
+
+    acg1, acg2 = calculate_neurons_acgs(neurons, [0.001, 0.002], [0.1, 0.2])
+    assert acg2.shape == (3, 101)
+    assert np.array_equal(
+        calculate_neurons_acgs(neurons, [0.002], [0.2])[0],
+        calculate_neurons_acgs(neurons, [0.002], [0.2], use_cache=False)[0],
+    )
+
+    # spike times edited in place, same number of spikes
+    neurons.spiketrains[1][:] = np.sort(rng.uniform(0, 100, 2000))
+    expected = calculate_neurons_acgs(neurons, [0.001], [0.1], use_cache=False)[0]
+    assert not np.array_equal(expected, acg1)
+    assert np.array_equal(calculate_neurons_acgs(neurons, [0.001], [0.1])[0], expected)
@@ -0,0 +1,18 @@
+import numpy as np
+from neuropy.utils.mathutil import circular_linear_regression
+
+
+def test_circular_linear_regression_flat():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 1, 200)
+    phase = np.mod(-2 * np.pi * 0.5 * x + rng.normal(0, 0.3, 200), 2 * np.pi)
+    groups = np.repeat([0, 1], 100)
+    # group 1 has constant phase, best slope is zero
+    phase[groups == 1] = 1.0
+
+    slope, _, rho, pval = circular_linear_regression(
+        phase, x, groups, n_groups=3, slope_bounds=(-1, 1), n_slopes=201
+    )
+    assert np.isclose(slope[0], -0.5, atol=0.05) and rho[0] < -0.5
+    assert slope[1] == 0 and rho[1] == 0 and pval[1] == 1
+    assert np.isnan(slope[2]) and np.isnan(rho[2])
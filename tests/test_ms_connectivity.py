@@ -0,0 +1,41 @@
+import numpy as np
+from neuropy.analyses import ms_connectivity
+
+
+def test_lag_counts():
+    rng = np.random.default_rng(0)
+    ref = np.sort(rng.integers(0, 300000, 2000))
+    targets = np.sort(rng.integers(0, 300000, (3, 3000)), axis=1)
+    binsize, halfbins = 15, 20
+
+    counts = ms_connectivity._lag_counts(ref, targets, binsize, halfbins)
+    edges = (np.arange(-halfbins, halfbins + 2) - 0.5) * binsize
+    for row, target in zip(counts, targets):
+        lags = (target[None, :] - ref[:, None]).ravel()
+        assert np.array_equal(row, np.histogram(lags[lags < edges[-1]], edges)[0])
+
+
+def test_ccg_jitter_detects_connection():
+    rng = np.random.default_rng(0)
+    duration = 600
+    pre = np.sort(rng.uniform(0, duration, 6000))
+    # half of pre spikes are followed by a post spike 1.5-2 ms later
+    driven = pre[rng.random(len(pre)) < 0.5] + rng.uniform(0.0015, 0.002)
+    post = np.sort(np.concatenate((rng.uniform(0, duration, 3000), driven)))
+    other = np.sort(rng.uniform(0, duration, 5000))
+    spike_trains = [post, other, pre]
+
+    kw = dict(njitter=50, seed=0)
+    result = ms_connectivity.ccg_jitter(spike_trains, **kw)
+    expected = np.zeros((3, 3), dtype=bool)
+    expected[2, 0] = True
+    assert np.array_equal(result["connectivity"], expected)
+    assert result["ccg"].shape == (3, len(result["t"]))
+
+    parallel = ms_connectivity.ccg_jitter(spike_trains, n_jobs=2, **kw)
+    for key in ["ccg", "global_band", "pvals_jitter", "pvals"]:
+        assert np.array_equal(parallel[key], result[key])
+
+    # convolution predictor of a flat ccg is flat
+    pvals, pred, qvals = ms_connectivity.eran_conv(np.full((2, 41), 30))
+    assert np.allclose(pred, 30) and np.allclose(pvals + qvals, 1)
@@ -18,3 +18,190 @@ def test_pf():
 
     neurons = Neurons(spiketrains=spktrns, t_start=0, t_stop=2000)
     pf1d = Pf1D(neurons=neurons, position=pos, speed_thresh=0.1, grid_bin=5)
+
+
+def test_ratemap_metrics_n_jobs():
+    from neuropy.analyses.ratemap_metrics import ratemap_metrics
+
+    rng = np.random.default_rng(0)
+    t = np.arange(0, 300, 1 / 30)
+    pos = Position(
+        traces=(np.sin(2 * np.pi * t / 20) * 100).reshape(1, -1), sampling_rate=30
+    )
+    spktrns = []
+    for center in [-60, 0, 60]:
+        rate = 20 * np.exp(-((pos.x - center) ** 2) / (2 * 10**2)) + 0.5
+        spktrns.append(np.sort(t[rng.random(len(t)) < rate / 30]))
+    neurons = Neurons(spiketrains=np.array(spktrns, dtype=object), t_stop=300)
+
+    kw = dict(n_shuffles=80, min_shift=20, seed=5)
+    df1 = ratemap_metrics(neurons, pos, n_jobs=1, **kw)
+    df2 = ratemap_metrics(neurons, pos, n_jobs=2, **kw)
+    assert df1.equals(df2)
+
+
+def test_pf1d_matches_per_neuron():
+    from scipy.ndimage import gaussian_filter1d
+    from neuropy.core import Epoch
+    import pandas as pd
+
+    rng = np.random.default_rng(0)
+    t = np.arange(0, 300, 1 / 30)
+    pos = Position(
+        traces=(np.sin(2 * np.pi * t / 20) * 100).reshape(1, -1), sampling_rate=30
+    )
+    spktrns = np.array(
+        [np.sort(rng.uniform(-5, 305, n)) for n in [3000, 50, 2000]], dtype=object
+    )
+    neurons = Neurons(spiketrains=spktrns, t_stop=300)
+    epochs = Epoch(pd.DataFrame(dict(start=[200, 10], stop=[250, 100], label="")))
+    grid_bin, sigma = 5, 3
+    xbin = np.arange(pos.x.min(), pos.x.max() + grid_bin, grid_bin)
+    smooth = lambda f: gaussian_filter1d(f, sigma / grid_bin, axis=-1)
+
+    for epochs_, speed_thresh in [(None, 10), (epochs, None)]:
+        pf = Pf1D(
+            neurons,
+            pos,
+            epochs=epochs_,
+            frate_thresh=0,
+            speed_thresh=speed_thresh,
+            grid_bin=grid_bin,
+            sigma=sigma,
+        )
+
+        if epochs_ is None:
+            keep = lambda st: (st >= pos.t_start) & (st <= pos.t_stop)
+            frames = pos.speed >= speed_thresh
+        else:
+            keep = lambda st: ((st >= 10) & (st <= 100)) | ((st >= 200) & (st <= 250))
+            frames = keep(pos.time)
+        occupancy = smooth(np.histogram(pos.x[frames], xbin)[0] / 30 + 1e-16)
+        assert np.allclose(pf.occupancy, occupancy)
+
+        for i, st in enumerate(spktrns):
+            st = st[keep(st)]
+            if speed_thresh is not None:
+                st = st[np.interp(st, pos.time, pos.speed) >= speed_thresh]
+            spk_x = np.interp(st, pos.time, pos.x)
+            counts = smooth(np.histogram(spk_x, xbin)[0].astype(float))
+            assert np.allclose(pf.tuning_curves[i], counts / occupancy)
+            assert np.array_equal(pf.ratemap_spiketrains[i], st)
+            assert np.allclose(pf.ratemap_spiketrains_pos[i], spk_x)
+
+
+def test_lap_ratemaps():
+    from scipy.ndimage import gaussian_filter1d
+    from neuropy.core import Epoch
+    from neuropy.analyses.placefields import LapRatemaps
+    import pandas as pd
+
+    rng = np.random.default_rng(0)
+    t = np.arange(0, 300, 1 / 30)
+    pos = Position(
+        traces=(np.sin(2 * np.pi * t / 20) * 100).reshape(1, -1), sampling_rate=30
+    )
+    spktrns = np.array(
+        [np.sort(rng.uniform(0, 300, n)) for n in [3000, 200, 2000]], dtype=object
+    )
+    neurons = Neurons(spiketrains=spktrns, t_stop=300)
+    # alternating 10 s laps, position increases during odd ("up") laps
+    starts = np.arange(5, 290, 10)
+    laps = Epoch(
+        pd.DataFrame(
+            dict(
+                start=starts,
+                stop=starts + 10,
+                label=np.where(np.arange(len(starts)) % 2, "up", "down"),
+            )
+        )
+    )
+    grid_bin, sigma = 5, 3
+    xbin = np.arange(pos.x.min(), pos.x.max() + grid_bin, grid_bin)
+    smooth = lambda f: gaussian_filter1d(f, sigma / grid_bin, axis=-1)
+
+    lr = LapRatemaps(neurons, pos, laps, "up", grid_bin=grid_bin, sigma=sigma)
+    up_starts = starts[1::2]
+    assert lr.n_laps == len(up_starts)
+
+    in_lap = lambda arr, lap: (arr >= up_starts[lap]) & (arr <= up_starts[lap] + 10)
+    for lap in range(lr.n_laps):
+        occupancy = np.histogram(pos.x[in_lap(pos.time, lap)], xbin)[0]
+        assert np.allclose(lr.occupancy[lap], smooth(occupancy / 30))
+        assert np.array_equal(lr.unvisited[lap], occupancy == 0)
+        for i, st in enumerate(spktrns):
+            spk_x = np.interp(st[in_lap(st, lap)], pos.time, pos.x)
+            counts = smooth(np.histogram(spk_x, xbin)[0].astype(float))
+            assert np.allclose(lr.spike_counts[lap, i], counts)
+
+    train = np.arange(lr.n_laps) % 3 != 0
+    ratemap = lr.get_ratemap(train)
+    expected = lr.spike_counts[train].sum(axis=0) / (
+        lr.occupancy[train].sum(axis=0) + 1e-16
+    )
+    assert np.allclose(ratemap.tuning_curves, expected)
+
+    tuning = lr.tuning_curves
+    reference = lr.get_ratemap().tuning_curves
+    lap_corr = lr.lap_correlation()
+    pv_corr = lr.population_vector_correlation()
+    for lap in range(lr.n_laps):
+        visited = ~lr.unvisited[lap]
+        for i in range(len(spktrns)):
+            expected = np.corrcoef(tuning[lap, i, visited], reference[i, visited])
+            assert np.isclose(lap_corr[lap, i], expected[0, 1])
+        for lap2 in range(lr.n_laps):
+            both = visited & ~lr.unvisited[lap2]
+            expected = np.corrcoef(
+                tuning[lap][:, both].ravel(), tuning[lap2][:, both].ravel()
+            )
+            assert np.isclose(pv_corr[lap, lap2], expected[0, 1])
+
+
+def test_ratemap_metrics_formulas():
+    from scipy.ndimage import gaussian_filter1d
+    from neuropy.analyses import ratemap_metrics as rm
+
+    rng = np.random.default_rng(0)
+    occupancy = rng.uniform(0.5, 2, 30)
+    tuning_curves = rng.gamma(1, 2, (4, 30))
+    tuning_curves[:, :5] = 0
+    p = occupancy / occupancy.sum()
+    for tc, info, sparsity in zip(
+        tuning_curves,
+        rm.spatial_information(tuning_curves, occupancy),
+        rm.sparsity(tuning_curves, occupancy),
+    ):
+        mean_rate = np.sum(p * tc)
+        nz = tc > 0
+        expected = np.sum(p[nz] * tc[nz] / mean_rate * np.log2(tc[nz] / mean_rate))
+        assert np.isclose(info, expected)
+        assert np.isclose(sparsity, mean_rate**2 / np.sum(p * tc**2))
+
+    # shuffles are circular shifts of each neuron's spikes along frames
+    n_frames, n_neurons, n_bins = 3000, 3, 30
+    frame_bins = rng.integers(0, n_bins, n_frames)
+    spk_frames = rng.integers(0, n_frames, 500)
+    neuron_indx = rng.integers(0, n_neurons, 500)
+    smooth = lambda f: gaussian_filter1d(f.astype("float"), 1, axis=-1)
+    occupancy = smooth(np.bincount(frame_bins, minlength=n_bins)) + 1e-16
+    info = rm._shuffled_information(
+        spk_frames,
+        neuron_indx,
+        frame_bins,
+        occupancy,
+        n_neurons,
+        n_bins,
+        7,
+        100,
+        smooth,
+        5,
+        max_elements=1000,
+    )
+    shifts = np.random.default_rng(5).integers(100, n_frames - 100, (7, n_neurons))
+    for shuffle_info, shift in zip(info, shifts):
+        counts = np.zeros((n_neurons, n_bins))
+        for f, n in zip(spk_frames, neuron_indx):
+            counts[n, frame_bins[(f + shift[n]) % n_frames]] += 1
+        expected = rm.spatial_information(smooth(counts) / occupancy, occupancy)
+        assert np.allclose(shuffle_info, expected)
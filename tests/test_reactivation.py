@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+from neuropy.core import Neurons
+from neuropy.analyses.reactivation import ExplainedVariance
+
+
+def _assembly_neurons(n_neurons=8, duration=300, seed=0):
+    """Poisson neurons, some of which are co-modulated by a shared drive"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(0, duration, 0.01)
+    drive = np.repeat(rng.random(len(t) // 10 + 1), 10)[: len(t)]
+    spiketrains = []
+    for i in range(n_neurons):
+        rate = 10 * (0.5 + (i % 3) * drive)
+        # spike times off the 10 ms grid so none falls on a bin edge
+        spikes = t[rng.random(len(t)) < rate * 0.01] + rng.uniform(0.001, 0.009)
+        spiketrains.append(np.sort(spikes))
+    return Neurons(spiketrains=np.array(spiketrains, dtype=object), t_stop=duration)
+
+
+def test_explained_variance_matches_pingouin():
+    pg = pytest.importorskip("pingouin")
+    neurons = _assembly_neurons()
+    ev = ExplainedVariance(
+        neurons, [0, 100], [100, 300], [0, 100], window=60, slideby=20
+    )
+
+    def pairwise_corr(t_start, t_stop):
+        binned = neurons.time_slice(t_start, t_stop).get_binned_spiketrains(0.25)
+        return binned.get_pairwise_corr()
+
+    windows = lambda t0, t1: np.lib.stride_tricks.sliding_window_view(
+        np.arange(t0, t1), 60
+    )[::20, [0, -1]]
+    template = pairwise_corr(0, 100)
+    matching = [pairwise_corr(*w) for w in windows(100, 300)]
+    control = [pairwise_corr(*w) for w in windows(0, 100)]
+
+    partial_corr = lambda x, y, z: pg.partial_corr(
+        pd.DataFrame(dict(x=x, y=y, z=z)), "x", "y", covar="z"
+    ).r.values[0]
+    expected = np.array(
+        [[partial_corr(template, m, c) for m in matching] for c in control]
+    )
+    assert np.allclose(ev.partial_corr, expected)
+    assert np.allclose(ev.ev, np.mean(expected**2, axis=0))
+    expected = np.array(
+        [[partial_corr(template, c, m) for m in matching] for c in control]
+    )
+    assert np.allclose(ev.rev_partial_corr, expected)
+    assert np.allclose(ev.matching_time, windows(100, 300).mean(axis=1))
+
+
+def test_ensemble_activation():
+    from neuropy.core import Epoch
+    from neuropy.analyses.reactivation import NeuronEnsembles
+
+    neurons = _assembly_neurons(n_neurons=12)
+    ensembles = NeuronEnsembles(
+        neurons, Epoch(pd.DataFrame(dict(start=[0], stop=[150], label="")))
+    )
+    assert ensembles.n_ensembles > 0
+    epochs = Epoch(pd.DataFrame(dict(start=[160, 200], stop=[180.1, 250], label="")))
+    activation, time = ensembles.get_activation(epochs, chunk_bins=37)
+
+    spkcnts, expected_time = [], []
+    for e in epochs.itertuples():
+        binned = neurons.time_slice(e.start, e.stop).get_binned_spiketrains(0.25)
+        spkcnts.append(binned.spike_counts)
+        expected_time.append(binned.time)
+    spkcnts = np.hstack(spkcnts)
+    assert np.allclose(time, np.concatenate(expected_time))
+
+    for w, act in zip(ensembles.weights.T, activation):
+        projection = np.outer(w, w)
+        np.fill_diagonal(projection, 0)
+        expected = [z @ projection @ z for z in spkcnts.T]
+        assert np.allclose(act, expected)
@@ -0,0 +1,355 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.signal as sg
+from scipy import stats
+from scipy.integrate import trapezoid
+from neuropy import core
+from neuropy.utils import signal_process
+from neuropy.utils.signal_process import PAC
+
+
+def _pac_signal(coupled, fs=1250, duration=60, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(fs * duration)) / fs
+    theta = np.sin(2 * np.pi * 8 * t)
+    gamma_amp = 1 + theta if coupled else np.ones_like(t)
+    trace = theta + 0.3 * gamma_amp * np.sin(2 * np.pi * 60 * t)
+    return core.Signal(trace[None, :] + 0.1 * rng.standard_normal(len(t)), fs)
+
+
+def test_pac_comodulo_fresh_signals():
+    pac = PAC()
+    kw = dict(phase_bands=[[6, 10]], amp_bands=[[50, 70]])
+    mi = [pac.comodulo(_pac_signal(c), **kw)[0, 0, 0, 0] for c in [True, False]]
+    assert mi[0] > 100 * mi[1]
+
+    signal = _pac_signal(True)
+    features = pac.band_features(signal, **kw)
+    assert np.allclose(pac.comodulo(signal, features=features, **kw)[0, 0, 0, 0], mi[0])
+
+
+def test_pac_comodulo_uncoupled_pvals():
+    rng = np.random.default_rng(0)
+    signal = core.Signal(rng.standard_normal((4, 250 * 60)), 250)
+    amp_bands = np.stack((np.arange(30, 90, 10), np.arange(40, 100, 10)), axis=1)
+    pac = PAC()
+    pac.comodulo(signal, [[4, 8], [8, 12]], amp_bands, n_shuffles=200, seed=0)
+    pvals = pac.comodulogram_pval.ravel()
+    assert 0.35 < pvals.mean() < 0.65
+    assert stats.kstest(pvals, "uniform").pvalue > 0.01
+
+    with pytest.raises(AssertionError):
+        pac.comodulo(signal, [[4, 8]], [[30, 40]], n_shuffles=10, min_shift=30)
+
+
+def test_event_triggered_csd_two_columns():
+    shank = core.Shank.auto_generate(columns=2, contacts_per_column=8)
+    probegroup = core.ProbeGroup()
+    probegroup.add_probe(core.Probe(shank))
+    depths = probegroup.to_dataframe().y.values
+    assert len(np.unique(depths)) < len(depths)
+
+    fs, rng = 1250, np.random.default_rng(0)
+    events = np.sort(rng.uniform(1, 59, 50))
+    traces = 0.01 * rng.standard_normal((len(depths), 60 * fs))
+    profile = np.exp(-((depths - depths.mean()) ** 2) / (2 * np.std(depths) ** 2))
+    for frame in (events * fs).astype(int):
+        traces[:, frame - 10 : frame + 11] += profile[:, None]
+    signal = core.Signal(traces, fs)
+
+    for method in ["spline", "step", "classic"]:
+        csd = signal_process.event_triggered_csd(
+            signal, probegroup, events, window=(-0.02, 0.02), method=method
+        )[0]
+        n_depths = len(np.unique(depths))
+        assert csd.lfp.shape == (n_depths, 51)
+        assert np.all(np.diff(csd.coords) < 0)
+        assert np.all(np.isfinite(csd.csdmap))
+
+
+def test_pe_spec_frames():
+    rng = np.random.default_rng(0)
+    fs, t_start = 100, 2.0
+    spec = signal_process.Spectrogram(
+        rng.random((3, 100000)), np.arange(3), sampling_rate=fs, t_start=t_start
+    )
+    starts = np.arange(200) * 5 + rng.uniform(0, 3, 200)
+    ignore_epochs = core.Epoch(
+        pd.DataFrame(
+            dict(start=starts, stop=starts + rng.uniform(0.05, 1, 200), label="")
+        )
+    )
+    events = np.append(rng.uniform(10, 990, 300), t_start + 0.5 + 0.4 / fs)
+    sxx = spec.get_pe_spec(events, (0.5, 0.5), ignore_epochs, False)
+
+    first = np.floor((events - 0.5 - t_start) * fs).astype(int)
+    frames = first[:, None] + np.arange(100)[None, :]
+    expected = spec.traces[:, frames].astype(float)
+    ignore = ignore_epochs.contains((t_start + frames / fs).ravel())[0]
+    expected[:, ignore.reshape(frames.shape)] = np.nan
+    assert np.array_equal(np.moveaxis(expected, 1, 2), sxx, equal_nan=True)
+
+
+def test_event_triggered_csd_event_frames():
+    shank = core.Shank.auto_generate(columns=1, contacts_per_column=6)
+    probegroup = core.ProbeGroup()
+    probegroup.add_probe(core.Probe(shank))
+    fs = 1250
+    traces = np.random.default_rng(1).standard_normal((6, fs * 10))
+    signal = core.Signal(traces, fs, t_start=5)
+
+    # first event starts before t_start and is dropped, second is floored
+    events = np.array([5 - 0.4 / fs, 7 + 0.6 / fs])
+    csd = signal_process.event_triggered_csd(
+        signal, probegroup, events, window=(0, 0.01), method="step"
+    )[0]
+    frame = int(2 * fs)
+    expected = traces[:, frame : frame + 13]
+    order = np.argsort(probegroup.to_dataframe().y.values)[::-1]
+    assert np.allclose(csd.lfp, expected[order])
+
+
+def test_theta_params_zero_crossings_aligned():
+    fs = 1250
+    rng = np.random.default_rng(0)
+    t = np.arange(10 * fs) / fs
+    # asymmetric theta with fast rise and slow fall
+    phase = 2 * np.pi * 8 * t
+    lfp = np.sin(phase) + 0.3 * np.sin(2 * phase) + 0.05 * rng.standard_normal(len(t))
+    theta = signal_process.ThetaParams(lfp, fs=fs, method="waveshape")
+
+    assert len(theta.zero_up) == len(theta.rise_mid)
+    assert len(theta.zero_down) == len(theta.fall_mid)
+    assert np.all((theta.trough < theta.zero_up) & (theta.zero_up < theta.peak))
+    assert np.all(
+        (theta.peak[:-1] < theta.zero_down) & (theta.zero_down < theta.trough[1:])
+    )
+
+
+def test_power_correlation_matches_spectrogram():
+    fs = 250
+    x = np.random.default_rng(0).standard_normal(fs * 60)
+    freqs, corr = signal_process.power_correlation(
+        x, fs=fs, window=2, overlap=1, fband=(1, 40)
+    )
+
+    f, _, sxx = sg.spectrogram(x, fs=fs, nperseg=2 * fs, noverlap=fs)
+    freq_indx = (f >= 1) & (f <= 40)
+    expected = np.corrcoef(sxx[freq_indx])
+    np.fill_diagonal(expected, 0)
+    assert np.allclose(freqs, f[freq_indx])
+    assert np.allclose(corr, expected)
+
+
+def test_mtspect_matches_welch():
+    fs = 250
+    x = np.random.default_rng(0).standard_normal((2, fs * 60))
+    f, psd = signal_process.mtspect(x, 256, 128, fs=fs)
+
+    tapers = sg.windows.dpss(256, NW=5, Kmax=6)
+    expected = np.mean(
+        [sg.welch(x, fs=fs, window=taper, noverlap=128)[1] for taper in tapers],
+        axis=0,
+    )
+    assert np.allclose(psd, expected)
+
+
+def test_irasa_epochs_matches_irasa():
+    fs, n_frames = 250, 250 * 120
+    rng = np.random.default_rng(0)
+    # 1/f noise
+    spectrum = np.fft.rfft(rng.standard_normal((2, n_frames)))
+    f = np.fft.rfftfreq(n_frames, 1 / fs)
+    spectrum[:, 1:] /= f[1:] ** 0.75
+    spectrum[:, 0] = 0
+    traces = np.fft.irfft(spectrum, n_frames)
+    signal = core.Signal(traces, fs)
+
+    freqs, psd_aperiodic, _ = signal_process.irasa(traces, sf=fs, win_sec=4)
+    freqs_epochs, aperiodic, _, states, n_windows = signal_process.irasa_epochs(
+        signal, win_sec=4, overlap_sec=2
+    )
+    assert states == ["all"] and np.allclose(freqs_epochs, freqs)
+    # windows are resampled separately, so only close to whole signal irasa
+    assert np.mean(np.abs(aperiodic[0] / psd_aperiodic - 1)) < 0.06
+
+    epochs = core.Epoch(
+        pd.DataFrame(dict(start=[0, 118], stop=[120, 120], label=["A", "B"]))
+    )
+    with pytest.warns(UserWarning):
+        _, aperiodic_states, _, states, n_windows_states = signal_process.irasa_epochs(
+            signal, epochs, win_sec=4, overlap_sec=2
+        )
+    assert states == ["A", "B"] and n_windows_states[1] == 0
+    assert n_windows_states[0] == n_windows[0]
+    assert np.allclose(aperiodic_states[0], aperiodic[0])
+    assert np.all(np.isnan(aperiodic_states[1]))
+
+
+def test_band_power_survey():
+    fs, window = 250, 2
+    traces = np.random.default_rng(0).standard_normal((3, fs * 60))
+    signal = core.Signal(traces, fs)
+    bands = [(5, 10), (30, 60)]
+    zscored = stats.zscore(traces, axis=-1)
+    windows = zscored.reshape(3, 30, window * fs)
+
+    power, t = signal_process.band_power_survey(
+        signal, bands, window=window, method="psd", block_dur=10
+    )
+    assert power.shape == (3, 2, 30) and np.allclose(t, np.arange(1, 60, 2))
+    f, pxx = sg.welch(windows, fs=fs, nperseg=125, noverlap=63)
+    for j, (lf, hf) in enumerate(bands):
+        f_band = (f > lf) & (f < hf)
+        expected = trapezoid(pxx[..., f_band], x=f[f_band], axis=-1)
+        assert np.allclose(power[:, j], expected, rtol=1e-5)
+
+    # blocks are filtered with margins, so close to filtering the whole signal
+    power, _ = signal_process.band_power_survey(
+        signal, bands, window=window, method="hilbert", block_dur=10, n_jobs=2
+    )
+    for j, (lf, hf) in enumerate(bands):
+        filtered = signal_process.filter_sig.bandpass(zscored, lf=lf, hf=hf, fs=fs)
+        amp = np.abs(sg.hilbert(filtered, axis=-1)).reshape(3, 30, window * fs)
+        assert np.allclose(power[:, j], amp.mean(axis=-1), rtol=1e-2)
+        assert np.allclose(
+            signal_process.hilbert_amplitude_stat(zscored, (lf, hf), fs),
+            signal_process.hilbert_amplitude_stat(list(zscored), (lf, hf), fs),
+        )
+
+
+def test_wavelet_sg_matches_convolution():
+    fs = 250
+    trace = np.random.default_rng(0).standard_normal(fs * 30)
+    freqs = np.array([4, 8, 20, 60.0])
+    wsg = signal_process.WaveletSg(
+        core.Signal(trace[None, :], fs), freqs, freq_chunk=3, block_dur=7, n_jobs=2
+    )
+
+    for f, amp in zip(freqs, wsg.traces):
+        # morlet wavelet with 7 cycles truncated to 5 standard deviations
+        sigma = 7 / (2 * np.pi * f)
+        half = int(np.ceil(5 * sigma * fs))
+        t = np.arange(-half, half + 1) / fs
+        wavelet = (sigma * np.sqrt(np.pi)) ** -0.5 * np.exp(
+            -(t**2) / (2 * sigma**2) + 2j * np.pi * f * t
+        )
+        expected = np.abs(np.convolve(trace, wavelet, mode="same"))
+        assert np.allclose(amp, expected, atol=1e-5 * expected.max())
+
+
+def test_batch_spectrogram_matches_scipy(tmp_path):
+    fs = 250
+    traces = np.random.default_rng(0).standard_normal((3, fs * 30))
+    signal = core.Signal(traces, fs)
+    zscored = stats.zscore(traces, axis=-1)
+
+    sxx, f, t = signal_process.batch_spectrogram(
+        signal, window=1, overlap=0.5, n_jobs=2
+    )
+    f_sg, t_sg, expected = sg.spectrogram(zscored, fs=fs, nperseg=250, noverlap=125)
+    assert np.allclose(f, f_sg) and np.allclose(t, t_sg)
+    assert np.allclose(sxx, expected, atol=1e-6 * expected.max())
+
+    filename = tmp_path / "sxx.npy"
+    sxx, _, _ = signal_process.batch_spectrogram(
+        signal,
+        multitaper=True,
+        NW=3,
+        n_tapers=4,
+        channel_indx=[2, 0],
+        filename=filename,
+    )
+    expected = np.mean(
+        [
+            sg.spectrogram(zscored[[2, 0]], fs=fs, window=taper, noverlap=125)[2]
+            for taper in sg.windows.dpss(250, NW=3, Kmax=4)
+        ],
+        axis=0,
+    )
+    assert np.allclose(sxx, expected, atol=1e-6 * expected.max())
+    assert np.array_equal(np.load(filename), sxx)
+
+
+def test_fourier_sg_freqs_interpolation():
+    fs = 250
+    signal = core.Signal(np.random.default_rng(0).standard_normal((1, fs * 30)), fs)
+    freqs = np.geomspace(0.5, 130, 40)
+
+    linear = signal_process.FourierSg(signal, window=1, overlap=0.5)
+    resampled = signal_process.FourierSg(signal, window=1, overlap=0.5, freqs=freqs)
+    # linear interpolation with nearest value beyond the fft frequencies
+    expected = np.array([np.interp(freqs, linear.freqs, _) for _ in linear.traces.T]).T
+    assert np.allclose(resampled.freqs, freqs)
+    assert np.allclose(resampled.traces, expected, atol=1e-6 * expected.max())
+
+    resampled = signal_process.FourierSg(
+        signal, window=1, overlap=0.5, freqs=freqs[::-1], multitaper=True
+    )
+    linear = signal_process.FourierSg(signal, window=1, overlap=0.5, multitaper=True)
+    expected = np.array(
+        [np.interp(freqs[::-1], linear.freqs, _) for _ in linear.traces.T]
+    ).T
+    assert np.allclose(resampled.traces, expected, atol=1e-6 * expected.max())
+
+
+def test_pe_mean_spec_chunks():
+    rng = np.random.default_rng(0)
+    spec = signal_process.Spectrogram(
+        rng.random((3, 100000)), np.arange(3), sampling_rate=100
+    )
+    ignore_epochs = core.Epoch(
+        pd.DataFrame(dict(start=[100, 400], stop=[101, 402], label=""))
+    )
+    # includes a missing event and events with all frames ignored
+    events = np.append(rng.uniform(10, 990, 300), [np.nan, 100.4, 401])
+
+    sxx = spec.get_pe_spec(events, (0.3, 0.3), ignore_epochs, False)
+    expected = np.nanmean(sxx, axis=2)
+    mean_spec = spec.get_pe_mean_spec(events, (0.3, 0.3), ignore_epochs, chunk_events=7)
+    assert np.allclose(mean_spec.traces, expected)
+    assert np.isclose(mean_spec.t_start, -0.3)
+
+
+def test_bicoherence_matches_stft():
+    fs = 250
+    rng = np.random.default_rng(0)
+    t = np.arange(fs * 60) / fs
+    # quadratic phase coupling between 8 and 20 Hz on first channel
+    phases = rng.uniform(0, 2 * np.pi, 2)
+    coupled = (
+        np.cos(2 * np.pi * 8 * t + phases[0])
+        + np.cos(2 * np.pi * 20 * t + phases[1])
+        + np.cos(2 * np.pi * 28 * t + phases.sum())
+    )
+    traces = np.vstack((coupled, np.zeros_like(t))) + rng.standard_normal((2, len(t)))
+
+    bicoh = signal_process.bicoherence(
+        flow=1, fhigh=40, fs=fs, window=500, overlap=250, chunk_segments=7
+    )
+    bicoh.compute(traces)
+
+    for trace, bicoher in zip(traces, bicoh.bicoher):
+        X = sg.stft(trace - trace.mean(), fs=fs, nperseg=500, noverlap=250)[2]
+        f1, f2 = np.meshgrid(bicoh.freq_ind, bicoh.freq_ind, indexing="ij")
+        bispec = np.mean(X[f1] * X[f2] * np.conj(X[f1 + f2]), axis=-1)
+        power = np.mean(np.abs(X) ** 2, axis=-1)
+        expected = np.abs(bispec) / np.sqrt(power[f1] * power[f2] * power[f1 + f2])
+        assert np.allclose(bicoher, expected)
+
+    i, j = np.searchsorted(bicoh.freq, [8, 20])
+    assert bicoh.bicoher[0, i, j] > 0.5 and bicoh.bicoher[1, i, j] < 0.2
+
+    single = signal_process.bicoherence(
+        flow=1, fhigh=40, fs=fs, window=500, overlap=250, single_precision=True
+    )
+    assert np.allclose(single.compute(traces), bicoh.bicoher, atol=1e-4)
+
+    # frequency sums beyond nyquist
+    bicoh = signal_process.bicoherence(
+        flow=1, fhigh=100, fs=fs, window=500, overlap=250
+    )
+    bicoh.compute(traces[0])
+    beyond = bicoh.freq[:, None] + bicoh.freq[None, :] > fs / 2
+    assert np.array_equal(np.isnan(bicoh.bicoher), beyond)
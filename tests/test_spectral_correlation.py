@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import scipy.signal as sg
+from neuropy import core
+from neuropy.utils.spectral_correlation import power_correlation_by_state
+
+
+def test_power_correlation_by_state():
+    rng = np.random.default_rng(0)
+    fs = 250
+    traces = rng.standard_normal((2, fs * 60))
+    signal = core.Signal(traces, fs)
+    epochs = core.Epoch(
+        pd.DataFrame(
+            dict(start=[0, 20.5, 35], stop=[20.5, 35, 50], label=["A", "B", "A"])
+        )
+    )
+
+    freqs, corr, states, n_windows = power_correlation_by_state(
+        signal, epochs, window=2, overlap=1, fband=(1, 40), multitaper=False
+    )
+
+    f, t, sxx = sg.spectrogram(traces, fs=fs, nperseg=2 * fs, noverlap=fs)
+    freq_indx = (f >= 1) & (f <= 40)
+    assert np.allclose(freqs, f[freq_indx])
+    window_start = t - 1
+    for s, state in enumerate(states):
+        bounds = epochs.to_dataframe().query("label == @state")[["start", "stop"]]
+        in_state = np.zeros(len(t), dtype=bool)
+        for start, stop in bounds.values:
+            in_state |= (window_start >= start) & (window_start + 2 <= stop)
+        assert n_windows[s] == in_state.sum()
+        for chan in range(2):
+            expected = np.corrcoef(sxx[chan][freq_indx][:, in_state])
+            np.fill_diagonal(expected, 0)
+            assert np.allclose(corr[s, chan], expected)
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+from neuropy.core import Neurons
+from neuropy.analyses.spkepochs import detect_off_epochs, detect_pbe_epochs
+
+
+def _bursty_neurons(n_neurons=100, duration=60, seed=0):
+    """Poisson neurons with shared population bursts and silent periods"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(0, duration, 0.001)
+    rate = np.full(len(t), 20.0)
+    for start in rng.uniform(0, duration - 1, 30):
+        rate[(t >= start) & (t < start + 0.15)] = 100
+    for start in rng.uniform(0, duration - 1, 30):
+        rate[(t >= start) & (t < start + 0.1)] = 0.5
+    spiketrains = [
+        np.sort(t[rng.random(len(t)) < rate * 0.001] + rng.uniform(0, 0.001))
+        for _ in range(n_neurons)
+    ]
+    return Neurons(spiketrains=np.array(spiketrains, dtype=object), t_stop=duration)
+
+
+def test_chunked_epochs_match_mua():
+    neurons = _bursty_neurons()
+    mua = neurons.get_mua(bin_size=0.001)
+
+    off_mua = detect_off_epochs(mua, chunk_dur=1000).to_dataframe()
+    off_neurons = detect_off_epochs(neurons, chunk_dur=5).to_dataframe()
+    assert len(off_mua) > 0
+    pd.testing.assert_frame_equal(off_neurons, off_mua)
+
+    pbe_mua = detect_pbe_epochs(mua, chunk_dur=1000).to_dataframe()
+    pbe_neurons = detect_pbe_epochs(neurons, chunk_dur=5).to_dataframe()
+    assert len(pbe_mua) > 0
+    pd.testing.assert_frame_equal(pbe_neurons, pbe_mua)
+
+
+def test_off_epochs_none_found():
+    from neuropy.core import Mua
+
+    mua = Mua(np.full(10000, 3), bin_size=0.001)
+    off = detect_off_epochs(mua, chunk_dur=2).to_dataframe()
+    assert len(off) == 0